@@ -0,0 +1,259 @@
+"""
+Aftercare Templates
+Pre-written meal prep guide and tips sections, keyed by goal, diet type and meal prep style
+"""
+
+import re
+from functools import lru_cache
+
+# The model writes only this personalised part; the templated sections go in front of it
+PERSONAL_NOTES_HEADING = 'PERSONAL NOTES'
+PERSONAL_NOTES_PATTERN = re.compile(r'^\s*#{0,3}\s*\**\s*(?:\d+\.\s*)?PERSONAL NOTES\s*\**\s*$', re.MULTILINE)
+MEAL_PREP_HEADING_PATTERN = re.compile(r'^\s*#{0,3}\s*\**\s*(?:\d+\.\s*)?MEAL PREP GUIDE', re.MULTILINE | re.IGNORECASE)
+
+
+PREP_STRATEGIES = {
+    'daily': """### Your Daily Prep Strategy
+
+Cooking fresh each day keeps meals varied and means nothing sits in the fridge for long. The key is making each session quick and calm rather than a chore.
+
+- Read the next day's meals the evening before, so you know exactly what you need
+- Take anything frozen out to defrost in the fridge overnight, never on the worktop
+- Wash and chop vegetables for the whole day in one go while the oven or hob heats up
+- Cook a little extra at dinner if tomorrow's lunch uses the same ingredients
+- Keep a tidy, stocked cupboard of staples so a missing ingredient never derails the plan""",
+
+    'batch': """### Your Batch Prep Strategy
+
+Batch cooking means one or two focused sessions a week do most of the work, so weekday meals are simply a case of reheating and assembling.
+
+- Pick one main prep day (Sunday works well for most people) and a shorter top-up session midweek
+- Cook proteins, grains and roasted vegetables in bulk, then portion them into labelled containers
+- Keep sauces and dressings in separate pots so meals don't go soggy
+- Freeze anything you won't eat within three days on the day you cook it
+- Write the date on every container so you always know what to eat first""",
+
+    'mixed': """### Your Mixed Prep Strategy
+
+A mix of batch cooking and fresh cooking gives you the time savings of prepping ahead with the variety of cooking on the day.
+
+- Batch cook the building blocks once or twice a week: proteins, grains and a big tray of roasted vegetables
+- Cook quick, fresh meals on the evenings you have time, using those prepared building blocks
+- Prepare breakfasts and snacks in advance, as they're the meals most often skipped when time is short
+- Keep one or two emergency meals in the freezer for days when plans change
+- Review the week ahead each weekend and decide which days are prep days and which are fresh days""",
+}
+
+STORAGE_GUIDES = {
+    'omnivore': """### Storage & Reheating
+
+- Cooked chicken, turkey, beef and pork keep for up to 3 days in the fridge, or 3 months in the freezer
+- Cooked fish is best eaten within 2 days; don't reheat it more than once
+- Cooked rice must be cooled quickly (within an hour) and eaten within 24 hours; reheat until piping hot
+- Soups, stews and chillies keep for 3-4 days in the fridge and freeze very well
+- Reheat everything until steaming hot all the way through, stirring halfway in the microwave
+- Defrost frozen meals overnight in the fridge rather than at room temperature""",
+
+    'pescatarian': """### Storage & Reheating
+
+- Cooked fish and seafood are best eaten within 2 days; don't reheat them more than once
+- Tinned fish such as tuna, salmon and sardines is a brilliant store-cupboard standby for quick meals
+- Cooked eggs keep for up to 5 days in their shells in the fridge
+- Cooked rice must be cooled quickly (within an hour) and eaten within 24 hours; reheat until piping hot
+- Bean and lentil dishes keep for 3-4 days in the fridge and freeze very well
+- Reheat everything until steaming hot all the way through, stirring halfway in the microwave""",
+
+    'vegetarian': """### Storage & Reheating
+
+- Cooked beans, lentils and chickpeas keep for 3-4 days in the fridge and freeze very well
+- Hard-boiled eggs keep for up to 5 days in their shells in the fridge
+- Halloumi, paneer and tofu dishes keep for 3 days; reheat gently so they don't turn rubbery
+- Cooked rice must be cooled quickly (within an hour) and eaten within 24 hours; reheat until piping hot
+- Soups, curries and stews keep for 3-4 days in the fridge and freeze in portions for busy days
+- Reheat everything until steaming hot all the way through, stirring halfway in the microwave""",
+
+    'vegan': """### Storage & Reheating
+
+- Cooked beans, lentils and chickpeas keep for 3-4 days in the fridge and freeze very well
+- Pressed and baked tofu and tempeh keep for 4 days and are ready to add to salads and bowls
+- Cooked rice must be cooled quickly (within an hour) and eaten within 24 hours; reheat until piping hot
+- Soups, curries and dhals keep for 3-4 days in the fridge and freeze in portions for busy days
+- Store dressings and nut-based sauces separately and give them a stir before serving
+- Reheat everything until steaming hot all the way through, stirring halfway in the microwave""",
+}
+
+BATCH_COOKING_IDEAS = {
+    'omnivore': "- Roast a tray of chicken thighs or breasts alongside a tray of mixed vegetables\n"
+                "- Make a large pot of chilli, bolognese or curry and freeze it in single portions\n"
+                "- Cook a big batch of rice, quinoa or potatoes to use across several meals",
+    'pescatarian': "- Bake several salmon or white fish fillets at once for salads and bowls\n"
+                   "- Make a large pot of lentil soup or bean chilli and freeze it in single portions\n"
+                   "- Cook a big batch of rice, quinoa or potatoes to use across several meals",
+    'vegetarian': "- Make a large pot of dhal, bean chilli or vegetable curry and freeze it in single portions\n"
+                  "- Bake a tray of frittata or egg muffins for grab-and-go breakfasts\n"
+                  "- Cook a big batch of rice, quinoa or potatoes to use across several meals",
+    'vegan': "- Make a large pot of dhal, bean chilli or vegetable curry and freeze it in single portions\n"
+             "- Bake a few blocks of marinated tofu at once for salads, wraps and stir-fries\n"
+             "- Cook a big batch of rice, quinoa or potatoes to use across several meals",
+}
+
+PORTION_GUIDANCE = {
+    'fat_loss': """### Adjusting Your Portions
+
+- Feeling too hungry? Add more vegetables and a little extra protein before you add carbohydrates or fats
+- Feeling too full? Reduce starchy carbohydrates slightly, but keep protein portions the same to protect your muscle
+- If weight loss stalls for two to three weeks, trim portions by about 10% rather than cutting whole meals
+- Aim to lose around 0.5-1% of your bodyweight per week; faster than that risks losing muscle""",
+
+    'maintenance': """### Adjusting Your Portions
+
+- Feeling too hungry? Add a little extra protein or a piece of fruit as a snack
+- Feeling too full? Reduce starchy carbohydrates slightly and keep protein the same
+- If your weight drifts up or down by more than a kilo or so over a month, adjust portions by about 10%
+- Let your appetite guide small day-to-day changes; what matters is the weekly average""",
+
+    'muscle_gain': """### Adjusting Your Portions
+
+- Struggling to eat everything? Use more calorie-dense foods such as oats, nut butters, olive oil and whole milk
+- Spread food over more meals and snacks rather than forcing very large portions
+- Aim to gain around 0.25-0.5% of your bodyweight per week; faster than that is mostly fat
+- If your weight hasn't moved in two weeks, add roughly 150-200 kcal a day, mostly from carbohydrates""",
+
+    'general_health': """### Adjusting Your Portions
+
+- Feeling too hungry? Add more vegetables, pulses or a little extra protein
+- Feeling too full? Reduce starchy carbohydrates slightly and keep plenty of vegetables
+- Eat slowly and stop when you're comfortably satisfied rather than completely full
+- Let your appetite guide small day-to-day changes; what matters is the overall pattern""",
+}
+
+PROGRESS_SIGNS = {
+    'fat_loss': "- Clothes fitting more loosely, especially around the waist\n"
+                "- Strength holding steady or improving in the gym, a sign you're keeping your muscle\n"
+                "- Better energy, sleep and mood through the day",
+    'maintenance': "- Steady energy through the day without mid-afternoon slumps\n"
+                   "- Weight staying within a comfortable range week to week\n"
+                   "- Better sleep, digestion and mood",
+    'muscle_gain': "- Steady increases in the weights you lift or the reps you manage\n"
+                   "- Clothes fitting more snugly across the shoulders, chest and legs\n"
+                   "- Better recovery between sessions and less soreness",
+    'general_health': "- More consistent energy through the day\n"
+                      "- Better sleep, digestion and mood\n"
+                      "- Feeling more confident and in control of what you eat",
+}
+
+GENERAL_TIPS = """### Hydration
+
+- Aim for around 2-3 litres of fluid a day, more on training days and in hot weather
+- Start the day with a large glass of water and keep a bottle with you
+- Pale yellow urine is a simple sign you're drinking enough
+- Tea and coffee count towards your fluids, but keep caffeine to the morning and early afternoon
+
+### Eating Out & Socialising
+
+- Look at the menu in advance and decide what you'll order before you arrive
+- Choose grilled, baked or steamed dishes and ask for sauces and dressings on the side
+- Build your meal around a good portion of protein and vegetables
+- Enjoy the occasion: one meal out won't undo a week of consistent eating
+
+{portions}
+
+### Signs of Progress Beyond the Scales
+
+{progress}
+
+### Staying Consistent
+
+- Aim for consistency, not perfection: following the plan 80-90% of the time gets results
+- Take progress photos and measurements every two to four weeks, as well as weighing yourself
+- Plan ahead for busy days so you're never caught without a suitable option
+
+### If You Have a Bad Day
+
+- One off-plan meal or day is completely normal and doesn't undo your progress
+- Don't try to make up for it by skipping meals; simply return to the plan at your next meal
+- Think about what led to it, and plan how you'd handle the same situation next time
+- Be kind to yourself: long-term results come from getting back on track, not from never slipping"""
+
+
+def _diet_key(dietary_type):
+    """Map a free-text diet type onto a template key"""
+    diet = (dietary_type or '').lower()
+    for key in ('vegan', 'vegetarian', 'pescatarian'):
+        if key in diet:
+            return key
+    return 'omnivore'
+
+
+def _goal_key(goal):
+    """Map a goal onto a template key"""
+    goal = (goal or '').lower()
+    if 'fat loss' in goal:
+        return 'fat_loss'
+    if 'maintenance' in goal:
+        return 'maintenance'
+    if 'muscle' in goal or 'bulk' in goal:
+        return 'muscle_gain'
+    return 'general_health'
+
+
+def _prep_style_key(meal_prep_style):
+    """Map a meal prep preference onto a template key"""
+    style = (meal_prep_style or '').lower()
+    if 'batch' in style:
+        return 'batch'
+    if 'daily' in style:
+        return 'daily'
+    return 'mixed'
+
+
+def template_key(user_data):
+    """The (goal, diet, prep style) key selecting a client's aftercare template"""
+    return (
+        _goal_key(user_data.get('goal')),
+        _diet_key(user_data.get('dietary_type')),
+        _prep_style_key(user_data.get('meal_prep_style')),
+    )
+
+
+@lru_cache(maxsize=None)
+def _render_template(goal, diet, prep_style):
+    """Render sections 5 and 6 for one template key"""
+    return "\n\n".join([
+        "## 5. MEAL PREP GUIDE",
+        PREP_STRATEGIES[prep_style],
+        STORAGE_GUIDES[diet],
+        "### Batch Cooking Suggestions",
+        BATCH_COOKING_IDEAS[diet],
+        "## 6. ADDITIONAL TIPS & ADVICE",
+        GENERAL_TIPS.format(portions=PORTION_GUIDANCE[goal], progress=PROGRESS_SIGNS[goal]),
+    ])
+
+
+def render_aftercare(user_data):
+    """Return the templated meal prep guide and tips sections for a client"""
+    return _render_template(*template_key(user_data))
+
+
+def merge_aftercare(plan_text, user_data):
+    """
+    Merge the templated aftercare sections into a freshly generated plan
+
+    The model's PERSONAL NOTES (supplements and a personal message) are kept
+    at the end of section 6. Plans that already contain their own meal prep
+    guide are returned unchanged.
+
+    Returns:
+        The complete plan text
+    """
+    if MEAL_PREP_HEADING_PATTERN.search(plan_text):
+        return plan_text
+
+    parts = PERSONAL_NOTES_PATTERN.split(plan_text, maxsplit=1)
+    main = parts[0].rstrip()
+    notes = parts[1].strip() if len(parts) > 1 else ''
+
+    merged = main + "\n\n" + render_aftercare(user_data)
+    if notes:
+        merged += "\n\n" + notes
+    return merged + "\n"
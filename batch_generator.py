@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Batch Nutrition Plan Generator
+Generates plans for a roster of client profiles concurrently, without CLI prompts
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+import instrumentation
+from nutrition_plan_generator import NutritionPlanGenerator, normalise_profile, summarise_usage
+from plan_cache import PlanCache
+from recipe_library import RecipeLibrary
+from request_policy import HedgePolicy, RetryPolicy
+from render_pool import RenderPool
+from shopping_list import load_price_table
+
+DEFAULT_CONCURRENCY = 8
+
+
+def load_profiles(path):
+    """
+    Load client profiles from a JSONL or CSV file
+
+    Each profile uses the same keys as the interactive user_data dict
+    (name, age, gender, height, weight, ideal_weight, budget, ...).
+
+    Returns:
+        List of raw profile dicts, in file order
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            return [dict(row) for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def _run_job(generator, semaphore, index, profile, output_dir, make_pdf, refresh, structured, render_pool):
+    """Generate, save and optionally render a single client's plan"""
+    job = {'index': index, 'name': profile.get('name', f'profile {index + 1}'), 'status': 'failed'}
+    started = time.perf_counter()
+
+    # One span per job, so its API, parse and PDF records share a trace
+    with instrumentation.span('batch_job', index=index) as fields:
+        try:
+            user_data = normalise_profile(profile)
+            async with semaphore:
+                api_started = time.perf_counter()
+                plan, usage = await generator.request_plan_async(user_data, refresh=refresh, structured=structured)
+                job['api_seconds'] = time.perf_counter() - api_started
+
+            job['cached'] = usage is None
+            job['structured'] = isinstance(plan, dict)
+            job.update(summarise_usage(usage))
+
+            # File and PDF work is blocking, so keep it off the event loop
+            job['text_path'] = await asyncio.to_thread(generator.save_plan, plan, user_data, output_dir)
+            if make_pdf:
+                job['pdf_path'] = await asyncio.to_thread(
+                    generator.generate_pdf, plan, user_data, output_dir, render_pool=render_pool
+                )
+            job['status'] = 'ok'
+
+        except Exception as e:
+            job['error'] = str(e)
+            print(f"❌ {job['name']}: {e}")
+        fields['status'] = job['status']
+
+    job['seconds'] = time.perf_counter() - started
+    return job
+
+
+async def run_batch(profiles, concurrency=DEFAULT_CONCURRENCY, output_dir=None, make_pdf=True,
+                    generator=None, refresh=False, structured=False, render_workers=None):
+    """
+    Generate plans for many profiles with at most `concurrency` API calls in flight
+
+    PDFs are laid out by a pool of render_workers processes (by default one
+    per CPU core); with 0, or on a single core, they render in threads here.
+
+    Returns:
+        Dict with a 'jobs' list (one entry per profile) and aggregate throughput figures
+    """
+    if generator is None:
+        generator = NutritionPlanGenerator()
+        generator.setup_api(interactive=False)
+
+    if render_workers is None:
+        render_workers = min(os.cpu_count() or 1, len(profiles))
+    render_pool = RenderPool(render_workers) if make_pdf and render_workers > 1 else None
+
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    try:
+        jobs = await asyncio.gather(*[
+            _run_job(generator, semaphore, index, profile, output_dir, make_pdf, refresh, structured, render_pool)
+            for index, profile in enumerate(profiles)
+        ])
+    finally:
+        if render_pool is not None:
+            render_pool.close()
+    elapsed = time.perf_counter() - started
+
+    succeeded = [job for job in jobs if job['status'] == 'ok']
+    output_tokens = sum(job.get('output_tokens', 0) for job in succeeded)
+    cache_read = sum(job.get('cache_read_input_tokens', 0) for job in jobs)
+    cache_write = sum(job.get('cache_creation_input_tokens', 0) for job in jobs)
+    prompt_tokens = cache_read + cache_write + sum(job.get('input_tokens', 0) for job in jobs)
+    return {
+        'jobs': jobs,
+        'total': len(jobs),
+        'succeeded': len(succeeded),
+        'failed': len(jobs) - len(succeeded),
+        'plan_cache_hits': sum(1 for job in succeeded if job['cached']),
+        'elapsed_seconds': elapsed,
+        'plans_per_minute': len(succeeded) / elapsed * 60 if elapsed else 0.0,
+        'output_tokens': output_tokens,
+        'output_tokens_per_second': output_tokens / elapsed if elapsed else 0.0,
+        'cache_read_input_tokens': cache_read,
+        'cache_creation_input_tokens': cache_write,
+        # Share of all prompt tokens that were served from the prompt cache
+        'cache_hit_rate': cache_read / prompt_tokens if prompt_tokens else 0.0,
+        'hedged_requests': generator.request_runner.hedge.hedges if generator.request_runner.hedge else 0,
+    }
+
+
+def print_report(report):
+    """Print per-job and aggregate throughput for a finished batch"""
+    print("\n" + "=" * 60)
+    print("📊 BATCH REPORT")
+    print("=" * 60)
+    for job in report['jobs']:
+        if job['status'] == 'ok' and job['cached']:
+            print(f"⚡ {job['name']}: reused cached plan, {job['seconds']:.1f}s total")
+        elif job['status'] == 'ok':
+            rate = job['output_tokens'] / job['api_seconds'] if job.get('api_seconds') else 0.0
+            print(f"✅ {job['name']}: {job['seconds']:.1f}s total, "
+                  f"{job['output_tokens']} tokens at {rate:.0f} tok/s, "
+                  f"cache {job['cache_read_input_tokens']} read / {job['cache_creation_input_tokens']} written")
+        else:
+            print(f"❌ {job['name']}: {job.get('error', 'unknown error')}")
+
+    print("-" * 60)
+    print(f"Plans: {report['succeeded']}/{report['total']} succeeded in {report['elapsed_seconds']:.1f}s "
+          f"({report['plan_cache_hits']} from the plan cache)")
+    print(f"Throughput: {report['plans_per_minute']:.1f} plans/min, "
+          f"{report['output_tokens_per_second']:.0f} output tok/s")
+    print(f"Prompt cache: {report['cache_hit_rate']:.0%} of prompt tokens read from cache "
+          f"({report['cache_read_input_tokens']} read, {report['cache_creation_input_tokens']} written)")
+    if report['hedged_requests']:
+        print(f"Hedging: {report['hedged_requests']} slow requests duplicated")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate nutrition plans for a file of client profiles")
+    parser.add_argument('profiles', help="JSONL or CSV file of client profiles")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Maximum API calls in flight (default {DEFAULT_CONCURRENCY})")
+    parser.add_argument('--output-dir', default=None, help="Directory for plan files (default: current directory)")
+    parser.add_argument('--no-pdf', action='store_true', help="Only save text plans")
+    parser.add_argument('--render-workers', type=int, default=None,
+                        help="Processes laying out PDFs (default: one per CPU core, 0 to render in-process)")
+    parser.add_argument('--report', default=None, help="Also write the batch report to this JSON file")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Regenerate even if a cached plan exists for an identical profile")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the local plan cache")
+    parser.add_argument('--structured', action='store_true',
+                        help="Request plans as structured JSON and lay out PDFs from it (text plans as fallback)")
+    parser.add_argument('--no-library', action='store_true',
+                        help="Don't offer known recipes to the model or add new plans' recipes to the library")
+    parser.add_argument('--prices', default=None, metavar='FILE',
+                        help="JSON price table for shopping list costs, mapping items to [£, unit]")
+    parser.add_argument('--metrics', default=None,
+                        help="Append span timings, token usage and page counts to this file as JSON lines")
+    parser.add_argument('--max-retries', type=int, default=4,
+                        help="Retries of a rate-limited, overloaded or failed API request (default 4)")
+    parser.add_argument('--hedge', type=float, default=None, metavar='PERCENTILE',
+                        help="Send a duplicate of any request slower than this latency percentile (e.g. 95)")
+    parser.add_argument('--hedge-max-ratio', type=float, default=0.05,
+                        help="Most requests that may be hedged, as a fraction of all requests (default 0.05)")
+    parser.add_argument('--hedge-max-tokens', type=int, default=None, metavar='TOKENS',
+                        help="Most max_tokens all hedges together may ask for (default: no cap)")
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.add_hook(instrumentation.JsonLinesWriter(args.metrics))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    profiles = load_profiles(args.profiles)
+    print(f"🚀 Generating {len(profiles)} plans with concurrency {args.concurrency}...\n")
+    hedge = HedgePolicy(args.hedge / 100, max_ratio=args.hedge_max_ratio,
+                        max_tokens_budget=args.hedge_max_tokens) if args.hedge else None
+    generator = NutritionPlanGenerator(cache=None if args.no_cache else PlanCache(),
+                                       retry=RetryPolicy(max_retries=args.max_retries), hedge=hedge,
+                                       prices=load_price_table(args.prices) if args.prices else None,
+                                       library=None if args.no_library else RecipeLibrary())
+    generator.setup_api(interactive=False)
+    report = asyncio.run(run_batch(
+        profiles, concurrency=args.concurrency, output_dir=args.output_dir, make_pdf=not args.no_pdf,
+        generator=generator, refresh=args.refresh, structured=args.structured,
+        render_workers=args.render_workers
+    ))
+    print_report(report)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Plan Corpus
+Deterministic generator of realistic and pathological plan texts for the benchmarks
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aftercare_templates import merge_aftercare
+from nutrition_plan_generator import normalise_profile
+
+BENCHMARK_PROFILE = normalise_profile({
+    'name': 'Benchmark Client', 'age': '38', 'gender': 'F', 'height': "5'6\"", 'weight': '72kg',
+    'ideal_weight': '65kg', 'budget': '£70', 'goal': 'Fat loss (maintain muscle)', 'plan_duration': '7',
+})
+
+# Plan shapes, by name, as make_plan arguments
+CORPUS = {
+    '7-day': {'days': 7},
+    '14-day': {'days': 14},
+    '28-day': {'days': 28},
+    '90-day': {'days': 90},
+    'huge-shopping-list': {'days': 7, 'shopping_items': 1500, 'shopping_categories': 1},
+    'many-recipes': {'days': 28, 'recipes': 300},
+    'malformed-markdown': {'days': 14, 'malformed': True},
+}
+
+MEALS = ['Breakfast', 'Lunch', 'Dinner', 'Snack']
+DISHES = {
+    'Breakfast': ['Overnight Oats with Berries', 'Greek Yoghurt Parfait', 'Spinach and Feta Omelette',
+                  'Protein Porridge', 'Smoked Salmon on Rye', 'Banana Protein Pancakes'],
+    'Lunch': ['Chicken and Quinoa Salad', 'Lentil and Vegetable Soup', 'Tuna Nicoise', 'Turkey Wrap',
+              'Halloumi Grain Bowl', 'Prawn Noodle Salad'],
+    'Dinner': ['Chicken Traybake', 'Salmon with Sweet Potato', 'Beef Chilli', 'Chickpea Curry',
+               'Cod with Roasted Vegetables', 'Turkey Meatballs with Courgetti'],
+    'Snack': ['Apple with Peanut Butter', 'Cottage Cheese and Pineapple', 'Protein Shake',
+              'Hummus and Crudites', 'Mixed Nuts'],
+}
+INGREDIENTS = [
+    ('Chicken breast', 'g'), ('Salmon fillet', 'g'), ('Lean beef mince', 'g'), ('Eggs', ''), ('Rolled oats', 'g'),
+    ('Greek yoghurt', 'g'), ('Semi-skimmed milk', 'ml'), ('Spinach', 'g'), ('Courgette', ''), ('Red pepper', ''),
+    ('Sweet potato', 'g'), ('Brown rice', 'g'), ('Quinoa', 'g'), ('Chickpeas', 'g'), ('Red lentils', 'g'),
+    ('Feta', 'g'), ('Olive oil', 'tbsp'), ('Garlic', 'cloves'), ('Blueberries', 'g'), ('Banana', ''),
+]
+CATEGORIES = ['Produce', 'Proteins', 'Dairy', 'Grains & Pantry', 'Frozen', 'Herbs & Spices']
+METHOD_STEPS = [
+    "Preheat the oven to 200°C (180°C fan) and line a tray with baking paper.",
+    "Chop the vegetables into even, bite-sized pieces so they cook at the same rate.",
+    "Season generously, drizzle with the oil and toss to coat.",
+    "Cook for 20-25 minutes, turning halfway, until golden and cooked through.",
+    "Stir everything together, taste and adjust the seasoning.",
+    "Divide between containers and chill for up to 3 days.",
+]
+# Broken markdown as models occasionally produce it: unbalanced emphasis,
+# stray HTML, bare ampersands, tables, deep headings and very long lines
+MALFORMED_LINES = [
+    "**Breakfast: Oats with **honey** & berries <b>unclosed",
+    "- *Lunch:* chicken < 200g & rice > 100g </i>",
+    "#### Tip:: **",
+    "| Meal | kcal |",
+    "|------|------|",
+    "__Dinner__: salmon *with* _herbs_ ** and ** lemon",
+    "* * *",
+    "**",
+    "•\tTabbed bullet with <script>alert(1)</script>",
+    "Snack: " + "nuts and seeds " * 60,
+    "<para>Already marked up</para> & <font color='red'>red</font>",
+    "1) Numbered with a paren **bold *nested* bold**",
+]
+
+
+def _quantity(rng, unit):
+    if unit == 'g':
+        return f"{rng.randrange(50, 1000, 50)}g"
+    if unit == 'ml':
+        return f"{rng.randrange(100, 2000, 100)}ml"
+    if unit:
+        return f"{rng.randint(1, 4)} {unit}"
+    return str(rng.randint(1, 12))
+
+
+def _recipe_names(count):
+    names = [dish for dishes in DISHES.values() for dish in dishes]
+    return [names[i % len(names)] + (f" (Variation {i // len(names)})" if i >= len(names) else '')
+            for i in range(count)]
+
+
+def make_plan(days=7, recipes=None, shopping_items=None, shopping_categories=None, malformed=False, seed=0):
+    """
+    Generate plan text in the layout the prompt asks for, with the templated aftercare sections
+
+    The same arguments always give the same text.
+
+    Args:
+        days: Days in the meal plan
+        recipes: Unique recipes (default: every dish used in the meal plan)
+        shopping_items: Shopping list items (default: about one per ingredient)
+        shopping_categories: Categories the items are split across (default: all of them)
+        malformed: Scatter broken markdown through the plan
+        seed: Seed for the choice of meals and quantities
+
+    Returns:
+        The complete plan text
+    """
+    rng = random.Random(seed)
+    lines = [
+        "## 1. NUTRITIONAL ANALYSIS", "",
+        "Your daily target is **1,850 kcal**, a gentle deficit that protects *muscle* while you lose fat.", "",
+        "- **Protein:** 150g (32%)", "- **Carbohydrates:** 185g (40%)", "- **Fats:** 58g (28%)", "",
+        "Protein stays high because it keeps you full and preserves lean mass as your weight comes down.", "",
+        f"## 2. {days}-DAY MEAL PLAN", "",
+    ]
+
+    used = set()
+    for day in range(1, days + 1):
+        lines.append(f"**DAY {day}:**")
+        for meal in MEALS:
+            dish = rng.choice(DISHES[meal])
+            used.add(dish)
+            lines.append(f"**{meal}:** {dish} - {rng.randrange(150, 700, 10)} kcal, "
+                         f"P {rng.randint(10, 50)}g / C {rng.randint(5, 80)}g / F {rng.randint(3, 30)}g")
+        if malformed:
+            lines.append(rng.choice(MALFORMED_LINES))
+        lines.append("")
+
+    lines += ["## 3. RECIPES", ""]
+    names = _recipe_names(recipes) if recipes else sorted(used)
+    for name in names:
+        # A bold title on its own line lexes as a heading, so give the servings
+        # on the title line, which is what makes the lexer open a recipe card
+        lines.append(f"{name} - Serves {rng.randint(1, 4)}")
+        lines.append(f"Prep time: {rng.randint(5, 20)} min | Cook time: {rng.randint(0, 40)} min")
+        lines.append("Ingredients:")
+        for ingredient, unit in rng.sample(INGREDIENTS, rng.randint(4, 8)):
+            lines.append(f"- {_quantity(rng, unit)} {ingredient.lower()}")
+        lines.append("Method:")
+        for number, step in enumerate(rng.sample(METHOD_STEPS, rng.randint(3, 5)), 1):
+            lines.append(f"{number}. {step}")
+        if malformed:
+            lines.append(rng.choice(MALFORMED_LINES))
+        lines.append(f"Per serving: {rng.randrange(250, 700, 10)} kcal")
+        lines.append("")
+
+    lines += ["## 4. SHOPPING LIST", ""]
+    items = shopping_items or len(INGREDIENTS)
+    per_category = -(-items // (shopping_categories or len(CATEGORIES)))
+    for index in range(items):
+        if index % per_category == 0:
+            if index:
+                lines.append("")
+            lines.append(f"### {CATEGORIES[index // per_category]}")
+        ingredient, unit = INGREDIENTS[index % len(INGREDIENTS)]
+        suffix = f" ({index // len(INGREDIENTS) + 1})" if index >= len(INGREDIENTS) else ''
+        lines.append(f"- {ingredient}{suffix} - {_quantity(rng, unit)}")
+    lines += ["", "**Estimated cost:** £62 per week", "- Buy own-brand staples", "- Freeze bread and berries", ""]
+
+    lines += [
+        "## PERSONAL NOTES", "",
+        "### Supplements", "",
+        "Vitamin D through the winter months is the only supplement you need.", "",
+        "### A Note for You", "",
+        "You have everything you need to make this work. Take it one week at a time.", "",
+    ]
+    return merge_aftercare('\n'.join(lines), BENCHMARK_PROFILE)
+
+
+def build_corpus(names=None, seed=0):
+    """Return {name: plan text} for the named corpus entries (all of them by default)"""
+    return {name: make_plan(seed=seed, **CORPUS[name]) for name in (names or CORPUS)}
+
+
+if __name__ == "__main__":
+    for name, text in build_corpus().items():
+        print(f"{name:<20} {len(text.splitlines()):6} lines {len(text):9,} chars")
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Render Benchmark
+Times each phase of turning plan text into a PDF over the synthetic corpus, and compares against a baseline
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import reportlab
+
+# plan_corpus puts the repository root on sys.path
+from plan_corpus import BENCHMARK_PROFILE, CORPUS, build_corpus
+import plan_ir
+from pdf_generator import NutritionPlanPDF, create_nutrition_plan_pdf, dedicate_process_to_renders
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render_baseline.json')
+
+# How much slower (or hungrier) than the baseline a phase may get before the
+# run fails, as a fraction, and the absolute change below which a difference
+# is treated as noise whatever its fraction. A phase's time has only regressed
+# if both its fastest run and its median run are past the threshold
+DEFAULT_THRESHOLDS = {'seconds': 0.35, 'alloc_peak_kb': 0.15}
+NOISE_FLOORS = {'seconds': 0.015, 'alloc_peak_kb': 64}
+TIME_METRICS = ('seconds', 'median_seconds')
+DEFAULT_REPEAT = 5
+# Fewest phase timings suite_speed will judge the machine's speed from
+MIN_SPEED_SAMPLES = 8
+
+
+def _new_pdf():
+    return NutritionPlanPDF(io.BytesIO(), BENCHMARK_PROFILE['name'])
+
+
+def _lex(text, nodes):
+    return lambda: plan_ir.lex_plan(text)
+
+
+def _sanitize(text, nodes):
+    pdf = _new_pdf()
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    return lambda: [pdf._sanitize_text(line) for line in lines]
+
+
+def _parse(text, nodes):
+    pdf = _new_pdf()
+    return lambda: pdf.parse_and_add_content(text)
+
+
+# Recipe cards and shopping tables go through add_nodes, as in a real build,
+# so markup reportlab rejects falls back to plain text instead of raising
+
+def _recipe_cards(text, nodes):
+    pdf = _new_pdf()
+    recipes = [node for node in nodes if isinstance(node, plan_ir.Recipe)]
+    return lambda: pdf.add_nodes(recipes)
+
+
+def _shopping_tables(text, nodes):
+    pdf = _new_pdf()
+    lists = [node for node in nodes if isinstance(node, plan_ir.ShoppingList)]
+    return lambda: pdf.add_nodes(lists)
+
+
+def _build(text, nodes):
+    # doc.build consumes the story, so every run lays out a freshly parsed one
+    pdf = _new_pdf()
+    pdf.add_cover_page(BENCHMARK_PROFILE)
+    pdf.parse_and_add_content(text)
+    return pdf.build
+
+
+def _end_to_end(text, nodes):
+    def run():
+        stats = {}
+        create_nutrition_plan_pdf(text, BENCHMARK_PROFILE, io.BytesIO(), stats=stats)
+        return stats
+    return run
+
+
+# Each phase prepares a callable (untimed) that runs just that phase (timed)
+PHASES = {
+    'lex': _lex,
+    'sanitize': _sanitize,
+    'parse': _parse,
+    'recipe_cards': _recipe_cards,
+    'shopping_tables': _shopping_tables,
+    'build': _build,
+    'end_to_end': _end_to_end,
+}
+
+
+def _time_run(prepare, text, nodes):
+    """
+    Time one run of a phase
+
+    Returns:
+        Tuple of (seconds, what the run returned)
+    """
+    run = prepare(text, nodes)
+    gc.collect()
+    started = time.perf_counter()
+    output = run()
+    return time.perf_counter() - started, output
+
+
+def _alloc_peak_kb(prepare, text, nodes):
+    """Peak memory (KB) tracemalloc sees allocated during one run of a phase"""
+    run = prepare(text, nodes)
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def run_suite(corpus_names=None, phases=None, repeat=DEFAULT_REPEAT):
+    """
+    Benchmark every phase on every corpus plan
+
+    The timed runs go round the whole suite repeat times (after one untimed
+    warm-up round), rather than repeating each phase back to back, so a spell
+    when the machine is busy slows one run of many measurements instead of
+    every run of a few.
+
+    Returns:
+        Dict with the environment and {corpus name: {phase: measurements}}, plus
+        page count and peak RSS (MB) of the end-to-end build per corpus plan
+    """
+    # Phases run one at a time, so the end-to-end build's peak RSS is its own
+    dedicate_process_to_renders()
+    corpus = {name: (text, plan_ir.lex_plan(text)) for name, text in build_corpus(corpus_names).items()}
+    timings = {(name, phase): [] for name in corpus for phase in phases or PHASES}
+    outputs = {}
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        for round_number in range(repeat + 1):
+            for name, phase in timings:
+                seconds, outputs[(name, phase)] = _time_run(PHASES[phase], *corpus[name])
+                if round_number:
+                    timings[(name, phase)].append(seconds)
+
+        results = {name: {'lines': text.count('\n') + 1} for name, (text, _) in corpus.items()}
+        for (name, phase), runs in timings.items():
+            # The fastest run is the one least disturbed by the rest of the machine;
+            # compare also checks the median, so one lucky run can't hide a regression
+            results[name][phase] = {'seconds': round(min(runs), 6),
+                                    'median_seconds': round(statistics.median(runs), 6),
+                                    'alloc_peak_kb': _alloc_peak_kb(PHASES[phase], *corpus[name])}
+            if phase == 'end_to_end':
+                results[name]['pages'] = outputs[(name, phase)]['pages']
+                results[name]['peak_rss_mb'] = round(outputs[(name, phase)]['peak_rss_mb'], 1)
+    return {
+        'environment': {'python': platform.python_version(), 'reportlab': reportlab.Version,
+                        'machine': platform.machine(), 'repeat': repeat},
+        'results': results,
+    }
+
+
+def suite_speed(report, baseline, metric='seconds'):
+    """
+    How long the suite took relative to the baseline: the median over every phase of metric's ratio
+
+    A machine that is busier (or slower) as a whole moves every phase
+    together, while a regression moves a few, so times are compared after
+    dividing this out. Needs MIN_SPEED_SAMPLES phases to go on; 1.0 otherwise.
+    """
+    ratios = [measured[metric] / expected[metric]
+              for name, phases in report['results'].items()
+              for phase, measured in phases.items()
+              if isinstance(measured, dict)
+              for expected in [baseline['results'].get(name, {}).get(phase)]
+              if expected and expected.get(metric)]
+    return statistics.median(ratios) if len(ratios) >= MIN_SPEED_SAMPLES else 1.0
+
+
+def compare(report, baseline):
+    """
+    Compare a run with the baseline
+
+    Baseline times are scaled by suite_speed first, so only phases that got
+    slower than the rest of the suite count as regressions.
+
+    Returns:
+        List of (corpus, phase, metric, baseline value, current value, regressed) for
+        every measurement the baseline also has
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS, **baseline.get('thresholds', {}))
+    speeds = {metric: suite_speed(report, baseline, metric) for metric in TIME_METRICS}
+    rows = []
+    for name, phases in report['results'].items():
+        for phase, measured in phases.items():
+            expected = baseline['results'].get(name, {}).get(phase)
+            if not isinstance(measured, dict) or not expected:
+                continue
+            for metric, threshold in thresholds.items():
+                if metric not in expected:
+                    continue
+                # Times are checked for the fastest and the median run, each against the suite's speed
+                checked = [m for m in TIME_METRICS if m in expected] if metric == 'seconds' else [metric]
+                regressed = all(
+                    measured[m] > expected[m] * speeds.get(m, 1.0) * (1 + threshold) and
+                    measured[m] - expected[m] * speeds.get(m, 1.0) > NOISE_FLOORS[metric]
+                    for m in checked
+                )
+                rows.append((name, phase, metric, expected[metric], measured[metric], regressed))
+    return rows
+
+
+def print_report(report, rows=None):
+    """Print the suite's timings and, if compared with a baseline, the change in each"""
+    changes = {(name, phase, metric): (before, after, regressed)
+               for name, phase, metric, before, after, regressed in rows or []}
+    print(f"📊 Render benchmark (best of {report['environment']['repeat']}, "
+          f"Python {report['environment']['python']}, reportlab {report['environment']['reportlab']})")
+    for name, phases in report['results'].items():
+        extra = f", {phases['pages']} pages, peak RSS {phases['peak_rss_mb']:.0f} MB" if 'pages' in phases else ''
+        print(f"\n{name} ({phases['lines']} lines{extra})")
+        for phase in PHASES:
+            if phase not in phases:
+                continue
+            cells = []
+            for metric, unit, scale in [('seconds', 'ms', 1000), ('alloc_peak_kb', 'KB', 1)]:
+                cell = f"{phases[phase][metric] * scale:9.1f} {unit}"
+                if (name, phase, metric) in changes:
+                    before, after, regressed = changes[(name, phase, metric)]
+                    change = (after - before) / before if before else 0.0
+                    cell += f" ({change:+6.0%}{' ❌' if regressed else ''})"
+                cells.append(cell)
+            print(f"   {phase:<16} {'   '.join(cells)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plan parsing and PDF rendering on a synthetic corpus")
+    parser.add_argument('--corpus', nargs='+', choices=list(CORPUS), default=None,
+                        help="Corpus plans to run (default: all)")
+    parser.add_argument('--phases', nargs='+', choices=list(PHASES), default=None,
+                        help="Phases to run (default: all)")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f"Timed runs per phase (default {DEFAULT_REPEAT})")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Baseline JSON to compare with")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="Save this run as the new baseline instead of comparing")
+    parser.add_argument('--json', default=None, help="Also write the full report to this JSON file")
+    args = parser.parse_args()
+
+    report = run_suite(args.corpus, args.phases, args.repeat)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        thresholds = DEFAULT_THRESHOLDS
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                thresholds = json.load(f).get('thresholds', thresholds)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(report, thresholds=thresholds), f, indent=2)
+            f.write('\n')
+        print_report(report)
+        print(f"\n✅ Baseline saved to: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print_report(report)
+        print(f"\n⚠️  No baseline at {args.baseline} (run with --update-baseline to create one)")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(report, baseline)
+    print_report(report, rows)
+    speed = suite_speed(report, baseline)
+    if speed > 1 + DEFAULT_THRESHOLDS['seconds']:
+        print(f"\n⚠️  The whole suite ran {speed:.2f}x the baseline's time. Phases are compared with that "
+              f"factor taken out, so check on a quiet machine in case everything got slower")
+    regressions = [row for row in rows if row[-1]]
+    if regressions:
+        print(f"\n❌ {len(regressions)} measurements regressed beyond the baseline thresholds")
+        return 1
+    print("\n✅ No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
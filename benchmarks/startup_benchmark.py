@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Startup Benchmark
+Measures cold import time of the command-line entry points, and fails if they regress
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry points, with the most time (ms) each may take to import in a fresh
+# interpreter before the benchmark fails
+IMPORT_BUDGETS_MS = {
+    'nutrition_plan_generator': 250,
+    'batch_generator': 300,
+    'nutrition_cli': 250,
+}
+
+# Loaded on first use only; importing any entry point must not pull these in
+DEFERRED_MODULES = ['anthropic', 'reportlab']
+
+# Runs in a fresh interpreter for each sample
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{'import_ms': elapsed * 1000,
+                  'loaded': [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+
+def _sample(module):
+    """Import module in a new interpreter, returning its import time, wall time and any deferred modules loaded"""
+    started = time.perf_counter()
+    probe = _PROBE.format(module=module, deferred=DEFERRED_MODULES)
+    output = subprocess.run([sys.executable, '-c', probe], cwd=REPO_ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output)
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def run_benchmark(runs=5):
+    """
+    Time cold imports of each entry point
+
+    Each sample is a new interpreter, so nothing is already imported
+    (compiled bytecode in __pycache__ is still used, as it is in production).
+
+    Returns:
+        Dict with the bare interpreter's wall time and, per module, the median
+        import and process times in ms and the deferred modules it loaded
+    """
+    baseline = statistics.median(_sample('os')['process_ms'] for _ in range(runs))
+    report = {'runs': runs, 'python': sys.version.split()[0], 'interpreter_ms': baseline, 'modules': {}}
+    for module in IMPORT_BUDGETS_MS:
+        samples = [_sample(module) for _ in range(runs)]
+        report['modules'][module] = {
+            'import_ms': statistics.median(sample['import_ms'] for sample in samples),
+            'process_ms': statistics.median(sample['process_ms'] for sample in samples),
+            'budget_ms': IMPORT_BUDGETS_MS[module],
+            'deferred_loaded': sorted({name for sample in samples for name in sample['loaded']}),
+        }
+    return report
+
+
+def check_report(report):
+    """Return the budget and deferred-import failures in a benchmark report"""
+    failures = []
+    for module, result in report['modules'].items():
+        if result['import_ms'] > result['budget_ms']:
+            failures.append(f"{module} took {result['import_ms']:.0f} ms to import "
+                            f"(budget {result['budget_ms']} ms)")
+        if result['deferred_loaded']:
+            failures.append(f"{module} imports {', '.join(result['deferred_loaded'])} at load time")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import time of the CLI entry points")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per module (default 5)")
+    parser.add_argument('--json', default=None, help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.runs)
+    print(f"⏱️  Cold imports, median of {args.runs} runs (bare interpreter {report['interpreter_ms']:.0f} ms)")
+    for module, result in report['modules'].items():
+        print(f"   {module:<26} {result['import_ms']:6.0f} ms import, "
+              f"{result['process_ms']:6.0f} ms process (budget {result['budget_ms']} ms)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failures = check_report(report)
+    for failure in failures:
+        print(f"❌ {failure}")
+    if not failures:
+        print("✅ Startup within budget")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Table Benchmark
+Times laying out shopping lists of growing length as the plan's LongTable and as a plain reportlab Table
+"""
+
+import argparse
+import gc
+import io
+import random
+import statistics
+import sys
+import time
+
+# plan_corpus puts the repository root on sys.path
+from plan_corpus import BENCHMARK_PROFILE, INGREDIENTS, _quantity
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Table
+from pdf_generator import SHOPPING_COLUMN_WIDTHS, NutritionPlanPDF
+
+DEFAULT_SIZES = [30, 100, 300, 1000, 3000]
+
+
+def make_items(count, seed=0):
+    """count shopping list lines ("- Item - quantity"), some with names too long for one line"""
+    rng = random.Random(seed)
+    items = []
+    for index in range(count):
+        name, unit = INGREDIENTS[index % len(INGREDIENTS)]
+        if index % 7 == 0:
+            name += ", ideally organic and from the chilled aisle, or frozen if fresh isn't available"
+        items.append(f"- {name} - {_quantity(rng, unit)}")
+    return items
+
+
+def _plan_table(items):
+    """The plan's shopping table: a LongTable repeating its header, with wrapped cells"""
+    return NutritionPlanPDF(io.BytesIO(), BENCHMARK_PROFILE['name'])._create_shopping_table(items)
+
+
+def _plain_table(items):
+    """The same rows as one plain Table, which measures every remaining row again at each page split"""
+    pdf = NutritionPlanPDF(io.BytesIO(), BENCHMARK_PROFILE['name'])
+    table = pdf._create_shopping_table(items)
+    plain = Table(table._cellvalues, colWidths=SHOPPING_COLUMN_WIDTHS, repeatRows=1)
+    plain.setStyle(pdf.context.shopping_table_style)
+    return plain
+
+
+TABLES = {'longtable': _plan_table, 'table': _plain_table}
+
+
+def _layout(make_table, items):
+    """Seconds to lay out and write the table on its own, and the pages it took"""
+    output = io.BytesIO()
+    doc = SimpleDocTemplate(output, pagesize=letter)
+    story = [make_table(items)]
+    gc.collect()
+    started = time.perf_counter()
+    doc.build(story)
+    return time.perf_counter() - started, doc.page
+
+
+def run_benchmark(sizes=None, repeat=3):
+    """
+    Lay out each table kind at each list length
+
+    Returns:
+        Dict of {rows: {kind: {'seconds', 'ms_per_row', 'pages'}}}, using the fastest of repeat runs
+    """
+    results = {}
+    for count in sizes or DEFAULT_SIZES:
+        items = make_items(count)
+        results[count] = {}
+        for kind, make_table in TABLES.items():
+            runs = [_layout(make_table, items) for _ in range(repeat)]
+            seconds = min(run[0] for run in runs)
+            results[count][kind] = {'seconds': seconds, 'median_seconds': statistics.median(run[0] for run in runs),
+                                    'ms_per_row': seconds * 1000 / count, 'pages': runs[0][1]}
+    return results
+
+
+def print_report(results):
+    """Print each length's layout time per table kind, and how much faster the LongTable was"""
+    print("📊 Shopping table layout (best of runs)")
+    print(f"   {'rows':>6}  {'pages':>5}  {'LongTable':>12}  {'Table':>12}  {'speed-up':>8}")
+    for count, kinds in results.items():
+        long_table, table = kinds['longtable'], kinds['table']
+        print(f"   {count:>6}  {long_table['pages']:>5}  {long_table['seconds'] * 1000:9.1f} ms  "
+              f"{table['seconds'] * 1000:9.1f} ms  {table['seconds'] / long_table['seconds']:7.1f}×")
+    per_row = [kinds['longtable']['ms_per_row'] for kinds in results.values()]
+    print(f"\n   LongTable cost per row: {min(per_row):.3f}-{max(per_row):.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shopping list table layout against list length")
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                        help=f"Shopping list lengths to lay out (default: {' '.join(map(str, DEFAULT_SIZES))})")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per length and table (default 3)")
+    args = parser.parse_args()
+    print_report(run_benchmark(args.sizes, args.repeat))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Build Symbol Font
+Cuts fonts/PlanSymbols.ttf, the PDF's symbol font, out of DejaVu Sans: only the glyphs in SYMBOL_CHARACTERS
+"""
+
+import argparse
+import os
+import sys
+from struct import pack, unpack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reportlab.pdfbase.ttfonts import TTFontFile, TTFontMaker
+from pdf_generator import SYMBOL_CHARACTERS, SYMBOL_FONT, SYMBOL_FONT_PATH
+
+DEFAULT_SOURCE = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+# Composite glyph flags (see the TrueType 'glyf' table)
+ARG_1_AND_2_ARE_WORDS = 0x0001
+WE_HAVE_A_SCALE = 0x0008
+MORE_COMPONENTS = 0x0020
+WE_HAVE_AN_X_AND_Y_SCALE = 0x0040
+WE_HAVE_A_TWO_BY_TWO = 0x0080
+# Name table entries kept from the source font: copyright and version. Like other
+# subsetters this leaves out the licence text (it is in fonts/LICENSE), which
+# would otherwise be most of the font embedded in every PDF
+KEPT_NAME_IDS = (0, 5)
+
+
+def _component_offsets(data):
+    """Offsets of the glyph index of each component in a composite glyph's data"""
+    position, flags = 10, MORE_COMPONENTS
+    while flags & MORE_COMPONENTS:
+        flags = unpack('>H', data[position:position + 2])[0]
+        yield position + 2
+        position += 4 + (4 if flags & ARG_1_AND_2_ARE_WORDS else 2)
+        if flags & WE_HAVE_A_SCALE:
+            position += 2
+        elif flags & WE_HAVE_AN_X_AND_Y_SCALE:
+            position += 4
+        elif flags & WE_HAVE_A_TWO_BY_TWO:
+            position += 8
+
+
+def _cmap(code_to_glyph):
+    """Windows Unicode (3, 1) format 4 cmap with one segment per character"""
+    codes = sorted(code_to_glyph) + [0xFFFF]
+    deltas = [(code_to_glyph[code] - code) % 0x10000 for code in codes[:-1]] + [1]
+    segments = len(codes)
+    search_range = 2 ** (segments.bit_length() - 1) * 2
+    subtable = pack('>7H', 4, 16 + segments * 8, 0, segments * 2, search_range,
+                    segments.bit_length() - 1, segments * 2 - search_range)
+    subtable += pack(f'>{segments}H', *codes) + b'\0\0' + pack(f'>{segments}H', *codes)
+    subtable += pack(f'>{segments}H', *deltas) + pack(f'>{segments}H', *[0] * segments)
+    return pack('>HHHHL', 0, 1, 3, 1, 12) + subtable
+
+
+def _name(source, family):
+    """Name table renaming the font to family (the licence forbids modified fonts keeping the Vera name)"""
+    table = source.get_table('name')
+    count, string_offset = unpack('>HH', table[2:6])
+    records = {}
+    for index in range(count):
+        platform, encoding, language, name_id, length, offset = unpack('>6H', table[6 + index * 12:18 + index * 12])
+        if (platform, encoding, language) == (3, 1, 0x409) and name_id in KEPT_NAME_IDS:
+            records[name_id] = table[string_offset + offset:string_offset + offset + length]
+    for name_id, value in {1: family, 2: 'Book', 3: family, 4: family, 6: family}.items():
+        records[name_id] = value.encode('utf-16-be')
+
+    header, strings = [], b''
+    for name_id, value in sorted(records.items()):
+        header.append(pack('>6H', 3, 1, 0x409, name_id, len(value), len(strings)))
+        strings += value
+    return pack('>HHH', 0, len(records), 6 + 12 * len(records)) + b''.join(header) + strings
+
+
+def build_font(source_path, characters, family=SYMBOL_FONT):
+    """
+    TrueType font holding only characters' glyphs (and the glyphs they are built from) from source_path
+
+    Returns:
+        The font file's bytes
+    """
+    source = TTFontFile(source_path)
+    glyph_map = [0]
+    glyph_set = {0: 0}
+    code_to_glyph = {}
+    for code in sorted(set(map(ord, characters)) | {32}):
+        if code not in source.charToGlyph:
+            raise ValueError(f"{source_path} has no glyph for U+{code:04X}")
+        original = source.charToGlyph[code]
+        if original not in glyph_set:
+            glyph_set[original] = len(glyph_map)
+            glyph_map.append(original)
+        code_to_glyph[code] = glyph_set[original]
+
+    glyph_data = source.get_table('glyf')
+
+    def original_glyph(index):
+        return glyph_data[source.glyphPos[index]:source.glyphPos[index + 1]]
+
+    # Composite glyphs need the glyphs they are made of too
+    index = 0
+    while index < len(glyph_map):
+        data = original_glyph(glyph_map[index])
+        index += 1
+        if len(data) > 2 and unpack('>h', data[:2])[0] < 0:
+            for offset in _component_offsets(data):
+                component = unpack('>H', data[offset:offset + 2])[0]
+                if component not in glyph_set:
+                    glyph_set[component] = len(glyph_map)
+                    glyph_map.append(component)
+
+    output = TTFontMaker()
+    for tag in ('OS/2', 'cvt ', 'fpgm', 'prep'):
+        try:
+            output.add(tag, source.get_table(tag))
+        except KeyError:
+            pass
+    output.add('name', _name(source, family))
+    # Version 3: no glyph names
+    output.add('post', b'\x00\x03\x00\x00' + source.get_table('post')[4:16] + b'\0' * 16)
+    output.add('cmap', _cmap(code_to_glyph))
+
+    glyphs, offsets = [], [0]
+    for original in glyph_map:
+        data = original_glyph(original)
+        if len(data) > 2 and unpack('>h', data[:2])[0] < 0:
+            for offset in _component_offsets(data):
+                component = glyph_set[unpack('>H', data[offset:offset + 2])[0]]
+                data = data[:offset] + pack('>H', component) + data[offset + 2:]
+        data += b'\0' * (-len(data) % 4)
+        glyphs.append(data)
+        offsets.append(offsets[-1] + len(data))
+    output.add('glyf', b''.join(glyphs))
+    output.add('loca', pack(f'>{len(offsets)}L', *offsets))
+
+    metrics = [value for original in glyph_map for value in source.hmetrics[original]]
+    output.add('hmtx', pack(f'>{len(metrics)}H', *(int(value) % 0x10000 for value in metrics)))
+    hhea = source.get_table('hhea')
+    output.add('hhea', hhea[:34] + pack('>H', len(glyph_map)) + hhea[36:])
+    maxp = source.get_table('maxp')
+    output.add('maxp', maxp[:4] + pack('>H', len(glyph_map)) + maxp[6:])
+    head = source.get_table('head')
+    # Long (32-bit) loca offsets
+    output.add('head', head[:50] + pack('>H', 1) + head[52:])
+    return output.makeStream()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the PDF's symbol font from DejaVu Sans")
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help=f"DejaVu Sans TTF to cut it from ({DEFAULT_SOURCE})")
+    parser.add_argument('--output', default=SYMBOL_FONT_PATH, help="Where to write the font (default: fonts/)")
+    args = parser.parse_args()
+    data = build_font(args.source, SYMBOL_CHARACTERS)
+    with open(args.output, 'wb') as f:
+        f.write(data)
+    print(f"✅ {len(SYMBOL_CHARACTERS)} symbols, {len(data) / 1024:.1f} KB written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Instrumentation
+Span timings and metrics records for plan generation and rendering, delivered to pluggable hooks
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+# Callables taking one record dict; nothing is recorded while there are none
+_hooks = []
+
+# Groups the records of one plan: set by the outermost span, inherited by
+# nested spans and by asyncio tasks started inside it
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+
+
+def add_hook(hook):
+    """Send every record to hook, a callable taking the record dict"""
+    _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """Stop sending records to hook"""
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def emit(event, **fields):
+    """
+    Deliver a record to every hook
+
+    Records are flat dicts with 'event', 'ts' (Unix time) and 'trace' keys
+    plus the given fields. A failing hook is reported and skipped, so
+    metrics can never break a plan.
+    """
+    if not _hooks:
+        return
+    record = {'event': event, 'ts': round(time.time(), 3), 'trace': _trace_id.get()}
+    record.update(fields)
+    for hook in list(_hooks):
+        try:
+            hook(record)
+        except Exception as e:
+            print(f"⚠️  Metrics hook failed: {e}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """
+    Time a block and emit it as a 'span' record
+
+    Yields the record's fields, so the block can add to them (token counts,
+    page counts, ...). An exception is recorded in 'error' and re-raised.
+    """
+    token = _trace_id.set(uuid.uuid4().hex[:12]) if _trace_id.get() is None else None
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = type(e).__name__
+        raise
+    finally:
+        emit('span', name=name, seconds=round(time.perf_counter() - started, 4), **fields)
+        if token is not None:
+            _trace_id.reset(token)
+
+
+class JsonLinesWriter:
+    """Metrics hook writing each record as one line of JSON to a path (appending) or a text stream"""
+
+    def __init__(self, target):
+        self._stream = open(target, 'a') if isinstance(target, str) else target
+        self._owned = isinstance(target, str)
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._stream.write(line + '\n')
+            self._stream.flush()
+
+    def close(self):
+        if self._owned:
+            self._stream.close()
+
+
+@contextlib.contextmanager
+def profiled(path=None, limit=25):
+    """
+    Run a block under cProfile
+
+    The slowest functions by cumulative time are printed to stderr, and the
+    full stats saved to path (if given) for pstats or snakeviz.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(limit)
+        print(report.getvalue(), file=sys.stderr)
+        if path:
+            print(f"📈 Profile saved to: {path}", file=sys.stderr)
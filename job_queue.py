@@ -0,0 +1,202 @@
+"""
+Job Queue
+Durable SQLite queue of plan jobs for the resident worker, with priority lanes and leases
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+DEFAULT_QUEUE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nutrition_plans', 'jobs.sqlite3')
+# Lanes in the order their jobs are taken: a queued paid-tier job always goes before any standard one
+LANES = ('paid', 'standard', 'bulk')
+DEFAULT_LANE = 'standard'
+# A claimed job is taken back for another worker if its lease isn't renewed in this long
+DEFAULT_LEASE_SECONDS = 120
+DEFAULT_MAX_ATTEMPTS = 3
+JOB_FIELDS = ('job_id', 'lane', 'status', 'attempts', 'profile', 'output_dir', 'make_pdf', 'structured', 'refresh',
+              'worker', 'claim', 'text_path', 'pdf_path', 'result', 'error', 'created_at', 'started_at', 'finished_at')
+
+
+def _job(row):
+    """A jobs row as a dict, with its JSON and flag columns decoded"""
+    job = dict(zip(JOB_FIELDS, row))
+    job['profile'] = json.loads(job['profile'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    for flag in ('make_pdf', 'structured', 'refresh'):
+        job[flag] = bool(job[flag])
+    return job
+
+
+class JobQueue:
+    """
+    SQLite queue of plan jobs, shared by any number of worker processes
+
+    A job is 'queued' until a worker claims it, 'running' while the worker
+    holds its lease, then 'ok' or 'failed'. A worker that stops without
+    finishing a job (crash, kill -9) stops renewing its lease, so the job is
+    claimed again once the lease runs out; after max_attempts claims it fails.
+
+    Each claim gets its own token, and only the holder of a job's current
+    claim can renew, finish, requeue or release it: a worker (or one slot of
+    a worker) whose lease ran out can't overwrite whoever claimed the job next.
+    """
+
+    def __init__(self, path=DEFAULT_QUEUE_PATH, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Threads in this process share one connection; other processes are kept
+        # in step by SQLite's own locking (claims take the write lock up front)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id INTEGER PRIMARY KEY, lane TEXT NOT NULL, priority INTEGER NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, profile TEXT NOT NULL, "
+                "output_dir TEXT, make_pdf INTEGER NOT NULL, structured INTEGER NOT NULL, refresh INTEGER NOT NULL, "
+                "worker TEXT, claim TEXT, lease_until REAL, text_path TEXT, pdf_path TEXT, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            # Queues created before claims had their own token
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+            if 'claim' not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN claim TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, job_id)")
+
+    def enqueue(self, profile, lane=DEFAULT_LANE, output_dir=None, make_pdf=True, structured=False, refresh=False):
+        """
+        Add a job for one (normalised) client profile
+
+        Returns:
+            The new job's id
+        """
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane {lane!r} (expected one of {', '.join(LANES)})")
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (lane, priority, profile, output_dir, make_pdf, structured, refresh, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (lane, LANES.index(lane), json.dumps(profile), output_dir, int(make_pdf), int(structured),
+                 int(refresh), time.time())
+            )
+        return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        Take the next job for worker: the oldest in the highest lane, or one whose lease has run out
+
+        Returns:
+            The job as a dict (see get), or None if nothing is waiting. Its 'claim'
+            token is what renew, finish, retry and release take
+        """
+        now = time.time()
+        with self._lock:
+            # Take the write lock before reading, so two processes can't claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, "
+                    "error = 'worker stopped while running the job ' || attempts || ' times' "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now, self.max_attempts)
+                )
+                row = self._conn.execute(
+                    "SELECT job_id FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                    "ORDER BY priority, job_id LIMIT 1", (now,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, claim = ?, "
+                        "lease_until = ?, started_at = ? WHERE job_id = ?",
+                        (worker, uuid.uuid4().hex, now + self.lease_seconds, now, row[0])
+                    )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return self.get(row[0]) if row else None
+
+    def renew(self, claims):
+        """Extend the leases of the claims (tokens from claim) whose jobs are still running"""
+        if not claims:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE claim = ? AND status = 'running'",
+                [(time.time() + self.lease_seconds, claim) for claim in claims]
+            )
+
+    def finish(self, job_id, claim, status, text_path=None, pdf_path=None, result=None, error=None):
+        """
+        Record a job's outcome ('ok' or 'failed'), its files and a JSON-able result summary
+
+        Only the current claim is updated: a worker whose lease ran out (and
+        whose job may have been claimed again) changes nothing.
+
+        Returns:
+            True if the outcome was recorded, False if claim no longer held the job
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, text_path = ?, pdf_path = ?, result = ?, error = ?, finished_at = ?, "
+                "lease_until = NULL WHERE job_id = ? AND claim = ? AND status = 'running'",
+                (status, text_path, pdf_path, json.dumps(result) if result is not None else None, error,
+                 time.time(), job_id, claim)
+            )
+        return cursor.rowcount > 0
+
+    def retry(self, job_id, claim, error):
+        """
+        Put a claimed job that failed back in its lane, or fail it for good once it has had max_attempts
+
+        Returns:
+            True if the job was updated, False if claim no longer held it (see finish)
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = ?, "
+                "lease_until = NULL, finished_at = CASE WHEN attempts >= ? THEN ? END "
+                "WHERE job_id = ? AND claim = ? AND status = 'running'",
+                (self.max_attempts, error, self.max_attempts, time.time(), job_id, claim)
+            )
+        return cursor.rowcount > 0
+
+    def release(self, job_id, claim):
+        """Hand back a claimed job given up without running to the end (it doesn't count as an attempt)"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), worker = NULL, claim = NULL, "
+                "lease_until = NULL WHERE job_id = ? AND claim = ? AND status = 'running'", (job_id, claim)
+            )
+
+    def get(self, job_id):
+        """Return a job as a dict of JOB_FIELDS, or None if it isn't known"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return _job(row) if row else None
+
+    def counts(self):
+        """Return {lane: {status: job count}}"""
+        with self._lock:
+            rows = self._conn.execute("SELECT lane, status, COUNT(*) FROM jobs GROUP BY lane, status").fetchall()
+        counts = {}
+        for lane, status, count in rows:
+            counts.setdefault(lane, {})[status] = count
+        return counts
+
+    def waiting(self):
+        """Number of jobs queued in any lane"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,325 @@
+"""
+Macro Engine
+Daily calorie and macro targets calculated from the client profile, and checks of a plan's meals against them
+"""
+
+import re
+from collections import namedtuple
+from plan_ir import MARKUP_CHARS
+
+# Daily targets for a client. bmr and tdee (maintenance calories) are kcal too.
+MacroTargets = namedtuple('MacroTargets', ['calories', 'protein_g', 'carbs_g', 'fat_g', 'bmr', 'tdee'])
+# A day whose meals add up to more than the tolerance away from the targets.
+# off maps each macro out of tolerance to its deviation, e.g. {'calories': 0.18}
+OffTargetDay = namedtuple('OffTargetDay', ['day', 'calories', 'protein_g', 'carbs_g', 'fat_g', 'off'])
+# The result of checking a plan: days that had meal macros to check, and those off target
+MacroReport = namedtuple('MacroReport', ['days_checked', 'off_target'])
+
+MACROS = ['calories', 'protein_g', 'carbs_g', 'fat_g']
+MACRO_LABELS = {'calories': 'calories', 'protein_g': 'protein', 'carbs_g': 'carbs', 'fat_g': 'fat'}
+# How far a day's total may stray from each target before the day is flagged
+DEFAULT_TOLERANCES = {'calories': 0.10, 'protein_g': 0.10, 'carbs_g': 0.20, 'fat_g': 0.20}
+
+KG_PER_LB = 0.45359237
+CM_PER_INCH = 2.54
+LB_PER_STONE = 14
+
+ACTIVITY_MULTIPLIERS = {
+    'sedentary': 1.2,
+    'lightly active': 1.375,
+    'moderately active': 1.55,
+    'very active': 1.725,
+    'extra active': 1.9,
+}
+# Daily calories never go below these, whatever the deficit
+MIN_CALORIES = {'M': 1500, 'F': 1200}
+# Protein in g per kg of reference bodyweight, by goal
+PROTEIN_PER_KG = {'loss': 2.0, 'gain': 1.8, 'maintain': 1.6}
+FAT_SHARE = 0.25
+MIN_FAT_PER_KG = 0.6
+
+FEET_INCHES_PATTERN = re.compile(
+    r'(\d+(?:\.\d+)?)\s*(?:\'|’|ft|feet|foot)\s*(?:(\d+(?:\.\d+)?)\s*(?:"|”|\'\'|in|inch|inches)?)?', re.IGNORECASE
+)
+CM_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:cm|centimet(?:re|er)s?)\b', re.IGNORECASE)
+METRES_PATTERN = re.compile(r'(\d(?:\.\d+)?)\s*(?:m|metres?|meters?)\b', re.IGNORECASE)
+INCHES_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:"|”|in|inch|inches)\b', re.IGNORECASE)
+STONE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:st|stones?)\b\s*(?:(\d+(?:\.\d+)?)\s*(?:lbs?|pounds?)?)?',
+                           re.IGNORECASE)
+POUNDS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:lbs?|pounds?)\b', re.IGNORECASE)
+KG_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:kgs?|kilos?|kilograms?)\b', re.IGNORECASE)
+BARE_NUMBER_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*$')
+
+# Per-meal macros as plans write them: "450 kcal, P 30g / C 45g / F 12g",
+# "Protein: 30g", "30g protein" and the like. Found in one pass over a line.
+MACRO_MENTION_PATTERN = re.compile(
+    r'(?:\b(?P<before>protein|carb(?:ohydrate)?s?|fats?|P|C|F)\s*:?\s*)?(?P<number>\d[\d,]*(?:\.\d+)?)\s*'
+    r'(?P<unit>kcal|calories|cals?|g)\b(?:\s*(?:of\s+)?(?P<after>protein|carb(?:ohydrate)?s?|fats?)\b)?',
+    re.IGNORECASE
+)
+MACRO_COLUMNS = {'p': 1, 'c': 2, 'f': 3}
+DAY_PATTERN = re.compile(r'^\W*DAY\s*(\d+)\b', re.IGNORECASE)
+# Lines that sum up a day rather than describe a meal, so aren't added in again
+TOTAL_LINE_PATTERN = re.compile(r'\b(?:total|daily|target)', re.IGNORECASE)
+
+
+def _float(text):
+    return float(text.replace(',', ''))
+
+
+def parse_height(text):
+    """
+    Height in cm from free text: 5'10", 5ft 10in, 178cm, 1.78m or 70in
+
+    A bare number is taken as cm (or metres if under 3). Raises ValueError
+    if the height can't be read or isn't plausible.
+    """
+    text = str(text).strip()
+    match = CM_PATTERN.search(text)
+    if match:
+        cm = _float(match.group(1))
+    elif FEET_INCHES_PATTERN.search(text):
+        match = FEET_INCHES_PATTERN.search(text)
+        cm = (_float(match.group(1)) * 12 + _float(match.group(2) or '0')) * CM_PER_INCH
+    elif METRES_PATTERN.search(text):
+        cm = _float(METRES_PATTERN.search(text).group(1)) * 100
+    elif INCHES_PATTERN.search(text):
+        cm = _float(INCHES_PATTERN.search(text).group(1)) * CM_PER_INCH
+    elif BARE_NUMBER_PATTERN.match(text):
+        value = _float(BARE_NUMBER_PATTERN.match(text).group(1))
+        cm = value * 100 if value < 3 else value
+    else:
+        raise ValueError(f"Can't read height {text!r}")
+    if not 100 <= cm <= 250:
+        raise ValueError(f"Height {text!r} is outside 100-250cm")
+    return cm
+
+
+def parse_weight(text):
+    """
+    Weight in kg from free text: 165lbs, 75kg, 11st 4lb or 11 stone
+
+    A bare number is taken as kg. Raises ValueError if the weight can't be
+    read or isn't plausible.
+    """
+    text = str(text).strip()
+    if STONE_PATTERN.search(text):
+        match = STONE_PATTERN.search(text)
+        kg = (_float(match.group(1)) * LB_PER_STONE + _float(match.group(2) or '0')) * KG_PER_LB
+    elif POUNDS_PATTERN.search(text):
+        kg = _float(POUNDS_PATTERN.search(text).group(1)) * KG_PER_LB
+    elif KG_PATTERN.search(text):
+        kg = _float(KG_PATTERN.search(text).group(1))
+    elif BARE_NUMBER_PATTERN.match(text):
+        kg = _float(BARE_NUMBER_PATTERN.match(text).group(1))
+    else:
+        raise ValueError(f"Can't read weight {text!r}")
+    if not 30 <= kg <= 350:
+        raise ValueError(f"Weight {text!r} is outside 30-350kg")
+    return kg
+
+
+def _goal_direction(goal, weight, ideal_weight):
+    """'loss', 'gain' or 'maintain', from the stated goal or, failing that, the ideal weight"""
+    goal = goal.lower()
+    if 'loss' in goal or 'lose' in goal or 'cut' in goal:
+        return 'loss'
+    if 'gain' in goal or 'bulk' in goal:
+        return 'gain'
+    if 'maintenance' in goal or 'maintain' in goal or ideal_weight is None:
+        return 'maintain'
+    if ideal_weight < weight * 0.97:
+        return 'loss'
+    if ideal_weight > weight * 1.03:
+        return 'gain'
+    return 'maintain'
+
+
+def compute_targets(user_data):
+    """
+    Calculate a client's daily calorie and macro targets
+
+    BMR is from the Mifflin-St Jeor equation and maintenance calories (TDEE)
+    from the activity level. Fat loss is a 20% deficit (10% for a general
+    goal with a lower ideal weight), never below MIN_CALORIES; muscle gain
+    a 10% (5%) surplus. Protein is per kg of the lower of current and ideal
+    weight, fat a quarter of calories and carbohydrates the rest.
+
+    Raises:
+        ValueError: if the age, height or weight can't be read
+    """
+    weight = parse_weight(user_data['weight'])
+    height = parse_height(user_data['height'])
+    age = re.search(r'\d+', str(user_data['age']))
+    if age is None:
+        raise ValueError(f"Can't read age {user_data['age']!r}")
+    age = int(age.group())
+    try:
+        ideal_weight = parse_weight(user_data.get('ideal_weight', ''))
+    except ValueError:
+        ideal_weight = None
+
+    gender = str(user_data.get('gender', '')).upper()
+    bmr = 10 * weight + 6.25 * height - 5 * age + (5 if gender == 'M' else -161)
+    activity = str(user_data.get('activity_level', '')).lower()
+    tdee = bmr * next((factor for level, factor in ACTIVITY_MULTIPLIERS.items() if level in activity), 1.55)
+
+    goal = str(user_data.get('goal', ''))
+    direction = _goal_direction(goal, weight, ideal_weight)
+    explicit = direction == _goal_direction(goal, weight, None)
+    adjustment = {'loss': -0.20 if explicit else -0.10, 'gain': 0.10 if explicit else 0.05, 'maintain': 0.0}
+    calories = max(tdee * (1 + adjustment[direction]), MIN_CALORIES.get(gender, 1200))
+    calories = round(calories / 10) * 10
+
+    reference_weight = min(weight, ideal_weight) if ideal_weight else weight
+    protein = round(PROTEIN_PER_KG[direction] * reference_weight)
+    fat = round(max(calories * FAT_SHARE / 9, MIN_FAT_PER_KG * reference_weight))
+    carbs = max(0, round((calories - protein * 4 - fat * 9) / 4))
+    return MacroTargets(calories, protein, carbs, fat, round(bmr), round(tdee))
+
+
+def format_targets(targets):
+    """The targets as a block for the client's prompt"""
+    share = {key: grams * factor / targets.calories * 100 for key, grams, factor in
+             [('protein', targets.protein_g, 4), ('carbs', targets.carbs_g, 4), ('fat', targets.fat_g, 9)]}
+    return f"""DAILY TARGETS (calculated from the profile - plan to these exactly, don't recalculate them):
+- Calories: {targets.calories:,} kcal (BMR {targets.bmr:,} kcal, maintenance {targets.tdee:,} kcal)
+- Protein: {targets.protein_g}g ({share['protein']:.0f}%)
+- Carbohydrates: {targets.carbs_g}g ({share['carbs']:.0f}%)
+- Fats: {targets.fat_g}g ({share['fat']:.0f}%)"""
+
+
+def _line_macros(line):
+    """[calories, protein, carbs, fat] mentioned on a line, None for those it doesn't give"""
+    values = [None] * 4
+    for match in MACRO_MENTION_PATTERN.finditer(line):
+        if match.group('unit').lower() != 'g':
+            column = 0
+        else:
+            label = match.group('before') or match.group('after')
+            if not label:
+                continue
+            column = MACRO_COLUMNS[label[0].lower()]
+        if values[column] is None:
+            values[column] = _float(match.group('number'))
+    return values
+
+
+def meal_macros_from_text(plan_text):
+    """
+    The macros of every meal in a text plan's meal plan section
+
+    Lines summing up a day ("Day total: ...") are skipped, so only meals are
+    counted. A meal's macros may be spread over several lines.
+
+    Returns:
+        Tuple of (day number per row, rows of [calories, protein, carbs, fat] with None where not given)
+    """
+    days, rows = [], []
+    day = None
+    in_meal_plan = False
+    for raw_line in plan_text.split('\n'):
+        line = raw_line.strip().translate(MARKUP_CHARS).strip()
+        if raw_line.lstrip().startswith('#') or (line.isupper() and not DAY_PATTERN.match(line)):
+            in_meal_plan = 'MEAL PLAN' in line.upper()
+            day = None
+            continue
+        match = DAY_PATTERN.match(line)
+        if in_meal_plan and match:
+            day = int(match.group(1))
+        elif in_meal_plan and day is not None and not TOTAL_LINE_PATTERN.search(line):
+            values = _line_macros(line)
+            if any(value is not None for value in values):
+                days.append(day)
+                rows.append(values)
+    return days, rows
+
+
+def meal_macros_from_data(data):
+    """The macros of every meal in a structured plan, in the same form as meal_macros_from_text"""
+    days, rows = [], []
+    for day in data['days']:
+        for meal in day.get('meals', []):
+            values = []
+            for key in MACROS:
+                try:
+                    values.append(float(meal[key]))
+                except (KeyError, TypeError, ValueError):
+                    values.append(None)
+            days.append(day['day'])
+            rows.append(values)
+    return days, rows
+
+
+def _day_totals(days, rows):
+    """
+    Sum meal macros per day
+
+    Vectorised with NumPy when it is installed (a 90-day plan takes well
+    under a millisecond), with a plain Python fallback otherwise.
+
+    Returns:
+        Tuple of (day numbers, per-day totals, per-day flags of which macros any meal gave)
+    """
+    day_numbers = sorted(set(days))
+    try:
+        import numpy as np
+    except ImportError:
+        index = {day: position for position, day in enumerate(day_numbers)}
+        totals = [[0.0] * 4 for _ in day_numbers]
+        given = [[False] * 4 for _ in day_numbers]
+        for day, row in zip(days, rows):
+            for column, value in enumerate(row):
+                if value is not None:
+                    totals[index[day]][column] += value
+                    given[index[day]][column] = True
+        return day_numbers, totals, given
+
+    positions = np.searchsorted(day_numbers, days)
+    values = np.array(rows, dtype=float)
+    present = ~np.isnan(values)
+    values = np.where(present, values, 0.0)
+    totals = np.stack([np.bincount(positions, weights=values[:, column], minlength=len(day_numbers))
+                       for column in range(4)], axis=1)
+    given = np.stack([np.bincount(positions, weights=present[:, column], minlength=len(day_numbers)) > 0
+                      for column in range(4)], axis=1)
+    return day_numbers, totals.tolist(), given.tolist()
+
+
+def check_plan_macros(plan, targets, tolerances=None):
+    """
+    Check each day's meals add up to the daily targets
+
+    A day is off target if any macro its meals give is further from the
+    target than its tolerance (a fraction, see DEFAULT_TOLERANCES).
+
+    Args:
+        plan: Plan text, or a structured plan dict
+        targets: MacroTargets to check against
+        tolerances: Optional overrides of DEFAULT_TOLERANCES
+
+    Returns:
+        MacroReport
+    """
+    tolerances = dict(DEFAULT_TOLERANCES, **(tolerances or {}))
+    days, rows = meal_macros_from_data(plan) if isinstance(plan, dict) else meal_macros_from_text(plan)
+    if not days:
+        return MacroReport(0, [])
+
+    day_numbers, totals, given = _day_totals(days, rows)
+    target_values = [getattr(targets, key) for key in MACROS]
+    off_target = []
+    for day, day_totals, day_given in zip(day_numbers, totals, given):
+        off = {}
+        for key, total, target, present in zip(MACROS, day_totals, target_values, day_given):
+            deviation = total / target - 1 if target else 0.0
+            if present and abs(deviation) > tolerances[key]:
+                off[key] = deviation
+        if off:
+            off_target.append(OffTargetDay(day, *[round(total) for total in day_totals], off))
+    return MacroReport(len(day_numbers), off_target)
+
+
+def describe_day(day):
+    """One off-target day in a line, e.g. "Day 3: calories +18%, protein -12%\""""
+    return f"Day {day.day}: " + ', '.join(f"{MACRO_LABELS[key]} {deviation:+.0%}" for key, deviation in day.off.items())
@@ -0,0 +1,403 @@
+"""
+Message Batches
+Submits plan requests as one Message Batch for non-urgent bulk runs, then collects, saves and renders the results
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import instrumentation
+from types import SimpleNamespace
+from nutrition_plan_generator import complete_plan, message_text, normalise_profile
+
+DEFAULT_BATCH_STORE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nutrition_plans', 'batches.sqlite3')
+DEFAULT_POLL_SECONDS = 60
+# The API's limit on requests in one batch
+MAX_BATCH_REQUESTS = 100000
+
+
+def make_custom_id(index, user_data):
+    """Unique id for one client's request within a batch (the API allows 1-64 letters, digits, - and _)"""
+    name = re.sub(r'[^A-Za-z0-9]+', '_', user_data['name']).strip('_')[:40]
+    return f"client-{index:05d}-{name}" if name else f"client-{index:05d}"
+
+
+class BatchStore:
+    """
+    SQLite record of submitted batches and which client each request is for
+
+    Every request stays 'pending' until its plan has been saved, so
+    collection can stop at any point and pick up where it left off. The
+    paths a plan is saved to are recorded before its files are written, so
+    a collection that stops part way writes the same files again.
+    """
+
+    def __init__(self, path=DEFAULT_BATCH_STORE_PATH):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "batch_id TEXT PRIMARY KEY, status TEXT NOT NULL, output_dir TEXT, make_pdf INTEGER NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS batch_requests ("
+                "batch_id TEXT NOT NULL, custom_id TEXT NOT NULL, profile TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', text_path TEXT, pdf_path TEXT, error TEXT, params TEXT, "
+                "PRIMARY KEY (batch_id, custom_id))"
+            )
+            # Stores written before requests' params were kept
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(batch_requests)")]
+            if 'params' not in columns:
+                self._conn.execute("ALTER TABLE batch_requests ADD COLUMN params TEXT")
+
+    def add_batch(self, batch_id, profiles, output_dir=None, make_pdf=True, params=None):
+        """Record a submitted batch, its {custom_id: profile} mapping and the {custom_id: params} sent"""
+        params = params or {}
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO batches (batch_id, status, output_dir, make_pdf, created_at) VALUES (?, ?, ?, ?, ?)",
+                (batch_id, 'submitted', output_dir, int(make_pdf), time.time())
+            )
+            self._conn.executemany(
+                "INSERT INTO batch_requests (batch_id, custom_id, profile, params) VALUES (?, ?, ?, ?)",
+                [(batch_id, custom_id, json.dumps(profile),
+                  json.dumps(params[custom_id]) if custom_id in params else None)
+                 for custom_id, profile in profiles.items()]
+            )
+
+    def get_batch(self, batch_id):
+        """Return a batch's status, output_dir and make_pdf as a dict, or None if it isn't known"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, output_dir, make_pdf FROM batches WHERE batch_id = ?", (batch_id,)
+            ).fetchone()
+        return {'status': row[0], 'output_dir': row[1], 'make_pdf': bool(row[2])} if row else None
+
+    def open_batches(self):
+        """Ids of the batches whose results haven't all been collected, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT batch_id FROM batches WHERE status != 'collected' ORDER BY created_at"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def set_status(self, batch_id, status):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE batches SET status = ? WHERE batch_id = ?", (status, batch_id))
+
+    def pending(self, batch_id):
+        """Return {custom_id: profile} for the requests in a batch not yet collected"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT custom_id, profile FROM batch_requests WHERE batch_id = ? AND status = 'pending'", (batch_id,)
+            ).fetchall()
+        return {custom_id: json.loads(profile) for custom_id, profile in rows}
+
+    def request_params(self, batch_id, custom_id):
+        """Return the Messages API params a request was submitted with, or None if they weren't recorded"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT params FROM batch_requests WHERE batch_id = ? AND custom_id = ?", (batch_id, custom_id)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def output_paths(self, batch_id, custom_id):
+        """Return the (text path, PDF path) recorded for a request, each None if not recorded yet"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text_path, pdf_path FROM batch_requests WHERE batch_id = ? AND custom_id = ?",
+                (batch_id, custom_id)
+            ).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def set_output_paths(self, batch_id, custom_id, text_path, pdf_path=None):
+        """Record where a pending request's plan will be saved, before saving it"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE batch_requests SET text_path = ?, pdf_path = ? WHERE batch_id = ? AND custom_id = ?",
+                (text_path, pdf_path, batch_id, custom_id)
+            )
+
+    def finish(self, batch_id, custom_id, status, text_path=None, pdf_path=None, error=None):
+        """Mark one request collected ('ok') or failed"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE batch_requests SET status = ?, text_path = ?, pdf_path = ?, error = ? "
+                "WHERE batch_id = ? AND custom_id = ?",
+                (status, text_path, pdf_path, error, batch_id, custom_id)
+            )
+
+    def summary(self, batch_id):
+        """Return {status: request count} for a batch"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM batch_requests WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        self._conn.close()
+
+
+class AnthropicBatchTransport:
+    """The Message Batches API, on an Anthropic client"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, requests):
+        """Submit [{'custom_id', 'params'}] as one batch, returning its id"""
+        return self.client.messages.batches.create(requests=requests).id
+
+    def status(self, batch_id):
+        """Return the batch's processing status ('in_progress', 'canceling' or 'ended') and request counts"""
+        batch = self.client.messages.batches.retrieve(batch_id)
+        return batch.processing_status, batch.request_counts
+
+    def results(self, batch_id):
+        """Iterate over the results of an ended batch as they are downloaded"""
+        return self.client.messages.batches.results(batch_id)
+
+
+def _placeholder_days(first, last):
+    lines = []
+    for day in range(first, last + 1):
+        lines += [f"**DAY {day}:**", "- Breakfast: Porridge with berries", "- Lunch: Chicken salad",
+                  "- Dinner: Salmon with vegetables", ""]
+    return lines
+
+
+PLACEHOLDER_RECIPE = ["**Porridge with Berries**", "Serves: 1", "Ingredients:", "- 50g rolled oats", "- 200ml milk",
+                      "- 80g blueberries", "Method:", "1. Simmer for 5 minutes.", ""]
+PLACEHOLDER_ANALYSIS = ["## 1. NUTRITIONAL ANALYSIS", "", "Offline test plan: no API request was made.", ""]
+PLACEHOLDER_NOTES = ["## PERSONAL NOTES", "", "Offline test plan.", ""]
+
+
+def placeholder_plan(params):
+    """
+    Stand-in reply for offline runs, shaped like the model's reply to params' prompt
+
+    A whole-plan prompt gets a minimal plan with every section the model
+    writes; the parts of a chunked long plan get just their part: section 1
+    for the analysis prompt, the ===MEAL PLAN=== and ===RECIPES=== body for a
+    chunk of days, and the personal notes for the aftercare prompt.
+    """
+    prompt = params['messages'][0]['content']
+    if 'Write ONLY section 1' in prompt:
+        lines = PLACEHOLDER_ANALYSIS
+    elif 'Write ONLY the personal notes' in prompt:
+        lines = PLACEHOLDER_NOTES
+    elif '===MEAL PLAN===' in prompt:
+        first, last = map(int, re.search(r'days (\d+) to (\d+)', prompt).groups())
+        lines = ["===MEAL PLAN===", ""] + _placeholder_days(first, last) + ["===RECIPES===", ""] + PLACEHOLDER_RECIPE
+    else:
+        days = re.search(r'Plan Duration: (\d+)', prompt)
+        days = int(days.group(1)) if days else 7
+        lines = (PLACEHOLDER_ANALYSIS + [f"## 2. {days}-DAY MEAL PLAN", ""] + _placeholder_days(1, days) +
+                 ["## 3. RECIPES", ""] + PLACEHOLDER_RECIPE + PLACEHOLDER_NOTES)
+    return '\n'.join(lines)
+
+
+def placeholder_message(params, respond=placeholder_plan):
+    """Stand-in Messages API response to params, with respond(params) as its text and rough token counts"""
+    text = respond(params)
+    usage = SimpleNamespace(input_tokens=len(params['messages'][0]['content']) // 4, output_tokens=len(text) // 4,
+                            cache_read_input_tokens=0, cache_creation_input_tokens=0)
+    return SimpleNamespace(content=[SimpleNamespace(type='text', text=text)], stop_reason='end_turn', usage=usage)
+
+
+class LocalBatchTransport:
+    """
+    Offline stand-in for the Message Batches API
+
+    Batches are kept as JSON files in directory, so a submitted batch can be
+    polled and collected after a restart just like a real one. A batch ends
+    ready_after seconds after it was created, and each request's reply is
+    respond(params) (placeholder_plan by default).
+    """
+
+    def __init__(self, directory, respond=None, ready_after=0.0):
+        self.directory = directory
+        self.respond = respond or placeholder_plan
+        self.ready_after = ready_after
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id):
+        return os.path.join(self.directory, f"{batch_id}.json")
+
+    def _load(self, batch_id):
+        with open(self._path(batch_id)) as f:
+            return json.load(f)
+
+    def create(self, requests):
+        batch_id = f"msgbatch_local_{uuid.uuid4().hex[:24]}"
+        with open(self._path(batch_id), 'w') as f:
+            json.dump({'created_at': time.time(), 'requests': requests}, f)
+        return batch_id
+
+    def status(self, batch_id):
+        batch = self._load(batch_id)
+        ended = time.time() - batch['created_at'] >= self.ready_after
+        total = len(batch['requests'])
+        counts = SimpleNamespace(processing=0 if ended else total, succeeded=total if ended else 0,
+                                 errored=0, canceled=0, expired=0)
+        return ('ended' if ended else 'in_progress'), counts
+
+    def results(self, batch_id):
+        for request in self._load(batch_id)['requests']:
+            message = placeholder_message(request['params'], self.respond)
+            yield SimpleNamespace(custom_id=request['custom_id'],
+                                  result=SimpleNamespace(type='succeeded', message=message))
+
+
+def submit_batch(generator, profiles, transport, store, output_dir=None, make_pdf=True):
+    """
+    Submit one plan request per profile as a single Message Batch
+
+    Invalid profiles are reported and left out. The batch id, its
+    custom_id to profile mapping and each request's params are recorded in
+    store for collect_batch.
+
+    Returns:
+        The batch id, or None if no profile was valid
+    """
+    if len(profiles) > MAX_BATCH_REQUESTS:
+        raise ValueError(f"{len(profiles)} profiles is more than one batch can hold ({MAX_BATCH_REQUESTS})")
+
+    mapping = {}
+    params = {}
+    requests = []
+    for index, profile in enumerate(profiles):
+        try:
+            user_data = normalise_profile(profile)
+        except ValueError as e:
+            print(f"❌ {profile.get('name') or f'profile {index + 1}'}: {e}")
+            continue
+        custom_id = make_custom_id(index, user_data)
+        mapping[custom_id] = user_data
+        params[custom_id] = generator._build_request(user_data)
+        requests.append({'custom_id': custom_id, 'params': params[custom_id]})
+
+    if not requests:
+        return None
+    with instrumentation.span('batch_submit', requests=len(requests)) as fields:
+        batch_id = transport.create(requests)
+        fields['batch_id'] = batch_id
+    store.add_batch(batch_id, mapping, output_dir, make_pdf, params)
+    print(f"📦 Submitted batch {batch_id} with {len(requests)} plan requests")
+    return batch_id
+
+
+def _collect_result(generator, store, batch_id, custom_id, user_data, result, output_dir, make_pdf, render_pool):
+    """Save (and render) one batch result, recording the outcome in store"""
+    with instrumentation.span('batch_result', batch_id=batch_id, custom_id=custom_id,
+                              result=result.type) as fields:
+        if result.type != 'succeeded':
+            error = getattr(getattr(result, 'error', None), 'error', None)
+            store.finish(batch_id, custom_id, 'failed', error=str(getattr(error, 'message', None) or result.type))
+            print(f"❌ {user_data['name']}: batch request {result.type}")
+            return
+
+        message = result.message
+        if generator.client is not None:
+            # Continued in real time from the request the batch actually sent, so the
+            # prompt still matches the text even if prices or the library have changed
+            # (batches recorded before params were stored are rebuilt from the profile)
+            request = store.request_params(batch_id, custom_id) or generator._build_request(user_data)
+            message, text, usages = generator._continue_completion(user_data, request, 'plan', message)
+            text, usage = generator._finish_completion(user_data, 'plan', None, message, text, usages)
+        else:
+            text, usage, usages = message_text(message), message.usage, [message.usage]
+            generator._record_usage(user_data, 'plan', None, usage.output_tokens)
+            if message.stop_reason == 'max_tokens':
+                print(f"⚠️  {user_data['name']}'s plan was cut off at the token limit; it may be incomplete")
+        fields.update(output_tokens=usage.output_tokens, stop_reason=message.stop_reason,
+                      continuations=len(usages) - 1)
+
+        plan = complete_plan(text, user_data, generator.prices, generator.library)
+        fields['off_target_days'] = generator.check_macros(plan, user_data)
+        generator._store_plan(user_data, plan)
+        # Paths are recorded before the files are written, so a collection that
+        # stops before finish() overwrites them when rerun instead of saving a second copy
+        text_path, pdf_path = store.output_paths(batch_id, custom_id)
+        if text_path is None:
+            text_path = generator._reserve_output_path(user_data, '.txt', output_dir)
+            pdf_path = generator._reserve_output_path(user_data, '.pdf', output_dir) if make_pdf else None
+            store.set_output_paths(batch_id, custom_id, text_path, pdf_path)
+        generator.save_plan(plan, user_data, output_dir, filepath=text_path)
+        if make_pdf:
+            pdf_path = generator.generate_pdf(plan, user_data, output_dir, render_pool=render_pool, filepath=pdf_path)
+        store.finish(batch_id, custom_id, 'ok', text_path, pdf_path)
+
+
+def collect_batch(generator, transport, store, batch_id, wait=True, poll_seconds=DEFAULT_POLL_SECONDS,
+                  render_pool=None):
+    """
+    Wait for a batch to end, then save and render each plan as its result is downloaded
+
+    Results already collected by an earlier, interrupted run are skipped,
+    and a plan that couldn't be saved stays pending, so this is safe to
+    rerun (from cron, say) until the batch is done.
+
+    Args:
+        generator: NutritionPlanGenerator used to save, cache and render the plans
+        transport: AnthropicBatchTransport or LocalBatchTransport the batch was submitted with
+        store: BatchStore the batch was recorded in
+        batch_id: Id returned by submit_batch
+        wait: Poll until the batch ends; otherwise return None at once if it hasn't
+        poll_seconds: Seconds between status checks
+        render_pool: Optional RenderPool for the PDFs
+
+    Returns:
+        Dict of {status: request count} for the batch, or None if it hasn't ended
+    """
+    batch = store.get_batch(batch_id)
+    if batch is None:
+        raise ValueError(f"Unknown batch {batch_id} (not in {store.path})")
+    if batch['status'] == 'collected':
+        return store.summary(batch_id)
+
+    while True:
+        status, counts = transport.status(batch_id)
+        if status == 'ended':
+            break
+        if not wait:
+            print(f"⏳ Batch {batch_id} is {status} ({counts.processing} requests still processing)")
+            return None
+        print(f"⏳ Batch {batch_id}: {counts.succeeded} done, {counts.processing} processing; "
+              f"checking again in {poll_seconds:.0f}s")
+        time.sleep(poll_seconds)
+
+    if batch['output_dir']:
+        os.makedirs(batch['output_dir'], exist_ok=True)
+    pending = store.pending(batch_id)
+    print(f"📥 Batch {batch_id} ended; collecting {len(pending)} plans")
+    retry_later = 0
+    for entry in transport.results(batch_id):
+        user_data = pending.pop(entry.custom_id, None)
+        if user_data is None:
+            # Collected before a restart
+            continue
+        try:
+            _collect_result(generator, store, batch_id, entry.custom_id, user_data, entry.result,
+                            batch['output_dir'], batch['make_pdf'], render_pool)
+        except Exception as e:
+            # Left pending: the batch's results stay downloadable, so the next run tries again
+            retry_later += 1
+            print(f"❌ {user_data['name']}: {e} (will retry on the next collection)")
+
+    for custom_id, user_data in pending.items():
+        store.finish(batch_id, custom_id, 'failed', error="no result in the batch")
+        print(f"❌ {user_data['name']}: no result in the batch")
+    if not retry_later:
+        store.set_status(batch_id, 'collected')
+    return store.summary(batch_id)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Nutrition Plan CLI
+Non-interactive generate, render, validate, Message Batch and job queue commands for scripts, workers and cron jobs
+"""
+
+import argparse
+import json
+import os
+import sys
+import contextlib
+import instrumentation
+from nutrition_plan_generator import NutritionPlanGenerator, normalise_profile, load_plan
+from job_queue import DEFAULT_LANE, LANES, JobQueue
+from plan_cache import PlanCache
+from plan_ir import Section, lex_plan
+from recipe_library import RecipeLibrary
+from shopping_list import load_price_table
+
+# Sections every generated plan must have, as they appear in its headings
+REQUIRED_PLAN_SECTIONS = ['NUTRITIONAL ANALYSIS', 'MEAL PLAN', 'RECIPES', 'SHOPPING LIST']
+
+
+def read_profiles(path):
+    """
+    Read client profiles from a JSON file (one profile), a JSONL/CSV roster, or '-' for JSON on stdin
+
+    Returns:
+        List of raw profile dicts, in file order
+    """
+    if path == '-':
+        return [json.load(sys.stdin)]
+    if path.lower().endswith(('.jsonl', '.csv')):
+        from batch_generator import load_profiles
+        return load_profiles(path)
+    with open(path) as f:
+        return [json.load(f)]
+
+
+def read_profile(path):
+    """Read and normalise the single client profile in path, raising ValueError if it isn't one"""
+    profiles = read_profiles(path)
+    if len(profiles) != 1:
+        raise ValueError(f"{path} holds {len(profiles)} profiles, expected one (use batch_generator.py for rosters)")
+    return normalise_profile(profiles[0])
+
+
+def check_plan(plan):
+    """Return the problems with a loaded plan, or an empty list if it looks complete"""
+    if isinstance(plan, dict):
+        # load_plan has already validated structured plans
+        return []
+    headings = [node.title.upper() for node in lex_plan(plan) if isinstance(node, Section)]
+    return [f"Plan has no {section} section" for section in REQUIRED_PLAN_SECTIONS
+            if not any(section in heading for heading in headings)]
+
+
+def _prices(args):
+    """Shopping list price table, with the --prices file over the defaults"""
+    return load_price_table(args.prices) if args.prices else None
+
+
+def _library(args):
+    """Recipe library offered to the model and grown from new plans, unless --no-library"""
+    return None if args.no_library else RecipeLibrary()
+
+
+def _queue(args):
+    """Job queue shared by enqueue, worker and jobs, at --queue or the default path"""
+    return JobQueue(args.queue) if args.queue else JobQueue()
+
+
+def _profiling(args):
+    """cProfile the PDF rendering if --profile was given"""
+    if args.profile_output is None:
+        return contextlib.nullcontext()
+    return instrumentation.profiled(args.profile_output or None)
+
+
+def cmd_generate(args):
+    """Generate, save and optionally render one client's plan"""
+    user_data = read_profile(args.profile)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    generator = NutritionPlanGenerator(cache=None if args.no_cache else PlanCache(), prices=_prices(args),
+                                       library=_library(args))
+    generator.setup_api(interactive=False)
+
+    plan = generator.generate_nutrition_plan(user_data, refresh=args.refresh, structured=args.structured)
+    if not plan:
+        return 1
+    generator.save_plan(plan, user_data, args.output_dir)
+    if not args.no_pdf:
+        with _profiling(args):
+            if not generator.generate_pdf(plan, user_data, args.output_dir):
+                return 1
+    return 0
+
+
+def cmd_render(args):
+    """Lay out a saved plan as a PDF without calling the API"""
+    user_data = read_profile(args.profile)
+    plan = load_plan(args.plan)
+    generator = NutritionPlanGenerator()
+    stats = {}
+
+    if args.output == '-':
+        with _profiling(args):
+            data = generator.render_pdf(plan, user_data, stats=stats)
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+        log = sys.stderr
+    else:
+        output = args.output or os.path.splitext(args.plan)[0] + '.pdf'
+        with _profiling(args):
+            generator.render_pdf(plan, user_data, output, stats=stats)
+        log = sys.stdout
+        print(f"✅ PDF saved to: {output}", file=log)
+    print(f"   {stats['pages']} pages in {stats['seconds']:.2f}s" +
+          (f", {stats['bytes'] / 1024:.0f} KB" if stats.get('bytes') else ''), file=log)
+    return 0
+
+
+def _batch_setup(args):
+    """Generator, batch transport and batch store for the batch commands (offline with --local)"""
+    from message_batches import AnthropicBatchTransport, BatchStore, LocalBatchTransport
+    generator = NutritionPlanGenerator(cache=None if args.no_cache else PlanCache(), prices=_prices(args),
+                                       library=_library(args))
+    if args.local:
+        transport = LocalBatchTransport(args.local)
+    else:
+        generator.setup_api(interactive=False)
+        transport = AnthropicBatchTransport(generator.client)
+    return generator, transport, BatchStore(args.store) if args.store else BatchStore()
+
+
+def cmd_submit_batch(args):
+    """Submit a roster's plan requests as one Message Batch, at batch prices, for collecting later"""
+    from message_batches import submit_batch
+    profiles = read_profiles(args.profiles)
+    generator, transport, store = _batch_setup(args)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    batch_id = submit_batch(generator, profiles, transport, store, args.output_dir, make_pdf=not args.no_pdf)
+    if batch_id is None:
+        return 1
+    print(batch_id)
+    return 0
+
+
+def cmd_collect_batch(args):
+    """Save and render the plans of submitted batches, resuming any earlier collection"""
+    from message_batches import collect_batch
+    generator, transport, store = _batch_setup(args)
+    batch_ids = [args.batch_id] if args.batch_id else store.open_batches()
+    if not batch_ids:
+        print("✅ No batches waiting to be collected")
+        return 0
+
+    failures = 0
+    for batch_id in batch_ids:
+        summary = collect_batch(generator, transport, store, batch_id, wait=not args.no_wait,
+                                poll_seconds=args.poll_seconds)
+        if summary is None:
+            continue
+        print(f"📊 Batch {batch_id}: {summary.get('ok', 0)} plans saved, {summary.get('failed', 0)} failed, "
+              f"{summary.get('pending', 0)} to retry")
+        failures += summary.get('failed', 0) + summary.get('pending', 0)
+    return 1 if failures else 0
+
+
+def cmd_enqueue(args):
+    """Queue plan jobs for the resident worker, printing their ids"""
+    queue = _queue(args)
+    failures = 0
+    for index, profile in enumerate(read_profiles(args.profiles), 1):
+        try:
+            user_data = normalise_profile(profile)
+        except ValueError as e:
+            failures += 1
+            print(f"❌ {profile.get('name') or f'profile {index}'}: {e}", file=sys.stderr)
+            continue
+        print(queue.enqueue(user_data, args.lane, args.output_dir, make_pdf=not args.no_pdf,
+                            structured=args.structured, refresh=args.refresh))
+    return 1 if failures else 0
+
+
+def cmd_worker(args):
+    """Run queued plan jobs on warm clients until SIGTERM/SIGINT (or, with --exit-when-idle, an empty queue)"""
+    from plan_worker import run_worker, use_stub_api
+    queue = _queue(args)
+    # Placeholder plans from the stub API are kept out of the plan cache and recipe library
+    offline = args.stub is not None
+    generator = NutritionPlanGenerator(cache=None if args.no_cache or offline else PlanCache(), prices=_prices(args),
+                                       library=None if offline else _library(args))
+    if offline:
+        use_stub_api(generator, latency=args.stub)
+    else:
+        generator.setup_api(interactive=False)
+
+    render_pool = None
+    if args.render_workers:
+        from render_pool import RenderPool
+        render_pool = RenderPool(args.render_workers)
+    try:
+        stats = run_worker(generator, queue, args.concurrency, render_pool, args.poll_seconds,
+                           exit_when_idle=args.exit_when_idle)
+    finally:
+        if render_pool is not None:
+            render_pool.close()
+    return 1 if stats['failed'] else 0
+
+
+def cmd_jobs(args):
+    """Show one queued job, or job counts per lane"""
+    queue = _queue(args)
+    if args.job_id is not None:
+        job = queue.get(args.job_id)
+        if job is None:
+            raise ValueError(f"Unknown job {args.job_id} (not in {queue.path})")
+        job['name'] = job.pop('profile')['name']
+        print(json.dumps(job, indent=2))
+        return 0
+
+    counts = queue.counts()
+    if not counts:
+        print("✅ No jobs queued")
+    for lane in sorted(counts, key=lambda lane: LANES.index(lane) if lane in LANES else len(LANES)):
+        print(f"📋 {lane}: " + ", ".join(f"{count} {status}" for status, count in sorted(counts[lane].items())))
+    return 0
+
+
+def cmd_validate(args):
+    """Check profiles (and optionally a saved plan) without calling the API or loading reportlab"""
+    failures = 0
+    profiles = []
+    for index, profile in enumerate(read_profiles(args.profile), 1):
+        name = profile.get('name') or f"profile {index}"
+        try:
+            profiles.append(normalise_profile(profile))
+            print(f"✅ {name}: profile OK")
+        except ValueError as e:
+            failures += 1
+            print(f"❌ {name}: {e}")
+
+    if args.plan:
+        plan = None
+        try:
+            plan = load_plan(args.plan)
+            problems = check_plan(plan)
+        except (ValueError, json.JSONDecodeError) as e:
+            problems = [str(e)]
+        for problem in problems:
+            print(f"❌ {args.plan}: {problem}")
+        if problems:
+            failures += 1
+        else:
+            print(f"✅ {args.plan}: plan OK")
+        # Days off the daily targets are reported, but don't fail validation
+        if plan and len(profiles) == 1:
+            NutritionPlanGenerator().check_macros(plan, profiles[0])
+
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate, render and validate nutrition plans non-interactively")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # Options every command takes, and those of the commands that render a PDF
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--metrics', default=None,
+                        help="Append span timings, token usage and page counts as JSON lines to this file (- for stderr)")
+    pricing = argparse.ArgumentParser(add_help=False)
+    pricing.add_argument('--prices', default=None, metavar='FILE',
+                         help="JSON price table for shopping list costs, mapping items to [£, unit]")
+    recipes = argparse.ArgumentParser(add_help=False)
+    recipes.add_argument('--no-library', action='store_true',
+                         help="Don't offer known recipes to the model or add new plans' recipes to the library")
+    rendering = argparse.ArgumentParser(add_help=False)
+    rendering.add_argument('--profile', dest='profile_output', nargs='?', const='', default=None, metavar='FILE',
+                           help="cProfile the PDF rendering, printing the top functions and saving stats to FILE")
+
+    generate = commands.add_parser('generate', parents=[common, pricing, recipes, rendering],
+                                   help="Generate a plan for one client profile")
+    generate.add_argument('profile', help="JSON file holding the client profile, or - to read it from stdin")
+    generate.add_argument('--output-dir', default=None, help="Directory for plan files (default: current directory)")
+    generate.add_argument('--no-pdf', action='store_true', help="Only save the text plan")
+    generate.add_argument('--refresh', action='store_true',
+                          help="Regenerate even if a cached plan exists for an identical profile")
+    generate.add_argument('--no-cache', action='store_true', help="Don't read or write the local plan cache")
+    generate.add_argument('--structured', action='store_true',
+                          help="Request the plan as structured JSON and lay out the PDF from it")
+    generate.set_defaults(handler=cmd_generate)
+
+    render = commands.add_parser('render', parents=[common, rendering],
+                                 help="Render a saved plan (.txt, or structured .json) as a PDF")
+    render.add_argument('plan', help="Saved plan file")
+    render.add_argument('profile', help="JSON file holding the client profile, or - to read it from stdin")
+    render.add_argument('-o', '--output', default=None,
+                        help="PDF path, or - to write the PDF to stdout (default: the plan path with .pdf)")
+    render.set_defaults(handler=cmd_render)
+
+    validate = commands.add_parser('validate', parents=[common],
+                                   help="Check client profiles and, optionally, a saved plan")
+    validate.add_argument('profile', help="JSON profile, JSONL/CSV roster, or - to read one profile from stdin")
+    validate.add_argument('--plan', default=None, help="Also check this saved plan (.txt or structured .json)")
+    validate.set_defaults(handler=cmd_validate)
+
+    batches = argparse.ArgumentParser(add_help=False)
+    batches.add_argument('--local', default=None, metavar='DIR',
+                         help="Use an offline stand-in for the Message Batches API, keeping batches in DIR")
+    batches.add_argument('--store', default=None,
+                         help="SQLite file recording submitted batches (default: ~/.cache/nutrition_plans/batches.sqlite3)")
+    batches.add_argument('--no-cache', action='store_true', help="Don't read or write the local plan cache")
+
+    submit = commands.add_parser('submit-batch', parents=[common, batches, pricing, recipes],
+                                 help="Submit plan requests for a roster as one Message Batch (half price, within 24h)")
+    submit.add_argument('profiles', help="JSONL/CSV roster or JSON profile")
+    submit.add_argument('--output-dir', default=None,
+                        help="Directory the plans are saved to when collected (default: current directory)")
+    submit.add_argument('--no-pdf', action='store_true', help="Only save text plans when collected")
+    submit.set_defaults(handler=cmd_submit_batch)
+
+    collect = commands.add_parser('collect-batch', parents=[common, batches, pricing, recipes],
+                                  help="Wait for submitted batches and save and render their plans")
+    collect.add_argument('batch_id', nargs='?', default=None,
+                         help="Batch to collect (default: every batch not yet collected)")
+    collect.add_argument('--no-wait', action='store_true', help="Only collect batches that have already ended")
+    collect.add_argument('--poll-seconds', type=float, default=60, help="Seconds between status checks (default 60)")
+    collect.set_defaults(handler=cmd_collect_batch)
+
+    queues = argparse.ArgumentParser(add_help=False)
+    queues.add_argument('--queue', default=None,
+                        help="SQLite job queue file (default: ~/.cache/nutrition_plans/jobs.sqlite3)")
+
+    enqueue = commands.add_parser('enqueue', parents=[common, queues],
+                                  help="Queue plan jobs for the resident worker, printing their job ids")
+    enqueue.add_argument('profiles', help="JSON profile, JSONL/CSV roster, or - to read one profile from stdin")
+    enqueue.add_argument('--lane', choices=LANES, default=DEFAULT_LANE,
+                         help=f"Priority lane; earlier lanes are always run first ({', '.join(LANES)}; "
+                              f"default {DEFAULT_LANE})")
+    enqueue.add_argument('--output-dir', default=None,
+                         help="Directory the worker saves the plans to (default: the worker's current directory)")
+    enqueue.add_argument('--no-pdf', action='store_true', help="Only save text plans")
+    enqueue.add_argument('--structured', action='store_true',
+                         help="Request the plans as structured JSON and lay out the PDFs from it")
+    enqueue.add_argument('--refresh', action='store_true',
+                         help="Regenerate even if a cached plan exists for an identical profile")
+    enqueue.set_defaults(handler=cmd_enqueue)
+
+    worker = commands.add_parser('worker', parents=[common, queues, pricing, recipes],
+                                 help="Run queued plan jobs until stopped (SIGTERM/SIGINT drain running jobs first)")
+    worker.add_argument('--concurrency', type=int, default=4, help="Jobs run at once (default 4)")
+    worker.add_argument('--render-workers', type=int, default=0,
+                        help="Processes laying out PDFs (default 0: render in the worker process)")
+    worker.add_argument('--poll-seconds', type=float, default=1.0,
+                        help="Seconds between checks for new jobs while idle (default 1)")
+    worker.add_argument('--exit-when-idle', action='store_true', help="Stop once no job is left to claim")
+    worker.add_argument('--no-cache', action='store_true', help="Don't read or write the local plan cache")
+    worker.add_argument('--stub', type=float, nargs='?', const=0.0, default=None, metavar='SECONDS',
+                        help="Answer with placeholder plans after SECONDS instead of calling the API (offline "
+                             "testing; skips the plan cache and recipe library)")
+    worker.set_defaults(handler=cmd_worker)
+
+    jobs = commands.add_parser('jobs', parents=[common, queues], help="Show job counts per lane, or one job")
+    jobs.add_argument('job_id', nargs='?', type=int, default=None, help="Job to show, with its files and result")
+    jobs.set_defaults(handler=cmd_jobs)
+
+    args = parser.parse_args(argv)
+    if args.metrics:
+        instrumentation.add_hook(instrumentation.JsonLinesWriter(sys.stderr if args.metrics == '-' else args.metrics))
+    try:
+        return args.handler(args)
+    except (OSError, ValueError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,31 +4,289 @@ Personal Nutrition Plan Generator
 Collects user preferences and generates personalised nutrition plans using Claude API
 """
 
+import io
 import os
+import re
 import json
-from anthropic import Anthropic
+import math
+import time
+import asyncio
 from datetime import datetime
-from pdf_generator import create_nutrition_plan_pdf
+import instrumentation
+from plan_cache import PlanCache, make_cache_key
+from request_policy import RequestRunner
+from aftercare_templates import (
+    PERSONAL_NOTES_HEADING, PERSONAL_NOTES_PATTERN, MEAL_PREP_HEADING_PATTERN, merge_aftercare, render_aftercare
+)
+from macro_engine import check_plan_macros, compute_targets, describe_day, format_targets
+from shopping_list import (
+    DEFAULT_PRICES, SHOPPING_HEADING_PATTERN, add_shopping_list, prices_digest, shopping_section,
+    structured_shopping_list
+)
+from plan_ir import RECIPE_SUBHEADINGS
+from recipe_library import (
+    NEXT_SECTION_PATTERN, RECIPES_HEADING_PATTERN, RecipeLibrary, expand_recipe_lines, expand_recipe_references,
+    expand_structured_recipes, format_known_recipes
+)
+from structured_plan import PLAN_TOOL, PLAN_TOOL_NAME, validate_plan_data, plan_to_ir, plan_to_text
+
+MODEL = "claude-sonnet-4-5-20250929"
+# max_tokens is sized per request: tokens per meal slot (a day's meal) times
+# the plan's slots, plus a fixed allowance for the analysis and notes, with headroom. Once MIN_USAGE_HISTORY requests of a kind have been
+# recorded in the plan cache, their 90th percentile rate replaces the default.
+TOKENS_PER_SLOT = 400
+FIXED_SLOTS = 8
+MAX_TOKENS_HEADROOM = 1.25
+MIN_MAX_TOKENS = 4000
+MAX_MAX_TOKENS = 32000
+MIN_USAGE_HISTORY = 5
+# Requests cut off at max_tokens are resumed from the partial reply this many times
+MAX_CONTINUATIONS = 2
+# Bump whenever the prompt text changes, so cached plans from the old prompt are not reused
+PROMPT_VERSION = '8'
+
+# Plans longer than this are generated as concurrent weekly chunks
+CHUNK_DAYS = 7
+ANALYSIS_MAX_TOKENS = 4000
+AFTERCARE_MAX_TOKENS = 2000
+
+# Banner written by _write_plan_header, stripped when a saved plan is read back
+SAVED_PLAN_HEADER_PATTERN = re.compile(r'\A=+\nPERSONAL NUTRITION PLAN\n=+\n\n(?:Generated: .*\n)?(?:Client: .*\n)?\n?')
+CHUNK_MARKER_PATTERN = re.compile(r'^\s*===\s*(MEAL PLAN|RECIPES|SHOPPING LIST)\s*===\s*$', re.MULTILINE)
+
+# Static instructions shared by every request. Sent as a cached system prefix,
+# so nothing client-specific belongs here (that goes in the user message).
+SYSTEM_PROMPT = """You are an expert nutritionist and meal planning specialist. You create comprehensive, personalised nutrition plans based on the client information you are given.
+
+IMPORTANT: Use British English spelling throughout (optimise, colour, fibre, etc.) and UK currency (£).
+
+Each client's profile, goals, dietary requirements and practical constraints are given in their message. For every client:
+- CRITICAL: Muscle preservation is paramount. Their protein target is set to maintain lean muscle mass.
+- Their daily calorie and macro targets are calculated for you and given in their message as DAILY TARGETS. Plan to them exactly and don't recalculate them; only if none are given, calculate optimal daily targets to reach their ideal weight healthily
+
+A comprehensive nutrition plan includes the six sections below. The shopping list (section 4) is totalled from your recipes, and sections 5 and 6 are general guidance added to every plan from our own templates, so NEVER write those sections yourself. You write sections 1 to 3 followed by the PERSONAL NOTES, which carry the parts of that guidance that are specific to the client.
+
+1. **NUTRITIONAL ANALYSIS**
+   - Their daily calorie target and macro split (protein/carbs/fats in grams and percentages), as given
+   - Why protein is prioritised to preserve muscle mass
+   - Clear explanation of the nutritional strategy and why it works for their goals
+   - Context about their journey and what to expect
+
+2. **N-DAY MEAL PLAN** (where N is the client's plan duration in days)
+   - Complete meal plan for every day of the plan
+   - Format each day clearly with "DAY 1:", "DAY 2:", etc. as headers
+   - Each day should include all meals (breakfast, lunch, dinner, snacks as needed)
+   - Include portion sizes and the calories and macros of each meal, so that each day's meals add up to the daily targets
+   - Keep recipes within their cooking skill level and time constraints
+   - Consider budget constraints
+   - Use British spelling and terminology
+
+3. **RECIPES**
+   - Detailed recipes for each unique meal mentioned in the meal plan
+   - Clearly label each recipe with its name as a header (use ** for bold)
+   - The number of servings it makes, e.g. "Serves: 2"
+   - Ingredients with quantities for the whole recipe (use metric where possible) - the shopping list is totalled from these
+   - Step-by-step cooking instructions
+   - Prep time and cook time
+   - Nutritional information (calories, protein, carbs, fats)
+   - Use British spelling (e.g., courgette not zucchini, aubergine not eggplant)
+
+4. **SHOPPING LIST** (added from your recipes - do not write)
+   - Every recipe ingredient totalled over the plan, by category, with an estimated cost against their budget
+
+5. **MEAL PREP GUIDE** (added from templates - do not write)
+   - Daily, batch or mixed prep strategy, storage and reheating, batch cooking suggestions
+
+6. **ADDITIONAL TIPS & ADVICE** (added from templates - do not write)
+   - Hydration, eating out, adjusting portions, signs of progress, staying consistent, bad days
+
+**PERSONAL NOTES** (always write this after section 3, starting with the heading line "## PERSONAL NOTES")
+   - "### Supplements" - supplement suggestions if appropriate for their goals and diet type (be specific and explain why), or a sentence explaining why none are needed
+   - "### A Note for You" - two or three short paragraphs of warm, personal encouragement that refer to their specific goal, starting point, constraints and preferences
+   - Keep it focused: don't repeat general meal prep, hydration or eating-out advice
+
+UNITS AND INGREDIENTS:
+- Give weights in grams or kilograms and liquids in millilitres or litres; use teaspoons (tsp) and tablespoons (tbsp) for small amounts
+- Give calories as kcal and macros in grams, per meal and as a daily total
+- Use ingredients available in UK supermarkets, and British names for them (coriander not cilantro, prawns not shrimp, spring onions not scallions, single/double cream not light/heavy cream)
+- Never include any ingredient the client is allergic to, including in sauces, stocks and garnishes, and avoid the foods they dislike
+- Reuse ingredients across meals where sensible to reduce waste and cost, and keep the total within the client's weekly budget
+
+FORMATTING (the plan is converted to a PDF, so keep to these conventions):
+- Start each numbered section with a markdown heading on its own line, e.g. "## 1. NUTRITIONAL ANALYSIS", "## 3. RECIPES"
+- Start each day of the meal plan with its own header line, e.g. "**DAY 1:**", and leave a blank line between days
+- Give each meal in a day its own line beginning with the meal name in bold followed by a colon and ending with its macros, e.g. "**Breakfast:** Overnight Oats with Berries - 450 kcal, P 30g / C 50g / F 12g"
+- Start each recipe with its name alone on one line in bold with no colon, e.g. "**Overnight Oats with Berries**", followed directly by its details, and leave one blank line after each recipe
+- Inside a recipe, put "Ingredients:" and "Method:" on lines of their own, write each ingredient as a "-" line starting with its quantity, e.g. "- 200g chicken breast", "- 1 tbsp olive oil", "- 2 eggs", and number the method steps
+- Use "-" for bullet points elsewhere, and use bold sparingly for emphasis within sentences
+- Do not use tables, code blocks or horizontal rules
+
+Make every plan practical, achievable, and tailored specifically to the client's needs. Use a warm, encouraging, and supportive tone throughout - this is a premium service and should feel personalised and caring. Write as if you're speaking directly to them, not about them. Use British English spelling throughout."""
+
+# Defaults applied to blank answers, matching the interactive prompts
+PROFILE_DEFAULTS = {
+    'dietary_type': 'omnivore',
+    'allergies': '',
+    'dislikes': '',
+    'preferences': '',
+    'activity_level': 'Moderately active',
+    'goal': 'General health & wellness',
+    'cooking_skill': 'Intermediate',
+    'prep_time': '30',
+    'meals_per_day': '3',
+    'plan_duration': '7',
+    'meal_prep_style': 'mixed',
+}
+
+REQUIRED_PROFILE_FIELDS = ['name', 'age', 'gender', 'height', 'weight', 'ideal_weight', 'budget']
+
+# Every profile field that reaches the prompt, and so identifies a cached plan
+PROMPT_FIELDS = [
+    'name', 'age', 'gender', 'height', 'weight', 'ideal_weight', 'activity_level', 'goal',
+    'dietary_type', 'allergies', 'dislikes', 'preferences', 'budget', 'cooking_skill',
+    'prep_time', 'meals_per_day', 'plan_duration', 'meal_prep_style',
+]
+
+
+def normalise_profile(profile):
+    """Return a copy of a client profile with defaults applied, raising ValueError if incomplete"""
+    user_data = dict(PROFILE_DEFAULTS)
+    for key, value in profile.items():
+        value = '' if value is None else str(value).strip()
+        if value or key not in PROFILE_DEFAULTS:
+            user_data[key] = value
+
+    missing = [field for field in REQUIRED_PROFILE_FIELDS if not user_data.get(field)]
+    if missing:
+        raise ValueError(f"Profile is missing required fields: {', '.join(missing)}")
+
+    user_data['gender'] = user_data['gender'].upper()
+    if user_data['gender'] not in ['M', 'F']:
+        raise ValueError(f"Gender must be M or F, got {user_data['gender']!r}")
+
+    return user_data
+
+
+def message_text(message):
+    """The text of an API response, joined across its text blocks"""
+    return ''.join(block.text for block in message.content if block.type == 'text')
+
+
+def combine_usage(usages):
+    """Sum the token usage of several API responses into one usage object"""
+    from anthropic.types import Usage
+    totals = [summarise_usage(usage) for usage in usages]
+    return Usage(**{key: sum(total[key] for total in totals) for key in totals[0]})
+
+
+def complete_plan(plan_text, user_data, prices=DEFAULT_PRICES, library=None):
+    """
+    Finish a generated plan locally
+
+    Recipes named by library ID are filled in from the library (if given),
+    then the shopping list and the templated aftercare sections are added.
+    """
+    if library is not None:
+        plan_text = expand_recipe_references(plan_text, library)
+    return merge_aftercare(add_shopping_list(plan_text, user_data, prices), user_data)
+
+
+def continuation_request(request, partial_text):
+    """
+    Request arguments that resume a reply cut off at max_tokens
+
+    The partial reply is sent back as the start of the assistant turn, which
+    the model carries on from. The API rejects an assistant turn ending in
+    whitespace, so that is trimmed; the model writes it again.
+    """
+    continued = dict(request)
+    continued['messages'] = request['messages'] + [{"role": "assistant", "content": partial_text.rstrip()}]
+    return continued
+
+
+def _plan_kind(plan):
+    """How a generation ended, for metrics: 'structured', 'text' or None if it failed"""
+    if isinstance(plan, dict):
+        return 'structured'
+    return 'text' if plan else None
+
+
+def load_plan(path):
+    """
+    Read a saved plan back in, e.g. to render it again
+
+    Returns:
+        Structured plan dict for a .json file, otherwise the plan text without
+        the banner save_plan writes at the top
+
+    Raises:
+        ValueError: if a structured plan is malformed
+    """
+    with open(path) as f:
+        if path.lower().endswith('.json'):
+            return validate_plan_data(json.load(f))
+        return SAVED_PLAN_HEADER_PATTERN.sub('', f.read(), count=1)
+
+
+def summarise_usage(usage):
+    """Token counts from a message's usage as a plain dict, treating missing cache counts as zero"""
+    if usage is None:
+        # Plan served from the local plan cache, so no API tokens were used
+        return {'input_tokens': 0, 'output_tokens': 0, 'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0}
+    return {
+        'input_tokens': usage.input_tokens or 0,
+        'output_tokens': usage.output_tokens or 0,
+        'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+        'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0,
+    }
+
+
+def message_metrics(message, seconds):
+    """Token usage, stop reason and output throughput of an API response, as flat metrics fields"""
+    metrics = summarise_usage(message.usage)
+    metrics['stop_reason'] = message.stop_reason
+    metrics['output_tokens_per_second'] = round(metrics['output_tokens'] / seconds, 1) if seconds else None
+    return metrics
+
 
 class NutritionPlanGenerator:
-    def __init__(self):
+    def __init__(self, cache=None, max_continuations=MAX_CONTINUATIONS, retry=None, hedge=None, prices=None,
+                 library=None):
         self.client = None
-        self.user_data = {}
+        self.async_client = None
+        # Optional PlanCache of previously generated plans (and past token usage)
+        self.cache = cache
+        self.max_continuations = max_continuations
+        # Retries (RetryPolicy, on by default) and optional hedging (HedgePolicy) of API requests
+        self.request_runner = RequestRunner(retry, hedge)
+        # Shopping list prices per unit (see shopping_list.load_price_table)
+        self.prices = prices or DEFAULT_PRICES
+        # Optional RecipeLibrary: known recipes are offered by ID and new ones learnt from each plan
+        self.library = library
 
-    def setup_api(self):
-        """Initialise Anthropic API client"""
+    def setup_api(self, interactive=True):
+        """Initialise Anthropic API clients"""
         api_key = os.environ.get('ANTHROPIC_API_KEY')
         if not api_key:
+            if not interactive:
+                raise ValueError("ANTHROPIC_API_KEY must be set to generate nutrition plans")
             print("\n⚠️  ANTHROPIC_API_KEY not found in environment variables.")
             api_key = input("Please enter your Anthropic API key: ").strip()
             if not api_key:
                 raise ValueError("API key is required to generate nutrition plans")
 
-        self.client = Anthropic(api_key=api_key)
+        # The SDK takes longer to import than everything else here, so runs
+        # that never call the API (validate, render) don't pay for it
+        from anthropic import Anthropic, AsyncAnthropic
+
+        # Retries are done by self.request_runner, with jitter and hedging, not by the SDK
+        self.client = Anthropic(api_key=api_key, max_retries=0)
+        self.async_client = AsyncAnthropic(api_key=api_key, max_retries=0)
         print("✅ API client initialised\n")
 
     def collect_user_info(self):
-        """Collect user information through CLI prompts"""
+        """Collect user information through CLI prompts and return it as a profile dict"""
+        user_data = {}
         print("=" * 60)
         print("🥗 PERSONAL NUTRITION PLAN GENERATOR")
         print("=" * 60)
@@ -37,21 +295,21 @@ class NutritionPlanGenerator:
         # Personal Information
         print("📋 PERSONAL INFORMATION")
         print("-" * 60)
-        self.user_data['name'] = input("What's your name? ").strip()
-        self.user_data['age'] = input("Age: ").strip()
+        user_data['name'] = input("What's your name? ").strip()
+        user_data['age'] = input("Age: ").strip()
 
         # Gender - M or F only
         while True:
             gender = input("Gender (M/F): ").strip().upper()
             if gender in ['M', 'F']:
-                self.user_data['gender'] = gender
+                user_data['gender'] = gender
                 break
             else:
                 print("Please enter M or F")
 
-        self.user_data['height'] = input("Height (e.g., 5'10\" or 178cm): ").strip()
-        self.user_data['weight'] = input("Current weight (e.g., 165lbs or 75kg): ").strip()
-        self.user_data['ideal_weight'] = input("Ideal weight (e.g., 155lbs or 70kg): ").strip()
+        user_data['height'] = input("Height (e.g., 5'10\" or 178cm): ").strip()
+        user_data['weight'] = input("Current weight (e.g., 165lbs or 75kg): ").strip()
+        user_data['ideal_weight'] = input("Ideal weight (e.g., 155lbs or 70kg): ").strip()
 
         # Activity Level
         print("\n🏃 ACTIVITY LEVEL")
@@ -69,7 +327,7 @@ class NutritionPlanGenerator:
             '4': 'Very active',
             '5': 'Extra active'
         }
-        self.user_data['activity_level'] = activity_map.get(activity_choice, 'Moderately active')
+        user_data['activity_level'] = activity_map.get(activity_choice, 'Moderately active')
 
         # Goals
         print("\n🎯 NUTRITION GOALS")
@@ -85,20 +343,20 @@ class NutritionPlanGenerator:
             '3': 'Muscle gain / bulking',
             '4': 'General health & wellness'
         }
-        self.user_data['goal'] = goal_map.get(goal_choice, 'General health & wellness')
+        user_data['goal'] = goal_map.get(goal_choice, 'General health & wellness')
 
         # Dietary Requirements
         print("\n🚫 DIETARY REQUIREMENTS & RESTRICTIONS")
         print("-" * 60)
-        self.user_data['dietary_type'] = input("Diet type (e.g., omnivore, vegetarian, vegan, pescatarian): ").strip() or "omnivore"
-        self.user_data['allergies'] = input("Any allergies? (comma-separated): ").strip()
-        self.user_data['dislikes'] = input("Foods you dislike or want to avoid: ").strip()
-        self.user_data['preferences'] = input("Cuisine preferences (e.g., Mediterranean, Asian, Mexican): ").strip()
+        user_data['dietary_type'] = input("Diet type (e.g., omnivore, vegetarian, vegan, pescatarian): ").strip() or "omnivore"
+        user_data['allergies'] = input("Any allergies? (comma-separated): ").strip()
+        user_data['dislikes'] = input("Foods you dislike or want to avoid: ").strip()
+        user_data['preferences'] = input("Cuisine preferences (e.g., Mediterranean, Asian, Mexican): ").strip()
 
         # Practical Constraints
         print("\n💰 PRACTICAL CONSTRAINTS")
         print("-" * 60)
-        self.user_data['budget'] = input("Weekly food budget (e.g., £50, £100): ").strip()
+        user_data['budget'] = input("Weekly food budget (e.g., £50, £100): ").strip()
 
         print("\nCooking skill level:")
         print("1. Beginner (simple recipes)")
@@ -106,41 +364,64 @@ class NutritionPlanGenerator:
         print("3. Advanced (any complexity)")
         skill_choice = input("Select (1-3): ").strip()
         skill_map = {'1': 'Beginner', '2': 'Intermediate', '3': 'Advanced'}
-        self.user_data['cooking_skill'] = skill_map.get(skill_choice, 'Intermediate')
+        user_data['cooking_skill'] = skill_map.get(skill_choice, 'Intermediate')
 
-        self.user_data['prep_time'] = input("Max time for meal prep per day (minutes): ").strip() or "30"
-        self.user_data['meals_per_day'] = input("Meals per day (3-6): ").strip() or "3"
+        user_data['prep_time'] = input("Max time for meal prep per day (minutes): ").strip() or "30"
+        user_data['meals_per_day'] = input("Meals per day (3-6): ").strip() or "3"
 
         # Plan Duration
         print("\n📅 PLAN DETAILS")
         print("-" * 60)
-        self.user_data['plan_duration'] = input("Plan duration in days (e.g., 7 for one week): ").strip() or "7"
-        self.user_data['meal_prep_style'] = input("Meal prep preference (daily/batch/mixed): ").strip() or "mixed"
+        user_data['plan_duration'] = input("Plan duration in days (e.g., 7 for one week): ").strip() or "7"
+        user_data['meal_prep_style'] = input("Meal prep preference (daily/batch/mixed): ").strip() or "mixed"
 
         print("\n✅ All information collected!\n")
+        return user_data
+
+    def generate_nutrition_plan(self, user_data, refresh=False, structured=False):
+        """
+        Generate nutrition plan using Claude API, or reuse a cached plan unless refresh is set
+
+        With structured set, the plan is requested as JSON through a tool call
+        and returned as a dict (see structured_plan), which save_plan and
+        generate_pdf accept in place of text. Long plans, and any structured
+        request that fails, fall back to the text plan.
+
+        The whole run is recorded as a 'generate' span (see instrumentation).
+        """
+        with instrumentation.span('generate', days=self._plan_days(user_data), structured=structured) as fields:
+            plan = self._generate_plan(user_data, refresh, structured)
+            fields['result'] = _plan_kind(plan)
+            fields['off_target_days'] = self.check_macros(plan, user_data)
+        return plan
+
+    def _generate_plan(self, user_data, refresh, structured):
+        """generate_nutrition_plan, without the span around it"""
+        if structured and not self._is_long_plan(user_data):
+            plan = self._generate_structured_plan(user_data, refresh)
+            if plan is not None:
+                return plan
+            print("↩️  Falling back to a text plan...\n")
+
+        cached = self._get_cached_plan(user_data, refresh)
+        if cached is not None:
+            return cached
 
-    def generate_nutrition_plan(self):
-        """Generate nutrition plan using Claude API"""
         print("🤖 Generating your personalised nutrition plan...")
         print("⏳ This may take a moment...\n")
 
-        # Build the prompt
-        prompt = self._build_nutrition_prompt()
-
-        # Call Claude API
         try:
-            message = self.client.messages.create(
-                model="claude-sonnet-4-5-20250929",
-                max_tokens=16000,
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }]
-            )
-
-            nutrition_plan = message.content[0].text
-            self.user_data['generated_plan'] = nutrition_plan
+            if self._is_long_plan(user_data):
+                print(f"📆 Long plan: generating {CHUNK_DAYS}-day chunks in parallel...")
+                nutrition_plan, _ = asyncio.run(self.generate_long_plan_async(user_data))
+            else:
+                text, usage = self._complete(user_data, self._build_request(user_data), 'plan')
+                nutrition_plan = complete_plan(text, user_data, self.prices, self.library)
+                usage = summarise_usage(usage)
+                print(f"💾 Prompt cache: {usage['cache_read_input_tokens']} tokens read, "
+                      f"{usage['cache_creation_input_tokens']} written")
 
+            self._store_plan(user_data, nutrition_plan)
             print("✅ Nutrition plan generated successfully!\n")
             return nutrition_plan
 
@@ -148,128 +429,828 @@ class NutritionPlanGenerator:
             print(f"❌ Error generating nutrition plan: {e}")
             return None
 
-    def _build_nutrition_prompt(self):
-        """Build the prompt for Claude to generate nutrition plan"""
-        prompt = f"""You are an expert nutritionist and meal planning specialist. Create a comprehensive, personalised nutrition plan based on the following client information.
+    def generate_nutrition_plan_streaming(self, user_data, output_dir=None, make_pdf=True, refresh=False):
+        """
+        Stream a nutrition plan, writing the text file and parsing PDF content as tokens arrive
 
-IMPORTANT: Use British English spelling throughout (optimise, colour, fibre, etc.) and UK currency (£).
+        A cached plan for the same profile is replayed through the same
+        pipeline instead, unless refresh is set.
+
+        Returns:
+            Dict with the plan text, output paths, token usage, whether it
+            came from the cache, and timings in seconds: time_to_first_byte,
+            generation_seconds and time_to_pdf (all from the start of the
+            request), plus pdf_after_last_token
+        """
+        with instrumentation.span('generate', days=self._plan_days(user_data), streaming=True) as fields:
+            result = self._stream_plan(user_data, output_dir, make_pdf, refresh)
+            fields['result'] = _plan_kind(result['plan'])
+            fields['off_target_days'] = self.check_macros(result['plan'], user_data)
+            fields.update((key, result[key]) for key in
+                          ['cached', 'time_to_first_byte', 'generation_seconds', 'time_to_pdf'])
+        return result
+
+    def _stream_plan(self, user_data, output_dir, make_pdf, refresh):
+        """generate_nutrition_plan_streaming, without the span around it"""
+        cached = self._get_cached_plan(user_data, refresh)
+        if cached is None:
+            print("🤖 Streaming your personalised nutrition plan...")
+
+        result = {'plan': None, 'text_path': None, 'pdf_path': None, 'usage': None, 'cached': cached is not None,
+                  'time_to_first_byte': None, 'generation_seconds': None,
+                  'time_to_pdf': None, 'pdf_after_last_token': None}
+        renderer = None
+        pdf_path = None
+        started = time.perf_counter()
+
+        try:
+            text_path = self._reserve_output_path(user_data, '.txt', output_dir)
+            if make_pdf:
+                pdf_path = self._reserve_output_path(user_data, '.pdf', output_dir)
+                from pdf_generator import StreamingPlanPDF
+                renderer = StreamingPlanPDF(pdf_path, user_data)
+
+            chunks = []
+            messages = []
+            with open(text_path, 'w') as f:
+                self._write_plan_header(f, user_data)
+                if cached is None:
+                    text_stream = self._stream_continued(user_data, self._build_request(user_data), messages)
+                else:
+                    text_stream = [cached]
+
+                def emit(text, static=False):
+                    nonlocal renderer
+                    chunks.append(text)
+                    f.write(text)
+                    f.flush()
+
+                    if renderer:
+                        try:
+                            if static:
+                                renderer.feed_static_section(text)
+                            else:
+                                renderer.feed(text)
+                        except Exception as e:
+                            print(f"⚠️  PDF generation failed: {e}")
+                            renderer = None
+
+                # Work line by line so the shopping list and templated aftercare
+                # sections can be slotted in when the model reaches its personal notes
+                aftercare_added = cached is not None
+                # Library recipes named by ID are expanded as their lines arrive
+                in_recipes = False
+
+                def add_shopping_list():
+                    # Totalled from the recipes streamed so far, unless the plan has one.
+                    # Fed as ordinary text: every plan's list differs, so caching its flowables won't pay
+                    if not SHOPPING_HEADING_PATTERN.search(''.join(chunks)):
+                        emit(shopping_section(''.join(chunks), user_data, self.prices))
+                        emit('\n\n')
+
+                def emit_line(line, ending='\n'):
+                    nonlocal aftercare_added, in_recipes
+                    if self.library is not None and cached is None:
+                        if RECIPES_HEADING_PATTERN.match(line):
+                            in_recipes = True
+                        elif in_recipes and NEXT_SECTION_PATTERN.match(line):
+                            in_recipes = False
+                        elif in_recipes:
+                            line = expand_recipe_lines(line, self.library)
+                    if not aftercare_added and PERSONAL_NOTES_PATTERN.match(line):
+                        add_shopping_list()
+                        emit(render_aftercare(user_data), static=True)
+                        emit('\n\n')
+                        aftercare_added = True
+                        return
+                    if not aftercare_added and MEAL_PREP_HEADING_PATTERN.match(line):
+                        add_shopping_list()
+                        aftercare_added = True
+                    emit(line + ending)
+
+                partial_line = ""
+                for text in text_stream:
+                    if result['time_to_first_byte'] is None:
+                        result['time_to_first_byte'] = time.perf_counter() - started
+
+                    lines = (partial_line + text).split('\n')
+                    partial_line = lines.pop()
+                    for line in lines:
+                        emit_line(line)
+
+                if partial_line:
+                    emit_line(partial_line, ending='')
+                if not aftercare_added:
+                    emit('\n\n')
+                    add_shopping_list()
+                    emit(render_aftercare(user_data), static=True)
+                    emit('\n')
+
+                if messages:
+                    result['usage'] = summarise_usage(combine_usage([message.usage for message in messages]))
+            result['generation_seconds'] = time.perf_counter() - started
+            result['plan'] = ''.join(chunks)
+            if cached is None:
+                self._store_plan(user_data, result['plan'])
+            result['text_path'] = text_path
+            print(f"✅ Text plan saved to: {os.path.basename(text_path)}")
+
+        except Exception as e:
+            print(f"❌ Error generating nutrition plan: {e}")
+            if pdf_path and os.path.exists(pdf_path):
+                os.remove(pdf_path)
+            return result
+
+        if renderer:
+            try:
+                result['pdf_path'] = renderer.finish()
+                result['time_to_pdf'] = time.perf_counter() - started
+                result['pdf_after_last_token'] = result['time_to_pdf'] - result['generation_seconds']
+                print(f"✅ PDF saved to: {os.path.basename(result['pdf_path'])}")
+            except Exception as e:
+                print(f"⚠️  PDF generation failed: {e}")
+                print("   (Text version is still available)")
+
+        print(f"⏱️  First byte after {result['time_to_first_byte'] or 0:.2f}s, "
+              f"last token after {result['generation_seconds']:.2f}s")
+        if result['time_to_pdf'] is not None:
+            print(f"⏱️  PDF ready after {result['time_to_pdf']:.2f}s "
+                  f"({result['pdf_after_last_token']:.2f}s after the last token)")
+        return result
+
+    async def request_plan_async(self, user_data, refresh=False, structured=False):
+        """
+        Generate a nutrition plan on the shared async client
+
+        Safe to run many times concurrently: all per-run state lives in
+        user_data and the returned values, never on the generator.
+
+        Returns:
+            Tuple of (plan, usage) where the plan is text, or a structured
+            plan dict if structured was requested and succeeded, and usage is
+            the API token usage, or None if the plan came from the plan cache
+        """
+        with instrumentation.span('generate', days=self._plan_days(user_data), structured=structured) as fields:
+            plan, usage = await self._request_plan_async(user_data, refresh, structured)
+            fields['result'] = _plan_kind(plan)
+            fields['off_target_days'] = await asyncio.to_thread(self.check_macros, plan, user_data)
+        return plan, usage
+
+    async def _request_plan_async(self, user_data, refresh, structured):
+        """
+        request_plan_async, without the span around it
+
+        Local work (plan cache and recipe library lookups, usage history,
+        shopping lists) runs in threads, so concurrent plans on the same event
+        loop only ever wait on each other's API requests.
+        """
+        if structured and not self._is_long_plan(user_data):
+            cached = await asyncio.to_thread(self._get_cached_plan, user_data, refresh, True)
+            if cached is not None:
+                return cached, None
+            try:
+                request = await asyncio.to_thread(self._build_structured_request, user_data)
+                message = await self._create_message_async(request, 'structured')
+                await asyncio.to_thread(self._record_usage, user_data, 'structured', None, message.usage.output_tokens)
+                plan = await asyncio.to_thread(self._read_structured_plan, message, user_data)
+                await asyncio.to_thread(self._store_plan, user_data, plan, True)
+                return plan, message.usage
+            except Exception as e:
+                print(f"⚠️  Structured plan for {user_data['name']} failed ({e}), falling back to text")
+
+        cached = await asyncio.to_thread(self._get_cached_plan, user_data, refresh)
+        if cached is not None:
+            return cached, None
+
+        if self._is_long_plan(user_data):
+            plan, usage = await self.generate_long_plan_async(user_data)
+        else:
+            request = await asyncio.to_thread(self._build_request, user_data)
+            text, usage = await self._complete_async(user_data, request, 'plan')
+            plan = await asyncio.to_thread(complete_plan, text, user_data, self.prices, self.library)
+
+        await asyncio.to_thread(self._store_plan, user_data, plan)
+        return plan, usage
+
+    def _stream_continued(self, user_data, request, messages):
+        """
+        Yield the text of a streamed plan, resuming it in a new stream while it stops at max_tokens
+
+        Trailing whitespace is held back until more text follows, because a
+        continuation drops it from the partial assistant turn and the model
+        writes it again. Each stream's final message is appended to messages
+        and recorded as an 'api_request' span.
+        """
+        text = ''
+        for continuation in range(self.max_continuations + 1):
+            if continuation:
+                print(f"\n✂️  Plan hit the token limit, continuing ({continuation}/{self.max_continuations})...")
+            started = time.perf_counter()
+            first_token = None
+            held = ''
+            arguments = continuation_request(request, text) if continuation else request
+            with self.request_runner.stream(self.client, arguments, 'stream') as stream:
+                for chunk in stream.text_stream:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    chunk = held + chunk
+                    released = chunk.rstrip()
+                    held = chunk[len(released):]
+                    if released:
+                        text += released
+                        yield released
+                message = stream.get_final_message()
+
+            seconds = time.perf_counter() - started
+            messages.append(message)
+            instrumentation.emit('span', name='api_request', kind='stream', model=MODEL,
+                                 max_tokens=request['max_tokens'], continuation=continuation,
+                                 seconds=round(seconds, 4), time_to_first_token=first_token,
+                                 **message_metrics(message, seconds - (first_token or 0)))
+            if message.stop_reason != 'max_tokens':
+                if held:
+                    yield held
+                break
+        else:
+            print(f"\n⚠️  Plan for {user_data['name']} is still cut off after "
+                  f"{self.max_continuations} continuations; it may be incomplete")
+
+        self._record_usage(user_data, 'plan', None, sum(message.usage.output_tokens for message in messages))
+
+    def _cache_key(self, user_data, structured=False):
+        """
+        Content address of a plan: its prompt fields, model and prompt version,
+        plus the prices its shopping list is worked out from and the library recipes the prompt offers
+        """
+        fields = {field: user_data.get(field, '') for field in PROMPT_FIELDS}
+        prompt_version = f"{PROMPT_VERSION}-structured" if structured else PROMPT_VERSION
+        recipes = self.library.suitable(user_data) if self.library is not None else []
+        context = {'prices': prices_digest(self.prices), 'recipes': [recipe_id for recipe_id, _, _ in recipes]}
+        return make_cache_key(fields, MODEL, prompt_version, context)
+
+    def _get_cached_plan(self, user_data, refresh=False, structured=False):
+        """Return a previously generated plan for this profile, if caching is on and refresh isn't forced"""
+        if self.cache is None or refresh:
+            return None
+        plan = self.cache.get(self._cache_key(user_data, structured))
+        if plan is not None:
+            print(f"⚡ Reusing cached plan for {user_data['name']} (use --refresh to regenerate)")
+            instrumentation.emit('plan_cache_hit', structured=structured)
+            if structured:
+                plan = json.loads(plan)
+        return plan
+
+    def check_macros(self, plan, user_data):
+        """
+        Check each day's meals in a plan against the client's daily targets, printing the days that are off
+
+        Returns:
+            Number of days off target, or None if the plan has no meal macros
+            or the targets can't be calculated from the profile
+        """
+        if not plan:
+            return None
+        try:
+            report = check_plan_macros(plan, compute_targets(user_data))
+        except ValueError:
+            return None
+        if not report.days_checked:
+            return None
+        if report.off_target:
+            print(f"⚠️  {len(report.off_target)} of {report.days_checked} days are off {user_data['name']}'s daily targets:")
+            for day in report.off_target[:5]:
+                print(f"   {describe_day(day)}")
+            if len(report.off_target) > 5:
+                print(f"   ...and {len(report.off_target) - 5} more")
+        return len(report.off_target)
+
+    def _store_plan(self, user_data, plan, structured=False):
+        """Remember a freshly generated plan for identical profiles, and learn its recipes"""
+        if not plan:
+            return
+        # Keyed before learning the plan's recipes, which changes the ones the library offers
+        key = self._cache_key(user_data, structured) if self.cache is not None else None
+        if self.library is not None:
+            self.library.add_from_plan(plan)
+        if key is not None:
+            self.cache.put(key, json.dumps(plan) if structured else plan)
+
+    def _generate_structured_plan(self, user_data, refresh=False):
+        """Request the plan as JSON through the plan tool, returning the plan dict or None if that fails"""
+        cached = self._get_cached_plan(user_data, refresh, structured=True)
+        if cached is not None:
+            return cached
+
+        print("🤖 Generating your personalised nutrition plan (structured)...")
+        print("⏳ This may take a moment...\n")
+        try:
+            message = self._create_message(self._build_structured_request(user_data), 'structured')
+            self._record_usage(user_data, 'structured', None, message.usage.output_tokens)
+            plan = self._read_structured_plan(message, user_data)
+        except Exception as e:
+            print(f"⚠️  Structured plan failed: {e}")
+            return None
+
+        usage = summarise_usage(message.usage)
+        print(f"💾 Prompt cache: {usage['cache_read_input_tokens']} tokens read, "
+              f"{usage['cache_creation_input_tokens']} written")
+        self._store_plan(user_data, plan, structured=True)
+        print("✅ Nutrition plan generated successfully!\n")
+        return plan
+
+    def _read_structured_plan(self, message, user_data):
+        """
+        Pull the validated plan dict out of a plan tool call, raising ValueError if there isn't a usable one
+
+        Library recipes are filled in and the shopping list totalled from the
+        recipes here, and kept with the plan.
+        """
+        if message.stop_reason == 'max_tokens':
+            raise ValueError("the plan was cut off at the token limit")
+        for block in message.content:
+            if block.type == 'tool_use' and block.name == PLAN_TOOL_NAME:
+                plan = validate_plan_data(block.input)
+                if self.library is not None:
+                    expand_structured_recipes(plan, self.library)
+                plan.setdefault('shopping_list', structured_shopping_list(plan, user_data, self.prices))
+                return plan
+        raise ValueError("no plan tool call in the response")
+
+    async def generate_long_plan_async(self, user_data):
+        """
+        Generate a multi-week plan as concurrent weekly chunks
+
+        One short request writes the nutritional analysis first, so every
+        chunk is given the same calorie and macro targets. The weekly chunks
+        and the personal notes are then generated concurrently and stitched,
+        with the templated aftercare sections, into the usual six-section layout.
+
+        Returns:
+            Tuple of (plan text, combined usage)
+        """
+        request = await asyncio.to_thread(
+            self._build_request, user_data, self._build_analysis_prompt(user_data), ANALYSIS_MAX_TOKENS
+        )
+        analysis, analysis_usage = await self._complete_async(user_data, request, 'analysis')
+        requests = await asyncio.to_thread(self._build_long_plan_requests, user_data, analysis)
+        replies = await asyncio.gather(*[
+            self._complete_async(user_data, request, kind, days) for request, kind, days in requests
+        ])
+
+        chunk_texts = [text for text, _ in replies[:-1]]
+        aftercare = replies[-1][0]
+        plan = await asyncio.to_thread(self._stitch_long_plan, user_data, analysis, chunk_texts, aftercare)
+        return plan, combine_usage([analysis_usage] + [usage for _, usage in replies])
+
+    def _build_long_plan_requests(self, user_data, analysis):
+        """(request, kind, days) for each weekly chunk of a long plan, then for its personal notes"""
+        chunks = self._plan_chunks(user_data)
+        requests = [
+            (self._build_request(
+                user_data, self._build_chunk_prompt(user_data, analysis, start_day, end_day, part, len(chunks)),
+                self._max_tokens_for(user_data, 'chunk', end_day - start_day + 1)
+            ), 'chunk', end_day - start_day + 1)
+            for part, (start_day, end_day) in enumerate(chunks, 1)
+        ]
+        requests.append((self._build_request(
+            user_data, self._build_aftercare_prompt(user_data, analysis), AFTERCARE_MAX_TOKENS
+        ), 'aftercare', None))
+        return requests
+
+    def _plan_days(self, user_data):
+        """Plan duration in days, defaulting to a week if it isn't a number"""
+        try:
+            return max(1, int(str(user_data['plan_duration']).strip()))
+        except ValueError:
+            return 7
+
+    def _is_long_plan(self, user_data):
+        """Whether the plan is long enough to be generated in chunks"""
+        return self._plan_days(user_data) > CHUNK_DAYS
+
+    def _plan_chunks(self, user_data):
+        """Split the plan into (first day, last day) ranges of at most CHUNK_DAYS"""
+        days = self._plan_days(user_data)
+        return [(start, min(start + CHUNK_DAYS - 1, days)) for start in range(1, days + 1, CHUNK_DAYS)]
+
+    def _meals_per_day(self, user_data):
+        """Meals per day, taking the first number given (\"3-4\" counts as 3) and defaulting to 3"""
+        match = re.search(r'\d+', str(user_data.get('meals_per_day', '')))
+        return max(1, int(match.group())) if match else 3
+
+    def _max_tokens_for(self, user_data, kind, days=None):
+        """
+        Size max_tokens for a request from its meal slots and past usage
 
-CLIENT PROFILE:
-- Name: {self.user_data['name']}
-- Age: {self.user_data['age']}, Gender: {self.user_data['gender']}
-- Height: {self.user_data['height']}
-- Current Weight: {self.user_data['weight']}
-- Ideal Weight: {self.user_data['ideal_weight']}
-- Activity Level: {self.user_data['activity_level']}
+        Args:
+            user_data: Dictionary with user information
+            kind: Kind of request, as recorded in the usage history ('plan', 'chunk', 'structured')
+            days: Days the request covers (default: the whole plan)
+
+        Returns:
+            max_tokens, rounded up to a multiple of 500
+        """
+        slots = (days or self._plan_days(user_data)) * self._meals_per_day(user_data)
+        rate = TOKENS_PER_SLOT
+        if self.cache is not None:
+            rates = sorted(tokens / (past_slots + FIXED_SLOTS) for past_slots, tokens in self.cache.usage_history(kind))
+            if len(rates) >= MIN_USAGE_HISTORY:
+                rate = rates[int(0.9 * (len(rates) - 1))]
+        estimate = rate * (slots + FIXED_SLOTS) * MAX_TOKENS_HEADROOM
+        return max(MIN_MAX_TOKENS, min(MAX_MAX_TOKENS, math.ceil(estimate / 500) * 500))
+
+    def _record_usage(self, user_data, kind, days, output_tokens):
+        """Add a completed request's output tokens to the usage history that sizes max_tokens"""
+        if self.cache is not None and kind in ('plan', 'chunk', 'structured'):
+            slots = (days or self._plan_days(user_data)) * self._meals_per_day(user_data)
+            self.cache.record_usage(kind, slots, output_tokens)
+
+    def _build_request(self, user_data, prompt=None, max_tokens=None):
+        """
+        Build the Messages API arguments for one plan (or one part of a chunked plan)
+
+        The static instructions go in a system block marked for prompt
+        caching, so every request shares the same cached prefix and only the
+        small per-client message is new input. max_tokens defaults to an
+        estimate for the whole plan (see _max_tokens_for).
+        """
+        with instrumentation.span('prompt_build') as fields:
+            content = prompt or self._build_nutrition_prompt(user_data)
+            fields['prompt_chars'] = len(content)
+        return {
+            'model': MODEL,
+            'max_tokens': max_tokens or self._max_tokens_for(user_data, 'plan'),
+            'system': [{
+                "type": "text",
+                "text": SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            }],
+            'messages': [{
+                "role": "user",
+                "content": content
+            }]
+        }
+
+    def _create_message(self, request, kind, continuation=0):
+        """Send one Messages API request, recording it as an 'api_request' span with its usage and stop reason"""
+        with instrumentation.span('api_request', kind=kind, model=request['model'],
+                                  max_tokens=request['max_tokens'], continuation=continuation) as fields:
+            started = time.perf_counter()
+            message = self.request_runner.create(self.client, request, kind)
+            fields.update(message_metrics(message, time.perf_counter() - started))
+        return message
+
+    async def _create_message_async(self, request, kind, continuation=0):
+        """Async counterpart of _create_message, on the shared async client"""
+        with instrumentation.span('api_request', kind=kind, model=request['model'],
+                                  max_tokens=request['max_tokens'], continuation=continuation) as fields:
+            started = time.perf_counter()
+            message = await self.request_runner.create_async(self.async_client, request, kind)
+            fields.update(message_metrics(message, time.perf_counter() - started))
+        return message
+
+    def _complete(self, user_data, request, kind, days=None):
+        """
+        Send a text request, resuming it while it stops at max_tokens
+
+        Each continuation sends the reply so far back as a partial assistant
+        turn, up to max_continuations times; a reply still cut off after
+        that is returned with a warning. The output tokens used are recorded
+        for sizing later requests (see _max_tokens_for).
+
+        Args:
+            user_data: Dictionary with user information
+            request: Messages API arguments from _build_request
+            kind: Kind of request, for the metrics and usage history
+            days: Days the request covers, for chunks of a long plan
+
+        Returns:
+            Tuple of (text, combined usage)
+        """
+        message = self._create_message(request, kind)
+        message, text, usages = self._continue_completion(user_data, request, kind, message)
+        return self._finish_completion(user_data, kind, days, message, text, usages)
+
+    def _continue_completion(self, user_data, request, kind, message):
+        """
+        Resume a reply to request while it stops at max_tokens, up to max_continuations times
+
+        Also used for replies that arrived some other way (a Message Batch),
+        as long as request is exactly what produced message.
+
+        Returns:
+            Tuple of (last message, full text, list of every message's usage)
+        """
+        text, usages = message_text(message), [message.usage]
+        for continuation in range(1, self.max_continuations + 1):
+            if message.stop_reason != 'max_tokens':
+                break
+            print(f"✂️  {kind.capitalize()} reply for {user_data['name']} hit the token limit, "
+                  f"continuing ({continuation}/{self.max_continuations})...")
+            text = text.rstrip()
+            message = self._create_message(continuation_request(request, text), kind, continuation)
+            text += message_text(message)
+            usages.append(message.usage)
+        return message, text, usages
+
+    async def _complete_async(self, user_data, request, kind, days=None):
+        """Async counterpart of _complete, on the shared async client"""
+        message = await self._create_message_async(request, kind)
+        text, usages = message_text(message), [message.usage]
+        for continuation in range(1, self.max_continuations + 1):
+            if message.stop_reason != 'max_tokens':
+                break
+            print(f"✂️  {kind.capitalize()} reply for {user_data['name']} hit the token limit, "
+                  f"continuing ({continuation}/{self.max_continuations})...")
+            text = text.rstrip()
+            message = await self._create_message_async(continuation_request(request, text), kind, continuation)
+            text += message_text(message)
+            usages.append(message.usage)
+        return await asyncio.to_thread(self._finish_completion, user_data, kind, days, message, text, usages)
+
+    def _finish_completion(self, user_data, kind, days, message, text, usages):
+        """Warn about a reply still cut off, record its usage and return (text, combined usage)"""
+        if message.stop_reason == 'max_tokens':
+            print(f"⚠️  {kind.capitalize()} reply for {user_data['name']} is still cut off after "
+                  f"{self.max_continuations} continuations; the plan may be incomplete")
+        usage = usages[0] if len(usages) == 1 else combine_usage(usages)
+        self._record_usage(user_data, kind, days, usage.output_tokens)
+        return text, usage
+
+    def _build_structured_request(self, user_data):
+        """Build the Messages API arguments for a plan recorded through the plan tool"""
+        request = self._build_request(
+            user_data, self._build_structured_prompt(user_data), self._max_tokens_for(user_data, 'structured')
+        )
+        request['tools'] = [PLAN_TOOL]
+        request['tool_choice'] = {"type": "tool", "name": PLAN_TOOL_NAME}
+        return request
+
+    def _build_structured_prompt(self, user_data):
+        """Build the per-client message asking Claude to record a plan with the plan tool"""
+        return f"""Please create a comprehensive nutrition plan, with sections 1 to 3 and the personal notes, for the following client, and record it with the {PLAN_TOOL_NAME} tool. The tool's fields replace the formatting conventions, so give plain text without markdown headings or bullet characters.
+
+{self._build_profile_block(user_data)}{self._build_known_recipes_block(user_data, structured=True)}
+
+Plan all {user_data['plan_duration']} days. Keep the ingredients within the {user_data['budget']} weekly budget and tailor everything specifically to {user_data['name']}'s needs."""
+
+    def _build_nutrition_prompt(self, user_data):
+        """Build the per-client message asking Claude for a complete nutrition plan"""
+        prompt = f"""Please create a comprehensive nutrition plan, with sections 1 to 3 and the personal notes, for the following client.
+
+{self._build_profile_block(user_data)}{self._build_known_recipes_block(user_data)}
+
+Head the meal plan section "{user_data['plan_duration']}-DAY MEAL PLAN" and plan all {user_data['plan_duration']} days. Keep the ingredients within the {user_data['budget']} weekly budget and tailor everything specifically to {user_data['name']}'s needs."""
+
+        return prompt
+
+    def _build_analysis_prompt(self, user_data):
+        """Build the message for the shared nutritional analysis of a chunked plan"""
+        return f"""You are writing the opening section of a {user_data['plan_duration']}-day nutrition plan for the following client; the meal plan itself is written separately.
+
+{self._build_profile_block(user_data)}
+
+Write ONLY section 1, starting with the heading "## 1. NUTRITIONAL ANALYSIS". State the daily calorie target and the daily protein, carbohydrate and fat targets in grams as clear single numbers, because every week of the plan will be written to match them."""
+
+    def _build_chunk_prompt(self, user_data, analysis, start_day, end_day, part, parts):
+        """Build the message for one weekly chunk of a long plan"""
+        return f"""You are writing part {part} of {parts} of a {user_data['plan_duration']}-day nutrition plan for the following client: days {start_day} to {end_day}. The other days are being written separately.
+
+{self._build_profile_block(user_data)}{self._build_known_recipes_block(user_data)}
+
+AGREED NUTRITIONAL ANALYSIS (follow these calorie and macro targets exactly so every week of the plan agrees):
+{analysis}
+
+Write ONLY the two parts below, each starting with its marker line exactly as shown. Do not add an introduction, a nutritional analysis, a shopping list, a meal prep guide, tips or a sign-off.
+
+===MEAL PLAN===
+Section 2 for days {start_day} to {end_day} only, continuing the day numbering from "DAY {start_day}:".
+
+===RECIPES===
+Section 3 for each unique meal in days {start_day} to {end_day}."""
+
+    def _build_aftercare_prompt(self, user_data, analysis):
+        """Build the message for the personal notes of a chunked plan"""
+        return f"""You are writing the personal notes that close a {user_data['plan_duration']}-day nutrition plan for the following client; the meal plan itself is written separately.
+
+{self._build_profile_block(user_data)}
+
+AGREED NUTRITIONAL ANALYSIS:
+{analysis}
+
+Write ONLY the personal notes, starting with the heading line "## {PERSONAL_NOTES_HEADING}"."""
+
+    def _stitch_long_plan(self, user_data, analysis, chunk_texts, aftercare):
+        """Join a chunked plan back into the six-section layout the PDF parser expects"""
+        meal_plans, recipes = [], []
+        for text in chunk_texts:
+            parts = self._split_chunk(text)
+            meal_plans.append(parts['MEAL PLAN'])
+            recipes.append(parts['RECIPES'])
+
+        sections = [
+            analysis.strip(),
+            f"## 2. {user_data['plan_duration']}-DAY MEAL PLAN",
+            '\n\n'.join(meal_plans),
+            "## 3. RECIPES",
+            self._dedupe_recipes(recipes),
+            aftercare.strip(),
+        ]
+        # One shopping list for the whole plan, totalled over every week
+        return complete_plan('\n\n'.join(sections), user_data, self.prices, self.library)
+
+    def _split_chunk(self, text):
+        """Split a chunk response on its ===PART=== marker lines"""
+        # A shopping list written despite the prompt is split off and dropped
+        parts = {'MEAL PLAN': '', 'RECIPES': '', 'SHOPPING LIST': ''}
+        pieces = CHUNK_MARKER_PATTERN.split(text)
+        # Anything before the first marker is treated as meal plan
+        parts['MEAL PLAN'] = pieces[0].strip()
+        for name, body in zip(pieces[1::2], pieces[2::2]):
+            parts[name] = (parts[name] + '\n\n' + body.strip()).strip()
+        return parts
+
+    def _dedupe_recipes(self, recipe_texts):
+        """Merge recipe sections from several chunks, keeping the first copy of each recipe"""
+        seen = set()
+        blocks = []
+        for text in recipe_texts:
+            block, key = [], None
+            for line in text.split('\n') + ['**']:
+                stripped = line.strip()
+                title = stripped.strip('*').strip().lower()
+                # Recipe titles are bold lines with no colon, like the PDF parser's rule
+                if (stripped.startswith('**') and stripped.endswith('**') and ':' not in stripped
+                        and title not in RECIPE_SUBHEADINGS):
+                    if block and key not in seen:
+                        blocks.append('\n'.join(block).strip())
+                        if key is not None:
+                            seen.add(key)
+                    block = []
+                    key = title
+                block.append(line)
+        return '\n\n'.join(b for b in blocks if b)
+
+    def _build_profile_block(self, user_data):
+        """Build the client profile and constraints part of the prompt, with the calculated daily targets"""
+        block = f"""CLIENT PROFILE:
+- Name: {user_data['name']}
+- Age: {user_data['age']}, Gender: {user_data['gender']}
+- Height: {user_data['height']}
+- Current Weight: {user_data['weight']}
+- Ideal Weight: {user_data['ideal_weight']}
+- Activity Level: {user_data['activity_level']}
 
 GOALS:
-- Primary Goal: {self.user_data['goal']}
-- CRITICAL: Muscle preservation is paramount. Calculate protein targets to maintain lean muscle mass.
-- Calculate optimal daily calories to reach their ideal weight healthily
+- Primary Goal: {user_data['goal']}
 
 DIETARY REQUIREMENTS:
-- Diet Type: {self.user_data['dietary_type']}
-- Allergies: {self.user_data['allergies'] or 'None'}
-- Foods to Avoid: {self.user_data['dislikes'] or 'None'}
-- Cuisine Preferences: {self.user_data['preferences'] or 'Varied'}
+- Diet Type: {user_data['dietary_type']}
+- Allergies: {user_data['allergies'] or 'None'}
+- Foods to Avoid: {user_data['dislikes'] or 'None'}
+- Cuisine Preferences: {user_data['preferences'] or 'Varied'}
 
 PRACTICAL CONSTRAINTS:
-- Weekly Budget: {self.user_data['budget']}
-- Cooking Skill: {self.user_data['cooking_skill']}
-- Available Prep Time: {self.user_data['prep_time']} minutes per day
-- Meals Per Day: {self.user_data['meals_per_day']}
-- Plan Duration: {self.user_data['plan_duration']} days
-- Meal Prep Style: {self.user_data['meal_prep_style']}
+- Weekly Budget: {user_data['budget']}
+- Cooking Skill: {user_data['cooking_skill']}
+- Available Prep Time: {user_data['prep_time']} minutes per day
+- Meals Per Day: {user_data['meals_per_day']}
+- Plan Duration: {user_data['plan_duration']} days
+- Meal Prep Style: {user_data['meal_prep_style']}"""
 
-Please create a comprehensive nutrition plan that includes:
+        # If the height or weight can't be read, the model works the targets out itself
+        try:
+            return block + "\n\n" + format_targets(compute_targets(user_data))
+        except ValueError:
+            return block
 
-1. **NUTRITIONAL ANALYSIS**
-   - Calculate optimal daily calories based on their current weight, ideal weight, and activity level
-   - Recommended macro split (protein/carbs/fats in grams and percentages)
-   - Prioritise protein to preserve muscle mass (minimum 1.6-2.2g per kg of bodyweight)
-   - Clear explanation of the nutritional strategy and why it works for their goals
-   - Context about their journey and what to expect
+    def _build_known_recipes_block(self, user_data, structured=False):
+        """The library recipes that suit the client, as a block to follow the profile, or '' without a library"""
+        recipes = self.library.suitable(user_data) if self.library is not None else []
+        return "\n\n" + format_known_recipes(recipes, structured) if recipes else ""
 
-2. **{self.user_data['plan_duration']}-DAY MEAL PLAN**
-   - Complete meal plan for {self.user_data['plan_duration']} days
-   - Format each day clearly with "DAY 1:", "DAY 2:", etc. as headers
-   - Each day should include all meals (breakfast, lunch, dinner, snacks as needed)
-   - Include portion sizes and estimated calories/macros per meal
-   - Keep recipes within their cooking skill level and time constraints
-   - Consider budget constraints
-   - Use British spelling and terminology
+    def _reserve_output_path(self, user_data, extension, output_dir=None):
+        """Atomically claim a unique timestamped output path, so concurrent jobs never overwrite each other"""
+        # Add timestamp to make each file unique
+        stem = f"nutrition_plan_{user_data['name'].replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        directory = output_dir or os.getcwd()
+        suffix = ''
+        attempt = 1
+        while True:
+            filepath = os.path.join(directory, f"{stem}{suffix}{extension}")
+            try:
+                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return filepath
+            except FileExistsError:
+                attempt += 1
+                suffix = f"_{attempt}"
 
-3. **RECIPES**
-   - Detailed recipes for each unique meal mentioned in the meal plan
-   - Clearly label each recipe with its name as a header (use ** for bold)
-   - Ingredients with quantities (use metric where possible)
-   - Step-by-step cooking instructions
-   - Prep time and cook time
-   - Nutritional information (calories, protein, carbs, fats)
-   - Use British spelling (e.g., courgette not zucchini, aubergine not eggplant)
+    def _write_plan_header(self, f, user_data):
+        """Write the banner that starts every saved text plan"""
+        f.write("=" * 80 + "\n")
+        f.write("PERSONAL NUTRITION PLAN\n")
+        f.write("=" * 80 + "\n\n")
+        f.write(f"Generated: {datetime.now().strftime('%d %B %Y at %I:%M %p')}\n")
+        f.write(f"Client: {user_data['name']}\n\n")
 
-4. **SHOPPING LIST**
-   - Organised by category (produce, proteins, dairy, pantry, etc.)
-   - Quantities needed for the full {self.user_data['plan_duration']}-day plan
-   - Estimated cost breakdown to stay within {self.user_data['budget']} budget
-   - Money-saving tips for staying within budget
-   - Use UK terminology and £ for prices
-
-5. **MEAL PREP GUIDE**
-   - {self.user_data['meal_prep_style'].capitalize()} meal prep strategy
-   - What to prep in advance to save time during the week
-   - Storage instructions and how long meals keep
-   - Reheating guidelines for best results
-   - Time-saving tips for efficient meal preparation
-   - Batch cooking suggestions
-
-6. **ADDITIONAL TIPS & ADVICE**
-   - Hydration recommendations for optimal performance and recovery
-   - Supplement suggestions if appropriate for their goals (be specific and explain why)
-   - Tips for staying on track when eating out or socialising
-   - How to adjust portions if feeling too hungry or too full
-   - Signs of progress to look for beyond the scales
-   - Encouragement and motivation for staying consistent
-   - What to do if they have a "bad" day
-
-Make this plan practical, achievable, and tailored specifically to {self.user_data['name']}'s needs. Use a warm, encouraging, and supportive tone throughout - this is a premium service and should feel personalised and caring. Write as if you're speaking directly to them, not about them. Use British English spelling throughout."""
+    def write_plan(self, plan, user_data, stream):
+        """Write the text plan (from text or a structured plan dict), header included, to a text stream"""
+        if isinstance(plan, dict):
+            plan = plan_to_text(plan, user_data)
+        self._write_plan_header(stream, user_data)
+        stream.write(plan)
 
-        return prompt
+    def format_plan(self, plan, user_data):
+        """Return the text plan, header included, as a string without touching the filesystem"""
+        buffer = io.StringIO()
+        self.write_plan(plan, user_data, buffer)
+        return buffer.getvalue()
+
+    def save_plan(self, plan, user_data, output_dir=None, filepath=None):
+        """
+        Save the nutrition plan (text or a structured plan dict) to a text file with unique timestamp
 
-    def save_plan(self, plan):
-        """Save the nutrition plan to a text file with unique timestamp"""
+        Pass filepath (from _reserve_output_path) to write to a path reserved earlier instead.
+        """
         if not plan:
             return
 
-        # Add timestamp to make each file unique
-        filename = f"nutrition_plan_{self.user_data['name'].replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        filepath = os.path.join(os.getcwd(), filename)
+        filepath = filepath or self._reserve_output_path(user_data, '.txt', output_dir)
+        filename = os.path.basename(filepath)
 
         # Save plan with user data
         with open(filepath, 'w') as f:
-            f.write("=" * 80 + "\n")
-            f.write("PERSONAL NUTRITION PLAN\n")
-            f.write("=" * 80 + "\n\n")
-            f.write(f"Generated: {datetime.now().strftime('%d %B %Y at %I:%M %p')}\n")
-            f.write(f"Client: {self.user_data['name']}\n\n")
-            f.write(plan)
+            self.write_plan(plan, user_data, f)
 
         print(f"✅ Text plan saved to: {filename}")
         return filepath
 
-    def generate_pdf(self, plan):
-        """Generate a PDF version of the nutrition plan with unique timestamp"""
+    def render_pdf(self, plan, user_data, output=None, theme=None, render_pool=None, stats=None):
+        """
+        Render the plan's PDF to a path or binary stream, or return its bytes if output is None
+
+        Nothing touches the filesystem unless output is a path, so PDFs can be
+        served over HTTP or attached to emails straight from memory.
+
+        Args:
+            plan: Plan text, or a structured plan dict
+            user_data: Dictionary with user information
+            output: Path, writable binary stream, or None for bytes
+            theme: Optional PDFTheme for trainer branding
+            render_pool: Optional RenderPool to lay the PDF out in a worker process
+            stats: Optional dict to fill with the build's page count, time and peak RSS
+
+        Returns:
+            output, or the PDF's bytes if output was None
+        """
+        with instrumentation.span('render', structured=isinstance(plan, dict), pooled=render_pool is not None):
+            return self._render_pdf(plan, user_data, output, theme, render_pool, stats)
+
+    def _render_pdf(self, plan, user_data, output, theme, render_pool, stats):
+        """render_pdf, without the span around it"""
+        if render_pool is not None:
+            if isinstance(output, str):
+                return render_pool.render(plan, user_data, output, theme=theme, stats=stats)
+            data = render_pool.render(plan, user_data, theme=theme, stats=stats)
+            if output is None:
+                return data
+            output.write(data)
+            return output
+
+        # reportlab is only loaded once a PDF is laid out in this process
+        import pdf_generator
+
+        if isinstance(plan, dict):
+            # Structured plans are laid out directly, with no text parsing
+            nodes = plan_to_ir(plan, user_data)
+            if output is None:
+                return pdf_generator.render_nutrition_plan_pdf_from_ir(nodes, user_data, theme=theme, stats=stats)
+            return pdf_generator.create_nutrition_plan_pdf_from_ir(nodes, user_data, output, theme=theme, stats=stats)
+        if output is None:
+            return pdf_generator.render_nutrition_plan_pdf(plan, user_data, theme=theme, stats=stats)
+        return pdf_generator.create_nutrition_plan_pdf(plan, user_data, output, theme=theme, stats=stats)
+
+    def generate_pdf(self, plan, user_data, output_dir=None, theme=None, render_pool=None, filepath=None):
+        """
+        Generate a PDF version of the nutrition plan with unique timestamp, optionally in a trainer's theme
+
+        Pass a RenderPool to lay the PDF out in a worker process instead of
+        this one, and filepath to write to a path reserved earlier.
+        """
         if not plan:
             return None
 
         try:
-            # Add timestamp to make each file unique
-            pdf_filename = f"nutrition_plan_{self.user_data['name'].replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            pdf_filepath = os.path.join(os.getcwd(), pdf_filename)
+            pdf_filepath = filepath or self._reserve_output_path(user_data, '.pdf', output_dir)
+            pdf_filename = os.path.basename(pdf_filepath)
 
             print("📄 Generating PDF...")
-            create_nutrition_plan_pdf(plan, self.user_data, pdf_filepath)
+            stats = {}
+            self.render_pdf(plan, user_data, pdf_filepath, theme=theme, render_pool=render_pool, stats=stats)
             print(f"✅ PDF saved to: {pdf_filename}")
+            print(f"   {stats['pages']} pages in {stats['seconds']:.1f}s" +
+                  (f", {stats['bytes'] / 1024:.0f} KB" if stats.get('bytes') else '') +
+                  (f", peak RSS {stats['peak_rss_mb']:.0f} MB" if stats.get('peak_rss_mb') else ''))
 
             return pdf_filepath
 
@@ -278,23 +1259,35 @@ Make this plan practical, achievable, and tailored specifically to {self.user_da
             print("   (Text version is still available)")
             return None
 
-    def run(self):
+    def run(self, stream=False, refresh=False, structured=False):
         """Main execution flow"""
         try:
             self.setup_api()
-            self.collect_user_info()
-            plan = self.generate_nutrition_plan()
+            user_data = self.collect_user_info()
+
+            if stream:
+                # Streaming renders while generating, so ask about the PDF up front
+                generate_pdf = input("Would you like a PDF version? (y/n): ").strip().lower()
+                result = self.generate_nutrition_plan_streaming(
+                    user_data, make_pdf=generate_pdf in ['y', 'yes'], refresh=refresh
+                )
+                plan = result['plan']
+                text_filepath = result['text_path']
+                pdf_filepath = result['pdf_path']
+            else:
+                plan = self.generate_nutrition_plan(user_data, refresh=refresh, structured=structured)
 
             if plan:
-                text_filepath = self.save_plan(plan)
+                if not stream:
+                    text_filepath = self.save_plan(plan, user_data)
 
-                # Ask about PDF generation
-                print("\n" + "=" * 60)
-                generate_pdf = input("Would you like a PDF version? (y/n): ").strip().lower()
+                    # Ask about PDF generation
+                    print("\n" + "=" * 60)
+                    generate_pdf = input("Would you like a PDF version? (y/n): ").strip().lower()
 
-                pdf_filepath = None
-                if generate_pdf in ['y', 'yes']:
-                    pdf_filepath = self.generate_pdf(plan)
+                    pdf_filepath = None
+                    if generate_pdf in ['y', 'yes']:
+                        pdf_filepath = self.generate_pdf(plan, user_data)
 
                 print("\n" + "=" * 60)
                 print("✨ YOUR NUTRITION PLAN IS READY!")
@@ -316,5 +1309,26 @@ Make this plan practical, achievable, and tailored specifically to {self.user_da
 
 
 if __name__ == "__main__":
-    generator = NutritionPlanGenerator()
-    generator.run()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a personalised nutrition plan")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream the plan, writing the text and building the PDF as it arrives")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Regenerate even if a cached plan exists for an identical profile")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the local plan cache")
+    parser.add_argument('--structured', action='store_true',
+                        help="Request the plan as structured JSON and lay out the PDF from it (text plan as fallback)")
+    parser.add_argument('--no-library', action='store_true',
+                        help="Don't offer known recipes to the model or add this plan's recipes to the library")
+    parser.add_argument('--metrics', default=None,
+                        help="Append span timings, token usage and page counts to this file as JSON lines")
+    args = parser.parse_args()
+    if args.stream and args.structured:
+        parser.error("--structured can't be combined with --stream")
+    if args.metrics:
+        instrumentation.add_hook(instrumentation.JsonLinesWriter(args.metrics))
+
+    generator = NutritionPlanGenerator(cache=None if args.no_cache else PlanCache(),
+                                       library=None if args.no_library else RecipeLibrary())
+    generator.run(stream=args.stream, refresh=args.refresh, structured=args.structured)
@@ -8,89 +8,437 @@ from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, TableStyle,
-    KeepTogether, HRFlowable, ListFlowable, ListItem
+    SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, LongTable, TableStyle,
+    KeepTogether, HRFlowable, ListFlowable, ListItem, Flowable
 )
+from reportlab import rl_config
+from reportlab.lib.fonts import tt2ps
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfbase.ttfonts import TTFont, TTFError
+from reportlab.lib.utils import simpleSplit
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_JUSTIFY, TA_RIGHT
 from reportlab.platypus.doctemplate import PageTemplate, BaseDocTemplate
 from reportlab.platypus.frames import Frame
 from reportlab.pdfgen import canvas
+from collections import namedtuple
+from functools import lru_cache
 from datetime import datetime
+import io
+import os
 import re
+import sys
+import copy
 import html
+import unicodedata
+import time
+import plan_ir
+import instrumentation
+from plan_ir import PlanLexer
+from aftercare_templates import render_aftercare
+
+# Templated sections (per template text and theme) whose flowables are kept for reuse
+STATIC_SECTION_CACHE_SIZE = 64
+
+# Content stream comment marking where a page's "Page X of Y" is filled in
+PAGE_NUMBER_PLACEHOLDER = '%PageNumber'
+
+BOLD_PATTERN = re.compile(r'\*\*([^\*]+)\*\*')
+ITALIC_PATTERN = re.compile(r'\*([^\*]+)\*')
+UNDERSCORE_ITALIC_PATTERN = re.compile(r'_([^_]+)_')
+ESCAPED_TAG_PATTERN = re.compile(r'&lt;(/?[bi])&gt;')
+
+# Symbols base Helvetica has no glyphs for - tick boxes, ticks, arrows, vulgar
+# fractions - are drawn with PlanSymbols, a cut-down DejaVu Sans kept in fonts/
+# (rebuild it with fonts/build_symbol_font.py after changing the characters).
+# reportlab embeds only the glyphs a document uses, so a PDF without symbols
+# carries no font and a typical plan about 2 KB of it
+SYMBOL_FONT = 'PlanSymbols'
+SYMBOL_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'PlanSymbols.ttf')
+SYMBOL_CHARACTERS = ('⅐⅑⅒⅓⅔⅕⅖⅗⅘⅙⅚⅛⅜⅝⅞←↑→↓↔↕⇐⇒⇔■□▪▫▲△▶▷►▼▽◀◆◇○●◦'
+                     '☀☁☐☑☒★☆☕☺♥♡⚠⚡⚖✓✔✕✖✗✘✦✧✱✳✴❤➔➜➤')
+SYMBOL_PATTERN = re.compile(f'[{re.escape(SYMBOL_CHARACTERS)}]+')
+# Vulgar fractions, after any whole number they belong to ("1⅓"). Plain table
+# cells have a single font, so these are written out instead ("1 1/3")
+FRACTION_PATTERN = re.compile(r'(\d?)([\u2150-\u215e])')
+# Marks recipe titles (the symbol font has no 🍽️, or any other emoji)
+RECIPE_MARKER = '✦'
+
+# Content streams are Flate-compressed without the ASCII85 wrapping reportlab
+# adds by default, which makes them a quarter bigger for no gain in a binary file
+rl_config.useA85 = 0
+
+# Shopping list table columns (tick box, item, quantity) and the font, line
+# height and padding (horizontal, vertical) of their cells, fixed so the rows
+# of a long list are sized up front instead of measured by reportlab
+SHOPPING_COLUMN_WIDTHS = (0.3*inch, 4.5*inch, 1.5*inch)
+SHOPPING_FONT = ('Helvetica', 9)
+SHOPPING_LEADING = 12
+SHOPPING_CELL_PADDING = (6, 3)
+SHOPPING_HEADER_PADDING = 10
 
 
 class NumberedCanvas(canvas.Canvas):
-    """Custom canvas that adds page numbers and headers"""
+    """
+    Custom canvas that adds page numbers and headers
+
+    Each page is finished as soon as it is laid out, with a placeholder where
+    "Page X of Y" goes; save() fills the placeholders in once the page count
+    is known, so no page's drawing state has to be kept until the end. The
+    header and footer are the same on every page, so they are drawn once as a
+    form XObject that each page refers to.
+    """
 
     def __init__(self, *args, **kwargs):
         canvas.Canvas.__init__(self, *args, **kwargs)
-        self._saved_page_states = []
         self.client_name = kwargs.get('client_name', 'Client')
+        self.page_count = 0
+        # (page number, finished page) for every page awaiting its page count
+        self._numbered_pages = []
+
+    def _context(self):
+        return getattr(self, '_render_context', None) or get_render_context(NutritionPlanPDF.default_theme())
 
     def showPage(self):
-        self._saved_page_states.append(dict(self.__dict__))
-        self._startPage()
+        page_num = self._pageNumber
+        # Skip header/footer on cover page (page 1)
+        if page_num > 1:
+            _draw_form(self, 'PageFurniture', (0, 0) + tuple(self._pagesize), self.draw_page_furniture)
+            self._code.append(PAGE_NUMBER_PLACEHOLDER)
+        self.page_count = page_num
+        canvas.Canvas.showPage(self)
+        if page_num > 1:
+            self._numbered_pages.append((page_num, self._doc.Pages.pages[-1]))
 
     def save(self):
-        num_pages = len(self._saved_page_states)
-        for state in self._saved_page_states:
-            self.__dict__.update(state)
-            self.draw_page_number(num_pages)
-            canvas.Canvas.showPage(self)
+        page_code = self._code
+        for page_num, page in self._numbered_pages:
+            self._code = []
+            self.draw_page_number(page_num, self.page_count)
+            page.stream = page.stream.replace(PAGE_NUMBER_PLACEHOLDER, '\n'.join(self._code), 1)
+        self._code = page_code
+        self._numbered_pages = []
         canvas.Canvas.save(self)
 
-    def draw_page_number(self, page_count):
-        """Draw page number and header on each page"""
-        page_num = self._pageNumber
-
-        # Skip header/footer on cover page (page 1)
-        if page_num == 1:
-            return
+    def draw_page_furniture(self):
+        """Draw the header and footer lines and header text on the current page"""
+        context = self._context()
 
         # Header line
-        self.setStrokeColor(colors.HexColor('#2C5F2D'))
+        self.setStrokeColor(context.primary_green)
         self.setLineWidth(0.5)
         self.line(0.75*inch, 10.25*inch, 7.75*inch, 10.25*inch)
 
         # Header text
         self.setFont('Helvetica', 9)
-        self.setFillColor(colors.HexColor('#666666'))
+        self.setFillColor(context.text_light)
         self.drawString(0.75*inch, 10.35*inch, "Personal Nutrition Plan")
         self.drawRightString(7.75*inch, 10.35*inch, getattr(self, '_client_name', 'Client'))
 
         # Footer line
         self.line(0.75*inch, 0.6*inch, 7.75*inch, 0.6*inch)
 
-        # Page number
+    def draw_page_number(self, page_num, page_count):
+        """Draw "Page X of Y" (called at save, once the page count is known)"""
         self.setFont('Helvetica', 9)
-        self.setFillColor(colors.HexColor('#666666'))
+        self.setFillColor(self._context().text_light)
         self.drawCentredString(4.25*inch, 0.4*inch, f"Page {page_num} of {page_count}")
 
 
-class NutritionPlanPDF:
-    # Colour scheme
-    PRIMARY_GREEN = '#2C5F2D'
-    SECONDARY_GREEN = '#4A7C4E'
-    LIGHT_GREEN = '#E8F5E9'
-    ACCENT_ORANGE = '#FF8C00'
-    TEXT_DARK = '#333333'
-    TEXT_LIGHT = '#666666'
+class LazyStory(list):
+    """
+    Story list that pulls flowables from an iterator as the document template consumes them
+
+    Platypus only looks at the front of the story (further ahead only for
+    runs of keepWithNext flowables), so buffering just that much lets a
+    whole document be laid out without every flowable existing at once.
+    """
+
+    def __init__(self, flowables):
+        list.__init__(self)
+        self._source = iter(flowables)
+        # Time spent producing flowables (parsing), as opposed to laying them out
+        self.pull_seconds = 0.0
+
+    def _pull(self):
+        started = time.perf_counter()
+        # Take a whole keepWithNext run, plus the flowable it keeps with
+        for flowable in self._source:
+            self.append(flowable)
+            if not flowable.getKeepWithNext():
+                break
+        self.pull_seconds += time.perf_counter() - started
+
+    def __len__(self):
+        if not list.__len__(self):
+            self._pull()
+        return list.__len__(self)
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+class DayBanner(Flowable):
+    """
+    Day header drawn straight onto the canvas: a bold title in a shaded, outlined box
+
+    Looks the same as the one-cell Table it replaces, without building a
+    Table, its cell styles and a Paragraph for every day of the plan.
+    """
+
+    # Box width, and the padding around the title (left, right, top and bottom)
+    WIDTH = 6.5*inch
+    PADDING = (15, 6, 3)
+
+    def __init__(self, title, style, background, border):
+        Flowable.__init__(self)
+        self.title = ' '.join(title.split())
+        self.style = style
+        self.font_name = tt2ps(style.fontName, 1, 0)
+        self.background = background
+        self.border = border
+        self.hAlign = 'CENTER'
+        self._lines = []
+
+    def wrap(self, availWidth, availHeight):
+        left, right, vertical = self.PADDING
+        self._lines = simpleSplit(self.title, self.font_name, self.style.fontSize, self.WIDTH - left - right) or ['']
+        self.width = self.WIDTH
+        self.height = len(self._lines) * self.style.leading + 2 * vertical
+        return self.width, self.height
+
+    def draw(self):
+        left, _, vertical = self.PADDING
+        canv = self.canv
+        canv.saveState()
+        canv.setFillColor(self.background)
+        canv.setStrokeColor(self.border)
+        canv.setLineWidth(1)
+        canv.setLineCap(1)
+        canv.setLineJoin(1)
+        canv.rect(0, 0, self.width, self.height, stroke=1, fill=1)
+
+        # Baselines where a Paragraph would put them, from the top line down
+        canv.setFillColor(self.style.textColor)
+        canv.setFont(self.font_name, self.style.fontSize)
+        y = self.height - vertical - self.style.fontSize
+        for line in self._lines:
+            canv.drawString(left, y, line)
+            y -= self.style.leading
+        canv.restoreState()
+
+
+class SharedHRFlowable(HRFlowable):
+    """Horizontal rule drawn from a form XObject shared by every identical rule in the document"""
+
+    def draw(self):
+        colour = self.color.hexval()[2:] if hasattr(self.color, 'hexval') else 'default'
+        name = f"Rule{round(self._width)}x{self.lineWidth}_{colour}".replace('.', '_')
+        margin = self.lineWidth
+        bbox = (-margin, -margin, self._width + margin, self.height + margin)
+        _draw_form(self.canv, name, bbox, lambda: HRFlowable.draw(self))
+
+
+class RecipeCard(Flowable):
+    """
+    A recipe's title and lines laid out as one flowable
+
+    Replaces a KeepTogether, which lays its contents out twice and copies the
+    page frame to do it. Each line is wrapped once per width; a card that
+    doesn't fit where it falls moves to the next page whole, as before, and
+    only a card taller than a page is split between lines, its first part
+    ending with a continuation marker and the rest headed "(continued)".
+    """
+
+    def __init__(self, flowables, title, title_style, marker_style):
+        Flowable.__init__(self)
+        self.flowables = flowables
+        self.title = title
+        self.title_style = title_style
+        self.marker_style = marker_style
+        self._wrapped_width = None
+        # Height of each flowable, and the space above each one (none above the first)
+        self._heights = []
+        self._gaps = []
+
+    def _gap(self, before, after):
+        # The space a frame leaves between two flowables, overlapping attached space as it does
+        if rl_config.overlapAttachedSpace:
+            return max(before.getSpaceAfter(), after.getSpaceBefore())
+        return before.getSpaceAfter() + after.getSpaceBefore()
+
+    def _wrap_flowables(self, availWidth):
+        if self._wrapped_width == availWidth:
+            return
+        self._heights = [flowable.wrap(availWidth, 0xffffff)[1] for flowable in self.flowables]
+        self._gaps = [0] + [self._gap(before, after) for before, after in zip(self.flowables, self.flowables[1:])]
+        self._wrapped_width = availWidth
+
+    def wrap(self, availWidth, availHeight):
+        self._wrap_flowables(availWidth)
+        self.width = availWidth
+        self.height = sum(self._heights) + sum(self._gaps)
+        return self.width, self.height
+
+    def getSpaceBefore(self):
+        return self.flowables[0].getSpaceBefore() if self.flowables else 0
+
+    def getSpaceAfter(self):
+        return self.flowables[-1].getSpaceAfter() if self.flowables else 0
+
+    def split(self, availWidth, availHeight):
+        frame = getattr(self, '_frame', None)
+        if frame is not None and not frame._atTop:
+            # Try again whole at the top of the next page
+            return []
+
+        self._wrap_flowables(availWidth)
+        # Only cards that split ever need these
+        marker = Paragraph("<i>Continued on the next page</i>", self.marker_style)
+        marker_height = marker.wrap(availWidth, availHeight)[1]
+        used = 0
+        fits = 0
+        for index, (height, gap) in enumerate(zip(self._heights, self._gaps)):
+            marker_gap = self._gap(self.flowables[index], marker)
+            if used + gap + height + marker_gap + marker_height > availHeight:
+                break
+            used += gap + height
+            fits = index + 1
+
+        # Never leave a title on its own at the foot of a page
+        if fits < 2 or fits >= len(self.flowables):
+            return list(self.flowables)
+        continued_title = Paragraph(_with_symbol_font(f"{RECIPE_MARKER} {self.title} (continued)"), self.title_style)
+        card = (self.title, self.title_style, self.marker_style)
+        return [RecipeCard(self.flowables[:fits] + [marker], *card),
+                RecipeCard([continued_title] + self.flowables[fits:], *card)]
+
+    def draw(self):
+        y = self.height
+        for flowable, height, gap in zip(self.flowables, self._heights, self._gaps):
+            y -= gap + height
+            flowable.drawOn(self.canv, 0, y)
+
+
+# Whether this process renders one PDF at a time and nothing else (a render
+# pool worker): only then is its peak RSS a build's own, so only then is it
+# reset and recorded per build. Concurrent renders in threads would report
+# each other's peaks
+_dedicated_process = False
+
+
+def dedicate_process_to_renders():
+    """Mark this process as rendering one PDF at a time, so builds record their peak RSS"""
+    global _dedicated_process
+    _dedicated_process = True
+
+
+def _reset_peak_rss():
+    """Reset this process's peak RSS counter where the OS allows it (Linux), returning whether it did"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if it can't be read"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+@lru_cache(maxsize=None)
+def symbol_font():
+    """Register the symbol font on first use, returning its name, or None (with a warning) if it won't load"""
+    try:
+        # Without asciiReadable reportlab's first subset holds only the symbols
+        # used, instead of reserving every ASCII glyph the font has
+        pdfmetrics.registerFont(TTFont(SYMBOL_FONT, SYMBOL_FONT_PATH, asciiReadable=False))
+    except (TTFError, OSError) as e:
+        print(f"⚠️  Couldn't load the symbol font {SYMBOL_FONT_PATH} ({e}); "
+              "ticks, arrows and fractions will be missing from PDFs", file=sys.stderr)
+        return None
+    return SYMBOL_FONT
+
+
+def _with_symbol_font(text):
+    """Paragraph markup drawing any symbols in text with the symbol font (if installed)"""
+    font = symbol_font()
+    if font is None:
+        return text
+    return SYMBOL_PATTERN.sub(lambda match: f'<font name="{font}">{match.group(0)}</font>', text)
+
+
+def _draw_form(canv, name, bbox, draw):
+    """Draw a form XObject, recording it with draw() the first time a document uses name"""
+    if not canv.hasForm(name):
+        canv.beginForm(name, *bbox)
+        draw()
+        canv.endForm()
+    canv.doForm(name)
+
+
+def _plain_fractions(text):
+    """Text with the vulgar fractions Helvetica lacks written out ("1⅓" as "1 1/3")"""
+    return FRACTION_PATTERN.sub(
+        lambda match: (match.group(1) + ' ' if match.group(1) else '') +
+        unicodedata.normalize('NFKC', match.group(2)).replace('\u2044', '/'), text)
+
+
+def _fit_cell(text, width):
+    """Table cell text, broken onto lines no wider than width (points) if it doesn't fit on one"""
+    text = _plain_fractions(text)
+    if not text or stringWidth(text, *SHOPPING_FONT) <= width:
+        return text
+    return '\n'.join(simpleSplit(text, SHOPPING_FONT[0], SHOPPING_FONT[1], width))
+
+
+PDFTheme = namedtuple('PDFTheme', [
+    'primary_green', 'secondary_green', 'light_green', 'accent_orange', 'text_dark', 'text_light'
+])
+
+
+class RenderContext:
+    """
+    Paragraph and table styles for one colour theme
+
+    Built once per theme by get_render_context and shared by every document
+    (and thread) using that theme, so nothing here is modified after __init__.
+    """
+
+    def __init__(self, theme):
+        self.theme = theme
+        self.PRIMARY_GREEN = theme.primary_green
+        self.SECONDARY_GREEN = theme.secondary_green
+        self.LIGHT_GREEN = theme.light_green
+        self.ACCENT_ORANGE = theme.accent_orange
+        self.TEXT_DARK = theme.text_dark
+        self.TEXT_LIGHT = theme.text_light
+
+        # Ready-made colours for flowables and the page header/footer
+        self.primary_green = colors.HexColor(theme.primary_green)
+        self.accent_orange = colors.HexColor(theme.accent_orange)
+        self.light_green = colors.HexColor(theme.light_green)
+        self.secondary_green = colors.HexColor(theme.secondary_green)
+        self.text_light = colors.HexColor(theme.text_light)
 
-    def __init__(self, filename, client_name):
-        self.filename = filename
-        self.client_name = client_name
-        self.doc = SimpleDocTemplate(
-            filename,
-            pagesize=letter,
-            rightMargin=0.75*inch,
-            leftMargin=0.75*inch,
-            topMargin=0.9*inch,
-            bottomMargin=0.75*inch
-        )
-        self.story = []
         self.styles = getSampleStyleSheet()
         self._create_custom_styles()
+        self._create_table_styles()
 
     def _create_custom_styles(self):
         """Create custom paragraph styles"""
@@ -227,6 +575,161 @@ class NutritionPlanPDF:
             leading=10
         ))
 
+        # Cover page and day header styles
+        self.styles.add(ParagraphStyle(
+            name='TableHeader', fontSize=12, textColor=colors.whitesmoke, alignment=TA_CENTER
+        ))
+        self.styles.add(ParagraphStyle(
+            name='ContentsTitle', fontSize=12, textColor=colors.HexColor(self.PRIMARY_GREEN),
+            alignment=TA_CENTER, spaceAfter=10
+        ))
+        self.styles.add(ParagraphStyle(
+            name='ContentsItem', fontSize=10, textColor=colors.HexColor(self.TEXT_DARK),
+            alignment=TA_CENTER, spaceAfter=4
+        ))
+        self.styles.add(ParagraphStyle(
+            name='DisclaimerText', fontSize=8, textColor=colors.HexColor(self.TEXT_LIGHT),
+            alignment=TA_CENTER, leading=11
+        ))
+        self.styles.add(ParagraphStyle(
+            name='DayTitle', fontSize=12, textColor=colors.HexColor(self.PRIMARY_GREEN),
+            alignment=TA_LEFT
+        ))
+
+    def _create_table_styles(self):
+        """Create the table styles shared by every document"""
+        # Cover page profile box
+        self.cover_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(self.PRIMARY_GREEN)),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('SPAN', (0, 0), (1, 0)),
+            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+            ('ALIGN', (0, 1), (0, -1), 'RIGHT'),
+            ('ALIGN', (1, 1), (1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('TOPPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F8F8F8')]),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor(self.SECONDARY_GREEN)),
+            ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
+            ('TEXTCOLOR', (0, 1), (0, -1), colors.HexColor(self.SECONDARY_GREEN)),
+            ('FONTSIZE', (0, 1), (-1, -1), 10),
+            ('PADDING', (0, 1), (-1, -1), 10),
+        ])
+
+        # Cover page disclaimer box
+        self.disclaimer_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
+            ('PADDING', (0, 0), (-1, -1), 12),
+            ('BOX', (0, 0), (-1, -1), 0.5, colors.HexColor('#DDDDDD')),
+        ])
+
+        # Nutrition facts mini-box
+        self.macro_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor(self.LIGHT_GREEN)),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor(self.SECONDARY_GREEN)),
+            ('TOPPADDING', (0, 0), (-1, 0), 8),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 4),
+            ('TOPPADDING', (0, 1), (-1, 1), 2),
+            ('BOTTOMPADDING', (0, 1), (-1, 1), 6),
+        ])
+
+        # Shopping list
+        self.shopping_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(self.PRIMARY_GREEN)),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (0, -1), 'CENTER'),
+            ('ALIGN', (1, 0), (1, -1), 'LEFT'),
+            ('ALIGN', (2, 0), (2, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), SHOPPING_HEADER_PADDING),
+            ('TOPPADDING', (0, 0), (-1, 0), SHOPPING_HEADER_PADDING),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#FAFAFA')),
+            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F5F5F5')]),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#DDDDDD')),
+            ('LEADING', (0, 0), (-1, -1), SHOPPING_LEADING),
+            ('TOPPADDING', (0, 1), (-1, -1), SHOPPING_CELL_PADDING[1]),
+            ('BOTTOMPADDING', (0, 1), (-1, -1), SHOPPING_CELL_PADDING[1]),
+        ])
+        if symbol_font():
+            # Tick boxes
+            self.shopping_table_style.add('FONTNAME', (0, 0), (0, -1), symbol_font())
+
+
+@lru_cache(maxsize=32)
+def get_render_context(theme):
+    """Return the shared RenderContext for a theme, building it on first use"""
+    return RenderContext(theme)
+
+
+@lru_cache(maxsize=STATIC_SECTION_CACHE_SIZE)
+def _static_section(pdf_class, theme, text):
+    """
+    Flowables for a templated block laid out by pdf_class in theme, parsed on first use
+
+    Shared by every PDF, so callers add shallow copies. Assumes the usual
+    cover page comes first (see NutritionPlanPDF._add_static_section).
+
+    Returns:
+        Tuple of (flowables, the lexer's current section after the block)
+    """
+    scratch = pdf_class(io.BytesIO(), '', theme=theme)
+    scratch.story = [None] * 11
+    scratch.begin_content()
+    for line in text.split('\n'):
+        scratch.feed_line(line)
+    scratch.finish_content()
+    return scratch.story[11:], scratch._lexer.current_section
+
+
+class NutritionPlanPDF:
+    """Lays out a plan as a PDF, written to filename: a path or a writable binary stream"""
+
+    # Colour scheme
+    PRIMARY_GREEN = '#2C5F2D'
+    SECONDARY_GREEN = '#4A7C4E'
+    LIGHT_GREEN = '#E8F5E9'
+    ACCENT_ORANGE = '#FF8C00'
+    TEXT_DARK = '#333333'
+    TEXT_LIGHT = '#666666'
+
+    @classmethod
+    def default_theme(cls):
+        """The theme given by this class's colour constants, so subclasses can still rebrand"""
+        return PDFTheme(
+            cls.PRIMARY_GREEN, cls.SECONDARY_GREEN, cls.LIGHT_GREEN,
+            cls.ACCENT_ORANGE, cls.TEXT_DARK, cls.TEXT_LIGHT
+        )
+
+    def __init__(self, filename, client_name, theme=None, compact=True):
+        self.filename = filename
+        self.client_name = client_name
+        # Per-trainer branding is just a different (cached) theme
+        self.theme = theme or self.default_theme()
+        self.context = get_render_context(self.theme)
+        self.doc = SimpleDocTemplate(
+            filename,
+            pagesize=letter,
+            rightMargin=0.75*inch,
+            leftMargin=0.75*inch,
+            topMargin=0.9*inch,
+            bottomMargin=0.75*inch,
+            # Compressed content streams; compact=False leaves them readable, for debugging layout
+            pageCompression=1 if compact else 0
+        )
+        self.story = []
+        # Flowables already handed to a lazy build and dropped from self.story
+        self._emitted = 0
+        self.styles = self.context.styles
+        self.build_stats = None
+        # Nodes that could not be laid out and were added as plain text instead
+        self.parse_fallbacks = 0
+
     def add_cover_page(self, user_data):
         """Add a professional cover page"""
         # Add some vertical space to center content
@@ -244,7 +747,7 @@ class NutritionPlanPDF:
         self.story.append(HRFlowable(
             width="40%",
             thickness=2,
-            color=colors.HexColor(self.ACCENT_ORANGE),
+            color=self.context.accent_orange,
             spaceBefore=5,
             spaceAfter=5,
             hAlign='CENTER'
@@ -260,9 +763,7 @@ class NutritionPlanPDF:
 
         # Client info box - more refined
         client_info = [
-            [Paragraph('<b>Your Profile</b>', ParagraphStyle(
-                'TableHeader', fontSize=12, textColor=colors.whitesmoke, alignment=TA_CENTER
-            )), ''],
+            [Paragraph('<b>Your Profile</b>', self.styles['TableHeader']), ''],
             ['Name', self.client_name],
             ['Age', user_data.get('age', 'N/A')],
             ['Goal', user_data.get('goal', 'N/A')],
@@ -273,34 +774,14 @@ class NutritionPlanPDF:
         ]
 
         table = Table(client_info, colWidths=[2*inch, 4*inch])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(self.PRIMARY_GREEN)),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('SPAN', (0, 0), (1, 0)),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('ALIGN', (0, 1), (0, -1), 'RIGHT'),
-            ('ALIGN', (1, 1), (1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('TOPPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F8F8F8')]),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor(self.SECONDARY_GREEN)),
-            ('FONTNAME', (0, 1), (0, -1), 'Helvetica-Bold'),
-            ('TEXTCOLOR', (0, 1), (0, -1), colors.HexColor(self.SECONDARY_GREEN)),
-            ('FONTSIZE', (0, 1), (-1, -1), 10),
-            ('PADDING', (0, 1), (-1, -1), 10),
-        ]))
-
+        table.setStyle(self.context.cover_table_style)
         self.story.append(table)
         self.story.append(Spacer(1, 0.8*inch))
 
         # What's inside section
         contents_title = Paragraph(
             "<b>What's Inside</b>",
-            ParagraphStyle('ContentsTitle', fontSize=12, textColor=colors.HexColor(self.PRIMARY_GREEN),
-                          alignment=TA_CENTER, spaceAfter=10)
+            self.styles['ContentsTitle']
         )
         self.story.append(contents_title)
 
@@ -315,9 +796,8 @@ class NutritionPlanPDF:
 
         for item in contents_items:
             self.story.append(Paragraph(
-                f"✓ {item}",
-                ParagraphStyle('ContentsItem', fontSize=10, textColor=colors.HexColor(self.TEXT_DARK),
-                              alignment=TA_CENTER, spaceAfter=4)
+                _with_symbol_font(f"✓ {item}"),
+                self.styles['ContentsItem']
             ))
 
         self.story.append(Spacer(1, 0.6*inch))
@@ -328,16 +808,9 @@ class NutritionPlanPDF:
             "professional medical advice. Please consult with a healthcare provider before starting "
             "any new diet or nutrition programme.</i>"
         )
-        disclaimer_data = [[Paragraph(disclaimer_text, ParagraphStyle(
-            'DisclaimerText', fontSize=8, textColor=colors.HexColor(self.TEXT_LIGHT),
-            alignment=TA_CENTER, leading=11
-        ))]]
+        disclaimer_data = [[Paragraph(disclaimer_text, self.styles['DisclaimerText'])]]
         disclaimer_table = Table(disclaimer_data, colWidths=[6*inch])
-        disclaimer_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#F5F5F5')),
-            ('PADDING', (0, 0), (-1, -1), 12),
-            ('BOX', (0, 0), (-1, -1), 0.5, colors.HexColor('#DDDDDD')),
-        ]))
+        disclaimer_table.setStyle(self.context.disclaimer_table_style)
         self.story.append(disclaimer_table)
 
         self.story.append(PageBreak())
@@ -345,211 +818,168 @@ class NutritionPlanPDF:
     def _sanitize_text(self, text):
         """Sanitise text for PDF generation - fix malformed HTML and convert markdown"""
         text = html.escape(text)
-        text = re.sub(r'\*\*([^\*]+)\*\*', r'<b>\1</b>', text)
-        text = re.sub(r'\*([^\*]+)\*', r'<i>\1</i>', text)
-        text = re.sub(r'_([^_]+)_', r'<i>\1</i>', text)
+        text = BOLD_PATTERN.sub(r'<b>\1</b>', text)
+        text = ITALIC_PATTERN.sub(r'<i>\1</i>', text)
+        text = UNDERSCORE_ITALIC_PATTERN.sub(r'<i>\1</i>', text)
+
+        # Unescape any <b>/<i> tags that were in the text itself
+        return _with_symbol_font(ESCAPED_TAG_PATTERN.sub(r'<\1>', text))
+
+    def parse_and_add_content(self, plan_text, static_section=None):
+        """
+        Parse the plan text and add formatted content with improved structure
+
+        If static_section (a templated block of the plan, such as the
+        aftercare sections) appears in the text, its flowables are reused
+        from the cache instead of being parsed again.
+        """
+        fallbacks = self.parse_fallbacks
+        with instrumentation.span('parse', lines=plan_text.count('\n') + 1) as fields:
+            for _ in self._feed_content(plan_text, static_section):
+                pass
+            fields['flowables'] = self._story_length()
+            fields['fallbacks'] = self.parse_fallbacks - fallbacks
+
+    def _feed_content(self, plan_text, static_section=None):
+        """Parse the plan into self.story, yielding after each line so a lazy build can take the flowables"""
+        self.begin_content()
+        if static_section and static_section in plan_text:
+            before, after = plan_text.split(static_section, 1)
+            for line in before.split('\n'):
+                self.feed_line(line)
+                yield
+            self._add_static_section(static_section)
+            yield
+            plan_text = after
+
+        for line in plan_text.split('\n'):
+            self.feed_line(line)
+            yield
+        self.finish_content()
+        yield
+
+    def _story_length(self):
+        """Number of flowables added so far, including any a lazy build has already taken"""
+        return self._emitted + len(self.story)
+
+    def _take_story(self):
+        """Hand over the flowables added since the last call"""
+        story, self.story = self.story, []
+        self._emitted += len(story)
+        return story
+
+    def iter_story(self, plan_text, user_data):
+        """Yield the complete document's flowables as the plan is parsed, line by line"""
+        self.add_cover_page(user_data)
+        yield from self._take_story()
+        for _ in self._feed_content(plan_text, static_section=render_aftercare(user_data)):
+            yield from self._take_story()
 
-        # Unescape the HTML tags we just added
-        text = text.replace('&lt;b&gt;', '<b>')
-        text = text.replace('&lt;/b&gt;', '</b>')
-        text = text.replace('&lt;i&gt;', '<i>')
-        text = text.replace('&lt;/i&gt;', '</i>')
+    def iter_story_from_ir(self, nodes, user_data):
+        """Yield the complete document's flowables for plan IR nodes, one node at a time"""
+        self.add_cover_page(user_data)
+        yield from self._take_story()
+        for node in nodes:
+            self.add_nodes([node])
+            yield from self._take_story()
+
+    def _add_static_section(self, text):
+        """Add a templated block that starts with a section heading, reusing cached flowables"""
+        # Cached blocks assume the usual cover page is already in the story,
+        # which decides whether their major sections start on a new page
+        if self._story_length() <= 10:
+            for line in text.split('\n'):
+                self.feed_line(line)
+            return
 
-        return text
+        # The block starts with a heading, so end any open recipe or list as feed_line would
+        self.add_nodes(self._lexer.interrupt(text.lstrip()))
 
-    def _is_major_section(self, line):
-        """Check if line is a major section header"""
-        major_keywords = [
-            'NUTRITIONAL ANALYSIS', 'MEAL PLAN', 'DAY MEAL PLAN', 'RECIPES',
-            'SHOPPING LIST', 'MEAL PREP', 'ADDITIONAL TIPS', 'TIPS & ADVICE',
-            'TIPS AND ADVICE', 'HYDRATION', 'SUPPLEMENT'
-        ]
-        clean_line = line.upper().replace('**', '').replace('*', '').replace('#', '').strip()
-        return any(keyword in clean_line for keyword in major_keywords)
-
-    def _is_day_header(self, line):
-        """Check if line is a day header"""
-        patterns = [
-            r'^#{0,3}\s*\*{0,2}DAY\s*\d+',
-            r'^#{0,3}\s*\*{0,2}(MONDAY|TUESDAY|WEDNESDAY|THURSDAY|FRIDAY|SATURDAY|SUNDAY)',
-            r'^DAY\s*\d+\s*[-:–]',
-            r'^(Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday)\s*[-:–]'
-        ]
-        for pattern in patterns:
-            if re.match(pattern, line.strip(), re.IGNORECASE):
-                return True
-        return False
+        flowables, current_section = _static_section(type(self), self.theme, text)
+        self.story.extend(copy.copy(flowable) for flowable in flowables)
+        self._lexer.current_section = current_section
 
-    def _is_recipe_title(self, line):
-        """Check if line looks like a recipe title"""
-        clean = line.replace('**', '').replace('*', '').replace('#', '').strip()
-        recipe_indicators = [
-            'recipe', 'breakfast:', 'lunch:', 'dinner:', 'snack:',
-            'serves', 'prep time', 'cook time'
-        ]
-        # Recipe titles are often bold and not too long
-        if line.startswith('**') and len(clean) < 60 and ':' not in clean:
-            return True
-        if any(ind in clean.lower() for ind in recipe_indicators):
-            return True
-        return False
+    def begin_content(self):
+        """Reset the lexer so plan lines can be fed one at a time"""
+        self._lexer = PlanLexer()
 
-    def parse_and_add_content(self, plan_text):
-        """Parse the plan text and add formatted content with improved structure"""
-        lines = plan_text.split('\n')
-        i = 0
-        in_recipe = False
-        recipe_lines = []
-        recipe_title = ""
-        current_section = ""
-        shopping_items = []
-        in_shopping_list = False
-
-        while i < len(lines):
-            line = lines[i].strip()
-
-            # Skip empty lines (but track them for recipe endings)
-            if not line:
-                if in_recipe and recipe_lines:
-                    # End of recipe - create recipe card
-                    self.story.append(self._create_recipe_card(recipe_title, recipe_lines))
-                    recipe_lines = []
-                    recipe_title = ""
-                    in_recipe = False
-                if in_shopping_list and shopping_items and i + 1 < len(lines):
-                    # Check if next non-empty line is still shopping content
-                    next_line = lines[i + 1].strip() if i + 1 < len(lines) else ""
-                    if next_line and not next_line.startswith(('-', '•', '*', '☐')):
-                        # End shopping list section
-                        table = self._create_shopping_table(shopping_items)
-                        if table:
-                            self.story.append(table)
-                            self.story.append(Spacer(1, 0.2*inch))
-                        shopping_items = []
-                        in_shopping_list = False
-                i += 1
-                continue
+    def feed_line(self, raw_line):
+        """Lex one line of plan text and add the flowables of any nodes it completes"""
+        self.add_nodes(self._lexer.feed_line(raw_line))
 
-            try:
-                # Check for main sections (all caps or **SECTION**)
-                is_section = (
-                    (line.isupper() and len(line) > 3) or
-                    (line.startswith('**') and line.endswith('**') and line.count('**') == 2) or
-                    (line.startswith('## ') or line.startswith('# '))
-                )
-
-                if is_section:
-                    # Flush any pending recipe
-                    if in_recipe and recipe_lines:
-                        self.story.append(self._create_recipe_card(recipe_title, recipe_lines))
-                        recipe_lines = []
-                        recipe_title = ""
-                        in_recipe = False
-
-                    # Flush shopping list
-                    if shopping_items:
-                        table = self._create_shopping_table(shopping_items)
-                        if table:
-                            self.story.append(table)
-                        shopping_items = []
-                        in_shopping_list = False
-
-                    section_title = line.replace('**', '').replace('*', '').replace('#', '').strip()
-                    section_title = html.escape(section_title)
-                    current_section = section_title.upper()
-
-                    # Add page break before major sections (except first one)
-                    if self._is_major_section(line) and len(self.story) > 10:
-                        self.story.append(PageBreak())
-
-                    self.story.append(Paragraph(section_title, self.styles['SectionHeading']))
-                    self.story.append(self._create_section_divider())
-
-                    # Track if we're entering shopping list
-                    if 'SHOPPING' in current_section:
-                        in_shopping_list = True
-
-                # Check for day headers
-                elif self._is_day_header(line):
-                    day_title = line.replace('**', '').replace('*', '').replace('#', '').strip()
-                    day_title = html.escape(day_title)
-
-                    # Add spacer before day (but not page break for every day)
-                    self.story.append(Spacer(1, 0.15*inch))
-
-                    # Create a styled day header box
-                    day_table = Table([[Paragraph(f"<b>{day_title}</b>", ParagraphStyle(
-                        'DayTitle', fontSize=12, textColor=colors.HexColor(self.PRIMARY_GREEN),
-                        alignment=TA_LEFT
-                    ))]], colWidths=[6.5*inch])
-                    day_table.setStyle(TableStyle([
-                        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor(self.LIGHT_GREEN)),
-                        ('PADDING', (0, 0), (-1, -1), 10),
-                        ('LEFTPADDING', (0, 0), (-1, -1), 15),
-                        ('BOX', (0, 0), (-1, -1), 1, colors.HexColor(self.SECONDARY_GREEN)),
-                    ]))
-                    self.story.append(day_table)
-                    self.story.append(Spacer(1, 0.1*inch))
-
-                # Check for subsections (### or bold text with colon)
-                elif line.startswith('###') or (line.startswith('**') and ':' in line and not self._is_recipe_title(line)):
-                    subsection_title = line.replace('###', '').replace('**', '').strip()
-                    subsection_title = html.escape(subsection_title)
-                    self.story.append(Paragraph(subsection_title, self.styles['SubsectionHeading']))
-
-                # Check for recipe titles
-                elif self._is_recipe_title(line) and 'RECIPE' in current_section:
-                    # Start collecting recipe
-                    if in_recipe and recipe_lines:
-                        self.story.append(self._create_recipe_card(recipe_title, recipe_lines))
-                        recipe_lines = []
-
-                    recipe_title = line.replace('**', '').replace('*', '').replace('#', '').strip()
-                    in_recipe = True
-
-                # Collecting recipe content
-                elif in_recipe:
-                    recipe_lines.append(line)
-
-                # Shopping list items
-                elif in_shopping_list and (line.startswith('-') or line.startswith('•') or line.startswith('*')):
-                    shopping_items.append(line)
-
-                # Check for bullet points
-                elif line.startswith('•') or line.startswith('-') or line.startswith('*'):
-                    bullet_text = line[1:].strip()
-                    bullet_text = self._sanitize_text(bullet_text)
-                    self.story.append(Paragraph(f"• {bullet_text}", self.styles['BulletItem']))
-
-                # Regular paragraph
-                else:
-                    sanitized_line = self._sanitize_text(line)
-                    self.story.append(Paragraph(sanitized_line, self.styles['CustomBody']))
+    def finish_content(self):
+        """Flush any content still being collected once the last line has been fed"""
+        self.add_nodes(self._lexer.finish())
 
+    def add_nodes(self, nodes):
+        """Add the flowables for a sequence of plan IR nodes to the story"""
+        for node in nodes:
+            try:
+                getattr(self, self.NODE_RENDERERS[type(node)])(node)
             except Exception as e:
-                print(f"Warning: Could not parse line: {line[:50]}... ({e})")
+                source = getattr(node, 'line', None) or getattr(node, 'title', '')
+                # stderr, so a PDF written to stdout (render -o -) isn't corrupted
+                print(f"Warning: Could not parse line: {source[:50]}... ({e})", file=sys.stderr)
+                self.parse_fallbacks += 1
+                instrumentation.emit('parse_fallback', node=type(node).__name__, error=str(e).strip()[:200])
                 try:
-                    safe_line = html.escape(line)
-                    self.story.append(Paragraph(safe_line, self.styles['CustomBody']))
+                    self.story.append(Paragraph(html.escape(source), self.styles['CustomBody']))
                 except:
                     pass
 
-            i += 1
+    def _add_section(self, node):
+        # Add page break before major sections (except first one)
+        if node.major and self._story_length() > 10:
+            self.story.append(PageBreak())
+
+        self.story.append(Paragraph(html.escape(node.title), self.styles['SectionHeading']))
+        self.story.append(self._create_section_divider())
+
+    def _add_day_header(self, node):
+        # Add spacer before day (but not page break for every day)
+        self.story.append(Spacer(1, 0.15*inch))
+
+        # Create a styled day header box
+        self.story.append(DayBanner(node.title, self.styles['DayTitle'], self.context.light_green,
+                                    self.context.secondary_green))
+        self.story.append(Spacer(1, 0.1*inch))
+
+    def _add_subsection(self, node):
+        self.story.append(Paragraph(html.escape(node.title), self.styles['SubsectionHeading']))
+
+    def _add_recipe(self, node):
+        self.story.append(self._create_recipe_card(node.title, node.lines))
+
+    def _add_shopping_list(self, node):
+        table = self._create_shopping_table(node.items)
+        if table:
+            self.story.append(table)
+            if node.spacer_after:
+                self.story.append(Spacer(1, 0.2*inch))
+
+    def _add_bullet(self, node):
+        self.story.append(Paragraph(f"• {self._sanitize_text(node.text)}", self.styles['BulletItem']))
 
-        # Flush any remaining content
-        if in_recipe and recipe_lines:
-            self.story.append(self._create_recipe_card(recipe_title, recipe_lines))
-        if shopping_items:
-            table = self._create_shopping_table(shopping_items)
-            if table:
-                self.story.append(table)
+    def _add_paragraph(self, node):
+        self.story.append(Paragraph(self._sanitize_text(node.text), self.styles['CustomBody']))
+
+    # Method adding each IR node type's flowables (looked up by name so subclasses can override)
+    NODE_RENDERERS = {
+        plan_ir.Section: '_add_section',
+        plan_ir.DayHeader: '_add_day_header',
+        plan_ir.Subsection: '_add_subsection',
+        plan_ir.Recipe: '_add_recipe',
+        plan_ir.ShoppingList: '_add_shopping_list',
+        plan_ir.Bullet: '_add_bullet',
+        plan_ir.Paragraph: '_add_paragraph',
+    }
 
     def _create_section_divider(self):
         """Create a horizontal line divider"""
-        return HRFlowable(
+        return SharedHRFlowable(
             width="100%",
             thickness=1,
-            color=colors.HexColor(self.PRIMARY_GREEN),
+            color=self.context.primary_green,
             spaceBefore=10,
             spaceAfter=15
         )
@@ -572,16 +1002,7 @@ class NutritionPlanPDF:
         ]
 
         table = Table(data, colWidths=[1.5*inch, 1.2*inch, 1.2*inch, 1.2*inch])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor(self.LIGHT_GREEN)),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor(self.SECONDARY_GREEN)),
-            ('TOPPADDING', (0, 0), (-1, 0), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 4),
-            ('TOPPADDING', (0, 1), (-1, 1), 2),
-            ('BOTTOMPADDING', (0, 1), (-1, 1), 6),
-        ]))
+        table.setStyle(self.context.macro_table_style)
         return table
 
     def _create_recipe_card(self, title, content_lines):
@@ -589,7 +1010,7 @@ class NutritionPlanPDF:
         elements = []
 
         # Recipe title with orange accent
-        title_para = Paragraph(f"🍽️ {title}", self.styles['RecipeTitle'])
+        title_para = Paragraph(_with_symbol_font(f"{RECIPE_MARKER} {title}"), self.styles['RecipeTitle'])
         elements.append(title_para)
 
         # Recipe content
@@ -603,74 +1024,201 @@ class NutritionPlanPDF:
                     elements.append(Paragraph(sanitized, self.styles['Recipe']))
 
         elements.append(Spacer(1, 0.15*inch))
-        return KeepTogether(elements)
+        return RecipeCard(elements, title, self.styles['RecipeTitle'], self.styles['SmallText'])
 
     def _create_shopping_table(self, items):
-        """Create a formatted shopping list table"""
+        """
+        Create a formatted shopping list table, however long the list
+
+        A LongTable splits between rows across as many pages as the list
+        needs, repeating its header row on each. Text too wide for its column
+        is wrapped onto extra lines of the cell here, so every column width and
+        row height is known up front and reportlab never measures the rows
+        again as it splits the table page by page.
+        """
         if not items:
             return None
 
-        # Group items by category if possible
+        item_width, quantity_width = (width - 2 * SHOPPING_CELL_PADDING[0] for width in SHOPPING_COLUMN_WIDTHS[1:])
         data = [['☐', 'Item', 'Quantity']]
-        for item in items[:30]:  # Limit to prevent overflow
+        heights = [SHOPPING_LEADING + 2 * SHOPPING_HEADER_PADDING]
+        for item in items:
             clean_item = item.strip().lstrip('-•* ')
             if clean_item:
                 # Try to split quantity if present
                 parts = clean_item.rsplit(' - ', 1) if ' - ' in clean_item else [clean_item, '']
-                data.append(['☐', parts[0][:50], parts[1] if len(parts) > 1 else ''])
+                name, quantity = _fit_cell(parts[0], item_width), _fit_cell(parts[1], quantity_width)
+                data.append(['☐', name, quantity])
+                lines = max(name.count('\n'), quantity.count('\n')) + 1
+                heights.append(lines * SHOPPING_LEADING + 2 * SHOPPING_CELL_PADDING[1])
 
         if len(data) <= 1:
             return None
 
-        table = Table(data, colWidths=[0.3*inch, 4.5*inch, 1.5*inch])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(self.PRIMARY_GREEN)),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (0, -1), 'CENTER'),
-            ('ALIGN', (1, 0), (1, -1), 'LEFT'),
-            ('ALIGN', (2, 0), (2, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 9),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
-            ('TOPPADDING', (0, 0), (-1, 0), 10),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#FAFAFA')),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F5F5F5')]),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#DDDDDD')),
-            ('PADDING', (0, 1), (-1, -1), 6),
-        ]))
+        table = LongTable(data, colWidths=SHOPPING_COLUMN_WIDTHS, rowHeights=heights, repeatRows=1, splitByRow=1)
+        table.setStyle(self.context.shopping_table_style)
         return table
 
     def generate(self, plan_text, user_data):
-        """Generate the complete PDF"""
-        # Add cover page
-        self.add_cover_page(user_data)
-
-        # Add plan content
-        self.parse_and_add_content(plan_text)
-
+        """Generate the complete PDF, parsing the plan as the layout consumes it"""
+        return self.build(LazyStory(self.iter_story(plan_text, user_data)))
+
+    def generate_from_ir(self, nodes, user_data):
+        """Generate the complete PDF from already-lexed plan IR nodes"""
+        return self.build(LazyStory(self.iter_story_from_ir(nodes, user_data)))
+
+    def build(self, story=None):
+        """
+        Lay out the story (self.story unless another is given) and write the PDF
+
+        Page count, build time and output size (bytes) are recorded in
+        self.build_stats and emitted as a 'pdf_build' span. For a LazyStory,
+        the time spent parsing is split out of the build time as
+        parse_seconds. In a process dedicated to renders (see
+        dedicate_process_to_renders) the peak RSS is recorded too: of this
+        build where the OS lets it be reset (Linux), of the whole process
+        otherwise. Elsewhere other renders may be running in threads, so it
+        would not be this build's.
+        """
         # Build PDF with custom canvas for page numbers
         client_name = self.client_name
+        context = self.context
+        canvases = []
 
         def make_canvas(filename, pagesize, **kwargs):
-            c = NumberedCanvas(filename, pagesize=pagesize)
+            c = NumberedCanvas(filename, pagesize=pagesize, pageCompression=kwargs.get('pageCompression'))
             c._client_name = client_name
+            c._render_context = context
+            canvases.append(c)
             return c
 
-        self.doc.build(self.story, canvasmaker=make_canvas)
+        story = self.story if story is None else story
+        rss_reset = _reset_peak_rss() if _dedicated_process else False
+        start_offset = self._output_offset()
+        started = time.perf_counter()
+        self.doc.build(story, canvasmaker=make_canvas)
+        self.build_stats = {
+            'pages': canvases[-1].page_count,
+            'seconds': time.perf_counter() - started,
+            'parse_seconds': getattr(story, 'pull_seconds', 0.0),
+            'parse_fallbacks': self.parse_fallbacks,
+            'bytes': self._output_size(start_offset),
+        }
+        if _dedicated_process:
+            self.build_stats['peak_rss_mb'] = _peak_rss_mb()
+            self.build_stats['peak_rss_scope'] = 'build' if rss_reset else 'process'
+        instrumentation.emit('span', name='pdf_build', **self.build_stats)
         return self.filename
 
+    def _output_offset(self):
+        """Write position of the output stream, or None for a path or a stream that can't tell (pipes)"""
+        if isinstance(self.filename, str):
+            return None
+        try:
+            return self.filename.tell()
+        except (AttributeError, OSError):
+            return None
+
+    def _output_size(self, start_offset):
+        """
+        Size of the written PDF in bytes, or None for a stream that can't tell
+
+        For a stream this is how far the write position moved from start_offset
+        (see _output_offset), as the stream may have held data before the PDF.
+        """
+        if isinstance(self.filename, str):
+            return os.path.getsize(self.filename)
+        end_offset = self._output_offset()
+        if start_offset is None or end_offset is None:
+            return None
+        return end_offset - start_offset
+
 
-def create_nutrition_plan_pdf(plan_text, user_data, output_path):
+class StreamingPlanPDF:
+    """
+    Builds a plan PDF from text chunks as they arrive, so parsing overlaps generation
+
+    output_path may also be a writable binary stream.
+    """
+
+    def __init__(self, output_path, user_data, theme=None):
+        self.pdf = NutritionPlanPDF(output_path, user_data.get('name', 'Client'), theme=theme)
+        self.pdf.add_cover_page(user_data)
+        self.pdf.begin_content()
+        self._partial_line = ""
+
+    def feed(self, text):
+        """Add a chunk of plan text, parsing every line it completes"""
+        lines = (self._partial_line + text).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self.pdf.feed_line(line)
+
+    def feed_static_section(self, text):
+        """Add a templated block of whole lines, reusing its cached flowables"""
+        if self._partial_line:
+            self.feed('\n')
+        self.pdf._add_static_section(text)
+
+    def finish(self):
+        """Parse the final line and write the PDF, returning its path"""
+        self.pdf.feed_line(self._partial_line)
+        self._partial_line = ""
+        self.pdf.finish_content()
+        return self.pdf.build()
+
+
+def create_nutrition_plan_pdf(plan_text, user_data, output_path, theme=None, stats=None):
     """
     Convenience function to create a nutrition plan PDF
 
     Args:
         plan_text: The generated nutrition plan text
         user_data: Dictionary with user information
-        output_path: Path where PDF should be saved
+        output_path: Path where PDF should be saved, or a writable binary stream
+        theme: Optional PDFTheme for trainer branding (defaults to the house colours)
+        stats: Optional dict to fill with the build's page count, time and peak RSS
+
+    Returns:
+        Path to (or the stream holding) the generated PDF
+    """
+    pdf = NutritionPlanPDF(output_path, user_data.get('name', 'Client'), theme=theme)
+    path = pdf.generate(plan_text, user_data)
+    if stats is not None:
+        stats.update(pdf.build_stats)
+    return path
+
+
+def create_nutrition_plan_pdf_from_ir(nodes, user_data, output_path, theme=None, stats=None):
+    """
+    Create a nutrition plan PDF from plan IR nodes, skipping text parsing
+
+    Args:
+        nodes: Plan IR nodes (from plan_ir.lex_plan or a structured plan)
+        user_data: Dictionary with user information
+        output_path: Path where PDF should be saved, or a writable binary stream
+        theme: Optional PDFTheme for trainer branding (defaults to the house colours)
+        stats: Optional dict to fill with the build's page count, time and peak RSS
 
     Returns:
-        Path to the generated PDF
+        Path to (or the stream holding) the generated PDF
     """
-    pdf = NutritionPlanPDF(output_path, user_data.get('name', 'Client'))
-    return pdf.generate(plan_text, user_data)
+    pdf = NutritionPlanPDF(output_path, user_data.get('name', 'Client'), theme=theme)
+    path = pdf.generate_from_ir(nodes, user_data)
+    if stats is not None:
+        stats.update(pdf.build_stats)
+    return path
+
+
+def render_nutrition_plan_pdf(plan_text, user_data, theme=None, stats=None):
+    """Render a plan PDF in memory and return its bytes, without touching the filesystem"""
+    buffer = io.BytesIO()
+    create_nutrition_plan_pdf(plan_text, user_data, buffer, theme=theme, stats=stats)
+    return buffer.getvalue()
+
+
+def render_nutrition_plan_pdf_from_ir(nodes, user_data, theme=None, stats=None):
+    """Render a plan PDF from plan IR nodes in memory and return its bytes"""
+    buffer = io.BytesIO()
+    create_nutrition_plan_pdf_from_ir(nodes, user_data, buffer, theme=theme, stats=stats)
+    return buffer.getvalue()
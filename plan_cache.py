@@ -0,0 +1,154 @@
+"""
+Plan Cache
+Persistent, content-addressed store of generated plan text, so identical profiles aren't paid for twice,
+plus the output token usage of past requests
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nutrition_plans', 'plans.sqlite3')
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+# Output token counts kept per kind of request, for sizing max_tokens
+USAGE_HISTORY_ROWS = 200
+
+
+# Profile fields whose case is kept in the key: the plan greets the client by
+# name as written, so "Jo" and "JO" mustn't share one
+CASE_SENSITIVE_FIELDS = ('name',)
+
+
+def normalise_value(value, fold_case=True):
+    """Normalise a profile value so trivially different answers share a cache entry"""
+    value = re.sub(r'\s+', ' ', str(value or '')).strip()
+    return value.casefold() if fold_case else value
+
+
+def make_cache_key(fields, model, prompt_version, context=None):
+    """
+    Hash the prompt-relevant profile fields with the model and prompt version
+
+    Args:
+        fields: Dict of the profile values that appear in the prompt
+        model: Model id the plan is generated with
+        prompt_version: Version of the prompt text
+        context: Optional JSON-able dict of anything else the stored plan depends on
+            (such as the price table its shopping list was priced from)
+
+    Returns:
+        Hex SHA-256 digest
+    """
+    payload = {
+        'fields': {key: normalise_value(value, fold_case=key not in CASE_SENSITIVE_FIELDS)
+                   for key, value in sorted(fields.items())},
+        'model': model,
+        'prompt_version': prompt_version,
+        'context': context or {},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class PlanCache:
+    """SQLite-backed plan cache with least-recently-used eviction and a time to live"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Shared across batch worker threads, so serialise access ourselves
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "key TEXT PRIMARY KEY, plan TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS plans_last_used ON plans (last_used)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, slots INTEGER NOT NULL, "
+                "output_tokens INTEGER NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS usage_kind ON usage (kind, id)")
+
+    def get(self, key):
+        """Return the cached plan text for key, or None if missing or expired"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT plan, created_at FROM plans WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM plans WHERE key = ?", (key,))
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE plans SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, plan):
+        """Store plan text under key, evicting the least recently used entries beyond max_entries"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO plans (key, plan, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, plan, now, now)
+            )
+            self._conn.execute("DELETE FROM plans WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM plans WHERE key IN ("
+                "SELECT key FROM plans ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def record_usage(self, kind, slots, output_tokens):
+        """
+        Remember how many output tokens a request needed
+
+        Args:
+            kind: What was requested ('plan', 'chunk', 'structured')
+            slots: Size of the request in meal slots (days x meals per day)
+            output_tokens: Output tokens used, across any continuations
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO usage (kind, slots, output_tokens, created_at) VALUES (?, ?, ?, ?)",
+                (kind, slots, output_tokens, time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM usage WHERE kind = ? AND id NOT IN ("
+                "SELECT id FROM usage WHERE kind = ? ORDER BY id DESC LIMIT ?)",
+                (kind, kind, USAGE_HISTORY_ROWS)
+            )
+
+    def usage_history(self, kind, limit=50):
+        """Return (slots, output_tokens) for the most recent requests of a kind, newest first"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT slots, output_tokens FROM usage WHERE kind = ? ORDER BY id DESC LIMIT ?", (kind, limit)
+            ).fetchall()
+
+    def clear(self):
+        """Remove every cached plan"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM plans")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,235 @@
+"""
+Plan IR
+Single-pass lexer turning plan text into a typed, serialisable intermediate representation
+"""
+
+import re
+import json
+from collections import namedtuple
+
+# Nodes, in document order. `line` is the source line, kept so a renderer can
+# fall back to plain text; `meal` names the meal a line belongs to inside a day.
+Section = namedtuple('Section', ['title', 'major', 'line'])
+DayHeader = namedtuple('DayHeader', ['title', 'line'])
+Subsection = namedtuple('Subsection', ['title', 'meal', 'line'])
+Recipe = namedtuple('Recipe', ['title', 'lines'])
+ShoppingList = namedtuple('ShoppingList', ['items', 'spacer_after'])
+Bullet = namedtuple('Bullet', ['text', 'meal', 'line'])
+Paragraph = namedtuple('Paragraph', ['text', 'meal', 'line'])
+
+NODE_TYPES = {node_type.__name__: node_type for node_type in (
+    Section, DayHeader, Subsection, Recipe, ShoppingList, Bullet, Paragraph
+)}
+
+DAY_HEADER_PATTERN = re.compile(
+    r'#{0,3}\s*\*{0,2}(?:DAY\s*\d+|MONDAY|TUESDAY|WEDNESDAY|THURSDAY|FRIDAY|SATURDAY|SUNDAY)',
+    re.IGNORECASE
+)
+MAJOR_SECTION_PATTERN = re.compile('|'.join(re.escape(keyword) for keyword in [
+    'NUTRITIONAL ANALYSIS', 'MEAL PLAN', 'DAY MEAL PLAN', 'RECIPES',
+    'SHOPPING LIST', 'MEAL PREP', 'ADDITIONAL TIPS', 'TIPS & ADVICE',
+    'TIPS AND ADVICE', 'HYDRATION', 'SUPPLEMENT'
+]))
+# Bold lines inside a recipe that head its parts rather than start a new recipe
+RECIPE_SUBHEADINGS = {'ingredients', 'method', 'instructions', 'steps', 'nutrition', 'notes', 'tips'}
+RECIPE_INDICATOR_PATTERN = re.compile('breakfast:|lunch:|dinner:|snack:|recipe|serves|prep time|cook time')
+MEAL_PATTERN = re.compile(
+    r'[#*\s\-•]*(breakfast|brunch|lunch|dinner|supper|snacks?|pre-workout|post-workout)\b', re.IGNORECASE
+)
+
+BULLET_CHARS = ('-', '•', '*')
+SHOPPING_CHARS = ('-', '•', '*', '☐')
+# Shopping list subheadings that introduce advice rather than items
+SHOPPING_ADVICE_PATTERN = re.compile(r'tip|cost|budget|saving|price', re.IGNORECASE)
+# Strips markdown emphasis and heading characters in one pass
+MARKUP_CHARS = str.maketrans('', '', '*#')
+
+
+class PlanLexer:
+    """
+    Incremental lexer for plan text
+
+    Feed lines one at a time (or use lex_plan for a whole plan); each call
+    returns the nodes completed by that line. Recipes and shopping lists are
+    emitted once their last line is known.
+    """
+
+    def __init__(self):
+        self.current_section = ""
+        self._in_day = False
+        self._in_recipe = False
+        self._recipe_lines = []
+        self._recipe_title = ""
+        self._shopping_items = []
+        self._in_shopping_list = False
+        # A blank line inside the shopping list may end it, depending on the line after
+        self._blank_in_shopping_list = False
+
+    def feed_line(self, raw_line):
+        """Lex one line, returning the list of nodes it completes"""
+        nodes = []
+        line = raw_line.strip()
+        self._resolve_blank_line(line, nodes)
+
+        # Blank lines end recipes
+        if not line:
+            if self._in_recipe and self._recipe_lines:
+                nodes.append(self._take_recipe())
+            if self._in_shopping_list and self._shopping_items:
+                self._blank_in_shopping_list = True
+            return nodes
+
+        # "**Ingredients**" and the like head parts of the open recipe
+        if self._in_recipe and line.translate(MARKUP_CHARS).strip().rstrip(':').lower() in RECIPE_SUBHEADINGS:
+            self._recipe_lines.append(line)
+
+        # Main sections (all caps, **SECTION** or markdown heading), except recipe titles in bold
+        elif ((line.isupper() and len(line) > 3) or
+                (line.startswith('**') and line.endswith('**') and line.count('**') == 2) or
+                line.startswith(('## ', '# '))) and not self._is_bold_recipe_title(line):
+            self._flush_open_blocks(nodes)
+            title = line.translate(MARKUP_CHARS).strip()
+            self.current_section = title.upper()
+            # All-caps day headings ("**DAY 1:**") are laid out as sections but still open a day
+            self._in_day = bool(DAY_HEADER_PATTERN.match(line))
+            nodes.append(Section(title, self._is_major_section(line), line))
+
+            if 'SHOPPING' in self.current_section:
+                self._in_shopping_list = True
+
+        elif DAY_HEADER_PATTERN.match(line):
+            self._in_day = True
+            nodes.append(DayHeader(line.translate(MARKUP_CHARS).strip(), line))
+
+        # Subsections (### or bold text with colon)
+        elif line.startswith('###') or (line.startswith('**') and ':' in line and not self._in_recipe and
+                                        not self._is_recipe_title(line)):
+            title = line.replace('###', '').replace('**', '').strip()
+            nodes.append(Subsection(title, self._meal(line), line))
+            # Each category of a shopping list is a checklist of its own
+            if 'SHOPPING' in self.current_section and line.startswith('###') and \
+                    not SHOPPING_ADVICE_PATTERN.search(title):
+                self._in_shopping_list = True
+
+        # Once a recipe is open, only a bold title starts the next one: its
+        # "Serves 2 | Prep time: 10 min" line looks like a title too
+        elif 'RECIPE' in self.current_section and (
+                self._is_bold_recipe_title(line) or not self._in_recipe and self._is_recipe_title(line)):
+            if self._in_recipe and self._recipe_lines:
+                nodes.append(Recipe(self._recipe_title, self._recipe_lines))
+                self._recipe_lines = []
+            self._recipe_title = line.translate(MARKUP_CHARS).strip()
+            self._in_recipe = True
+
+        elif self._in_recipe:
+            self._recipe_lines.append(line)
+
+        elif line.startswith(BULLET_CHARS):
+            if self._in_shopping_list:
+                self._shopping_items.append(line)
+            else:
+                nodes.append(Bullet(line[1:].strip(), self._meal(line), line))
+
+        else:
+            nodes.append(Paragraph(line, self._meal(line), line))
+
+        return nodes
+
+    def interrupt(self, next_line):
+        """
+        Close any open recipe or shopping list ahead of a heading that will not be fed
+
+        Used when a pre-lexed block starting with next_line is spliced in.
+        """
+        nodes = []
+        self._resolve_blank_line(next_line.strip(), nodes)
+        self._flush_open_blocks(nodes)
+        self._in_day = False
+        return nodes
+
+    def finish(self):
+        """Return the nodes still open once the last line has been fed"""
+        nodes = []
+        self._blank_in_shopping_list = False
+        if self._in_recipe and self._recipe_lines:
+            nodes.append(self._take_recipe())
+        if self._shopping_items:
+            nodes.append(self._take_shopping_list(spacer_after=False))
+        return nodes
+
+    def _resolve_blank_line(self, line, nodes):
+        """Decide whether a blank line in the shopping list ended it, now the next line is known"""
+        if self._blank_in_shopping_list:
+            self._blank_in_shopping_list = False
+            if line and not line.startswith(SHOPPING_CHARS):
+                nodes.append(self._take_shopping_list(spacer_after=True))
+
+    def _flush_open_blocks(self, nodes):
+        if self._in_recipe and self._recipe_lines:
+            nodes.append(self._take_recipe())
+        if self._shopping_items:
+            nodes.append(self._take_shopping_list(spacer_after=False))
+
+    def _take_recipe(self):
+        node = Recipe(self._recipe_title, self._recipe_lines)
+        self._recipe_lines = []
+        self._recipe_title = ""
+        self._in_recipe = False
+        return node
+
+    def _take_shopping_list(self, spacer_after):
+        node = ShoppingList(self._shopping_items, spacer_after)
+        self._shopping_items = []
+        self._in_shopping_list = False
+        return node
+
+    def _is_major_section(self, line):
+        """Check if line is a major section header"""
+        return bool(MAJOR_SECTION_PATTERN.search(line.upper().translate(MARKUP_CHARS)))
+
+    def _is_bold_recipe_title(self, line):
+        """Check if a bold line in the recipes section names a recipe rather than a section"""
+        if 'RECIPE' not in self.current_section or not (line.startswith('**') and line.endswith('**')):
+            return False
+        clean = line.translate(MARKUP_CHARS).strip()
+        return (line.count('**') == 2 and ':' not in clean and not self._is_major_section(line)
+                and clean.lower() not in RECIPE_SUBHEADINGS)
+
+    def _is_recipe_title(self, line):
+        """Check if line looks like a recipe title"""
+        clean = line.translate(MARKUP_CHARS).strip()
+        # Recipe titles are often bold and not too long
+        if line.startswith('**') and len(clean) < 60 and ':' not in clean:
+            return True
+        return bool(RECIPE_INDICATOR_PATTERN.search(clean.lower()))
+
+    def _meal(self, line):
+        """Name of the meal a line inside a day block introduces, if any"""
+        if not self._in_day:
+            return None
+        match = MEAL_PATTERN.match(line)
+        return match.group(1).lower() if match else None
+
+
+def lex_plan(plan_text):
+    """Lex a whole plan into a list of IR nodes"""
+    lexer = PlanLexer()
+    nodes = []
+    for line in plan_text.split('\n'):
+        nodes.extend(lexer.feed_line(line))
+    nodes.extend(lexer.finish())
+    return nodes
+
+
+def nodes_to_json(nodes):
+    """Serialise IR nodes to a JSON string"""
+    return json.dumps([dict(node._asdict(), type=type(node).__name__) for node in nodes])
+
+
+def nodes_from_json(data):
+    """Rebuild IR nodes from nodes_to_json output"""
+    nodes = []
+    for item in json.loads(data):
+        node_type = NODE_TYPES[item.pop('type')]
+        nodes.append(node_type(**item))
+    return nodes
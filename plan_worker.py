@@ -0,0 +1,221 @@
+"""
+Plan Worker
+Resident worker that runs queued plan jobs on warm API clients, with a graceful drain on shutdown
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import time
+import instrumentation
+from types import SimpleNamespace
+from job_queue import JobQueue
+from message_batches import placeholder_message, placeholder_plan
+from nutrition_plan_generator import summarise_usage
+
+DEFAULT_WORKER_CONCURRENCY = 4
+# How often an idle worker looks for new jobs
+DEFAULT_POLL_SECONDS = 1.0
+
+
+class StubMessages:
+    """
+    Offline stand-in for client.messages
+
+    Every request is answered with respond(params) (placeholder_plan by
+    default) after latency seconds, so the worker can be run and timed
+    without an API key or network.
+    """
+
+    def __init__(self, respond=None, latency=0.0):
+        self.respond = respond or placeholder_plan
+        self.latency = latency
+        self.requests = 0
+
+    def create(self, **request):
+        self.requests += 1
+        time.sleep(self.latency)
+        return placeholder_message(request, self.respond)
+
+
+class AsyncStubMessages(StubMessages):
+    """Async counterpart of StubMessages, for the async client"""
+
+    async def create(self, **request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return placeholder_message(request, self.respond)
+
+
+def use_stub_api(generator, respond=None, latency=0.0):
+    """Give generator offline stand-in API clients instead of calling setup_api"""
+    generator.client = SimpleNamespace(messages=StubMessages(respond, latency))
+    generator.async_client = SimpleNamespace(messages=AsyncStubMessages(respond, latency))
+
+
+class PlanWorker:
+    """
+    Long-running worker pulling plan jobs from a JobQueue
+
+    One generator (and its API clients, plan cache and recipe library) is
+    set up once and shared by up to concurrency jobs at a time, so no job
+    pays for interpreter start-up, imports or client setup. Jobs are taken
+    lane by lane (paid first), and each job's files and outcome are written
+    back to the queue. A job that raises is put back in its lane until it
+    has had the queue's max_attempts. If a job's lease ran out while it ran
+    (a stalled worker), the job may have been claimed again, so its result is
+    discarded rather than written over the new claim.
+
+    SIGTERM or SIGINT drains the worker: no new jobs are claimed and the
+    running ones are finished. A second signal stops at once, handing the
+    unfinished jobs back to the queue.
+    """
+
+    def __init__(self, generator, queue, concurrency=DEFAULT_WORKER_CONCURRENCY, render_pool=None,
+                 poll_seconds=DEFAULT_POLL_SECONDS, name=None):
+        self.generator = generator
+        self.queue = queue
+        self.concurrency = concurrency
+        self.render_pool = render_pool
+        self.poll_seconds = poll_seconds
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.stats = {'ok': 0, 'failed': 0, 'retried': 0, 'lost': 0}
+        self.draining = False
+        # Claim tokens of the jobs being run (a job claimed again after its lease ran out has a new one)
+        self._running = set()
+        self._slots = []
+        self._wake = None
+
+    def drain(self):
+        """Stop claiming jobs; the worker returns once the running ones are finished"""
+        self.draining = True
+        if self._wake is not None:
+            self._wake.set()
+
+    def _on_signal(self):
+        if self.draining:
+            print("🛑 Stopping now; unfinished jobs go back to the queue")
+            for slot in self._slots:
+                slot.cancel()
+            return
+        print(f"⏳ Draining: finishing {len(self._running)} running jobs (signal again to stop now)")
+        self.drain()
+
+    def _warm_up(self):
+        """Import reportlab and build the shared PDF styles before the first job, unless a render pool does it"""
+        if self.render_pool is None:
+            from pdf_generator import NutritionPlanPDF, get_render_context
+            get_render_context(NutritionPlanPDF.default_theme())
+
+    async def serve(self, exit_when_idle=False):
+        """
+        Run jobs until drained, or with exit_when_idle until no job is left to claim
+
+        Returns:
+            Dict of job counts: 'ok', 'failed', 'retried' and 'lost' (leases that ran out mid-job)
+        """
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        signals = []
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self._on_signal)
+                signals.append(signum)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not the main thread, or a platform without loop signal handlers
+                pass
+
+        await asyncio.to_thread(self._warm_up)
+        print(f"👷 Worker {self.name} running up to {self.concurrency} jobs from {self.queue.path}")
+        renewer = asyncio.create_task(self._renew_leases())
+        self._slots = [asyncio.create_task(self._run_slot(exit_when_idle)) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*self._slots, return_exceptions=True)
+        finally:
+            renewer.cancel()
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+        print(f"👋 Worker stopped: {self.stats['ok']} jobs done, {self.stats['failed']} failed, "
+              f"{self.stats['retried']} requeued" + (f", {self.stats['lost']} lost" if self.stats['lost'] else ""))
+        return self.stats
+
+    async def _run_slot(self, exit_when_idle):
+        """Claim and run jobs one at a time until the worker drains"""
+        while not self.draining:
+            job = await asyncio.to_thread(self.queue.claim, self.name)
+            if job is None:
+                if exit_when_idle and not self._running:
+                    return
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    async def _renew_leases(self):
+        """Keep the leases of running jobs alive, so other workers don't take them over"""
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            await asyncio.to_thread(self.queue.renew, list(self._running))
+
+    def _lost_lease(self, job, fields):
+        """Note a job whose lease ran out before it finished; its outcome is dropped, the queue's claim stands"""
+        self.stats['lost'] += 1
+        fields['status'] = 'lost'
+        print(f"⚠️  Job {job['job_id']} ({job['lane']}): lease ran out before it finished; "
+              f"result discarded (the job is back with the queue)")
+
+    async def _run_job(self, job):
+        """Generate, save and optionally render one job's plan, recording the outcome in the queue"""
+        job_id, user_data = job['job_id'], job['profile']
+        self._running.add(job['claim'])
+        started = time.perf_counter()
+        with instrumentation.span('worker_job', job_id=job_id, lane=job['lane'], attempt=job['attempts'],
+                                  queued_seconds=job['started_at'] - job['created_at']) as fields:
+            try:
+                if job['output_dir']:
+                    os.makedirs(job['output_dir'], exist_ok=True)
+                plan, usage = await self.generator.request_plan_async(user_data, refresh=job['refresh'],
+                                                                      structured=job['structured'])
+                text_path = await asyncio.to_thread(self.generator.save_plan, plan, user_data, job['output_dir'])
+                pdf_path = None
+                if job['make_pdf']:
+                    pdf_path = await asyncio.to_thread(self.generator.generate_pdf, plan, user_data,
+                                                       job['output_dir'], render_pool=self.render_pool)
+                result = {'cached': usage is None, 'structured': isinstance(plan, dict),
+                          'seconds': time.perf_counter() - started, **summarise_usage(usage)}
+                # The text plan is what the client needs; a PDF that failed is noted, not retried
+                error = "PDF generation failed (text plan saved)" if job['make_pdf'] and not pdf_path else None
+                if not await asyncio.to_thread(self.queue.finish, job_id, job['claim'], 'ok', text_path, pdf_path,
+                                               result, error):
+                    self._lost_lease(job, fields)
+                    return
+                self.stats['ok'] += 1
+                fields['status'] = 'ok'
+                print(f"✅ Job {job_id} ({job['lane']}): {user_data['name']}'s plan done in {result['seconds']:.1f}s")
+
+            except asyncio.CancelledError:
+                self.queue.release(job_id, job['claim'])
+                fields['status'] = 'released'
+                raise
+            except Exception as e:
+                if not await asyncio.to_thread(self.queue.retry, job_id, job['claim'], str(e)):
+                    self._lost_lease(job, fields)
+                    return
+                retried = job['attempts'] < self.queue.max_attempts
+                self.stats['retried' if retried else 'failed'] += 1
+                fields['status'] = 'retried' if retried else 'failed'
+                print(f"❌ Job {job_id} ({job['lane']}): {user_data['name']}: {e}" +
+                      (" (requeued)" if retried else f" (failed after {job['attempts']} attempts)"))
+            finally:
+                self._running.discard(job['claim'])
+
+
+def run_worker(generator, queue=None, concurrency=DEFAULT_WORKER_CONCURRENCY, render_pool=None,
+               poll_seconds=DEFAULT_POLL_SECONDS, exit_when_idle=False):
+    """Serve queue (the default JobQueue if None) until drained, returning the worker's job counts"""
+    worker = PlanWorker(generator, queue or JobQueue(), concurrency, render_pool, poll_seconds)
+    return asyncio.run(worker.serve(exit_when_idle=exit_when_idle))
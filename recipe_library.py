@@ -0,0 +1,311 @@
+"""
+Recipe Library
+Persistent store of recipe cards from past plans, so the model can name a known recipe instead of writing it out
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from plan_ir import MARKUP_CHARS, RECIPE_SUBHEADINGS, Recipe, lex_plan
+
+DEFAULT_LIBRARY_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nutrition_plans', 'recipes.sqlite3')
+# Most recipes offered in one prompt, most used first
+DEFAULT_PROMPT_RECIPES = 30
+
+# A stored recipe card. lines are its body as written under the title in a
+# text plan; ingredients and method are pulled out of them for structured plans.
+LibraryRecipe = namedtuple('LibraryRecipe', ['id', 'name', 'servings', 'lines', 'ingredients', 'method', 'tags'])
+
+# How a plan refers to a library recipe, on its own line in the recipes section
+RECIPE_REFERENCE_PATTERN = re.compile(r'^[ \t*#\-•]*\[R(\d+)\][ \t*]*(.*)$', re.MULTILINE)
+RECIPES_HEADING_PATTERN = re.compile(r'^\s*#{0,3}\s*\**\s*(?:\d+\.\s*)?RECIPES\b.*$', re.MULTILINE)
+NEXT_SECTION_PATTERN = re.compile(r'^\s*#{1,2}\s|^\s*\**\s*(?:\d+\.\s*)?(?:SHOPPING LIST|PERSONAL NOTES|MEAL PREP GUIDE)',
+                                  re.MULTILINE)
+SERVINGS_PATTERN = re.compile(r'\b(?:serves|servings?|portions?|makes)\W{0,3}(\d+)', re.IGNORECASE)
+TITLE_SUFFIX_PATTERN = re.compile(r'\s*(?:[-–|(]\s*)?(?:serves|servings?|makes)\b.*$', re.IGNORECASE)
+NUMBERED_PATTERN = re.compile(r'^\d+[.)]\s*')
+
+# Words that rule a recipe out of each dietary tag. Tags say what a recipe is free of.
+_MEAT = r'chicken|beef|pork|lamb|turkey|bacon|ham|sausages?|chorizo|duck|gammon|salami|pepperoni|venison|steak|mince'
+_FISH = r'salmon|tuna|cod|haddock|mackerel|sardines?|anchov\w*|trout|sea bass|fish|pollock|hake|kipper'
+_SHELLFISH = r'prawns?|shrimps?|crab|lobster|mussels|scallops?|squid|clams?|oysters?'
+_DAIRY = (r'milk|cheese|cheddar|feta|halloumi|mozzarella|parmesan|ricotta|paneer|quark|yog(?:h)?urt|butter|cream|'
+          r'cr[eè]me fra[iî]che|ghee|whey|skyr|kefir|cottage')
+_GLUTEN = (r'wheat|flour|bread|breadcrumbs|pasta|spaghetti|penne|noodles|couscous|bulgur|barley|rye|spelt|'
+           r'wraps?|tortillas?|pittas?|bagels?|crackers|soy sauce|seitan|oats?|granola|muesli')
+_NUTS = r'almonds?|walnuts?|cashews?|peanuts?|pecans?|hazelnuts?|pistachios?|macadamias?|brazil nuts?|nuts?'
+TAG_EXCLUSIONS = {
+    'vegetarian': rf'\b(?:{_MEAT}|{_FISH}|{_SHELLFISH}|gelatine)\b',
+    'vegan': rf'\b(?:{_MEAT}|{_FISH}|{_SHELLFISH}|{_DAIRY}|eggs?|honey|gelatine|mayonnaise)\b',
+    'pescatarian': rf'\b(?:{_MEAT}|gelatine)\b',
+    'dairy-free': rf'\b(?:{_DAIRY})\b',
+    'gluten-free': rf'\b(?:{_GLUTEN})\b',
+    'nut-free': rf'\b(?:{_NUTS})\b',
+    'egg-free': r'\b(?:eggs?|mayonnaise)\b',
+    'fish-free': rf'\b(?:{_FISH}|{_SHELLFISH})\b',
+    'shellfish-free': rf'\b(?:{_SHELLFISH})\b',
+}
+_TAG_PATTERNS = {tag: re.compile(pattern, re.IGNORECASE) for tag, pattern in TAG_EXCLUSIONS.items()}
+# Plant and nut "dairy" that isn't dairy
+NON_DAIRY_PATTERN = re.compile(r'\b(?:oat|almond|soya?|coconut|rice|cashew|peanut|nut)\s+(?:milk|yog(?:h)?urt|butter|'
+                               r'cream|drink)\b|\bbutter beans?\b|\bcream crackers\b', re.IGNORECASE)
+GLUTEN_FREE_PATTERN = re.compile(r'\bgluten[- ]free\s+\w+', re.IGNORECASE)
+
+# Tags a client needs, from their diet type and allergies
+DIET_TAGS = {'vegan': 'vegan', 'vegetarian': 'vegetarian', 'pescatarian': 'pescatarian',
+             'dairy-free': 'dairy-free', 'dairy free': 'dairy-free', 'gluten-free': 'gluten-free',
+             'gluten free': 'gluten-free', 'coeliac': 'gluten-free', 'celiac': 'gluten-free'}
+ALLERGY_TAGS = {'nut': 'nut-free', 'peanut': 'nut-free', 'dairy': 'dairy-free', 'lactose': 'dairy-free',
+                'milk': 'dairy-free', 'gluten': 'gluten-free', 'wheat': 'gluten-free', 'coeliac': 'gluten-free',
+                'celiac': 'gluten-free', 'egg': 'egg-free', 'fish': 'fish-free', 'shellfish': 'shellfish-free',
+                'seafood': 'fish-free', 'crustacean': 'shellfish-free'}
+
+
+def normalise_recipe_name(name):
+    """Normalise a recipe title so the same dish is stored once: "**Overnight Oats - Serves 2**" -> "overnight oats\""""
+    name = TITLE_SUFFIX_PATTERN.sub('', name.translate(MARKUP_CHARS))
+    name = re.sub(r'\([^)]*\)', ' ', name.lower().replace('&', ' and '))
+    return ' '.join(re.findall(r'[a-z0-9]+', name))
+
+
+def _split_card(lines):
+    """Pull the ingredient lines and method steps out of a recipe card's lines"""
+    ingredients, method = [], []
+    part = None
+    for line in lines:
+        clean = line.translate(MARKUP_CHARS).strip()
+        heading = clean.rstrip(':').strip().lower()
+        if heading in RECIPE_SUBHEADINGS or heading in ('directions', 'preparation'):
+            part = 'ingredients' if heading == 'ingredients' else 'method' if heading in (
+                'method', 'instructions', 'steps', 'directions', 'preparation') else None
+        elif part == 'ingredients' and clean.startswith(('-', '•')):
+            ingredients.append(clean.lstrip('-• ').strip())
+        elif part == 'method' and (NUMBERED_PATTERN.match(clean) or clean.startswith(('-', '•'))):
+            method.append(NUMBERED_PATTERN.sub('', clean.lstrip('-• ')).strip())
+    return ingredients, method
+
+
+def recipe_tags(ingredients):
+    """Dietary tags a recipe qualifies for, from its ingredient lines (and title, if included)"""
+    text = '\n'.join(ingredients)
+    # Oat milk doesn't rule out dairy-free, nor gluten-free oats gluten-free; peanut butter still has nuts
+    relaxed = GLUTEN_FREE_PATTERN.sub(' ', NON_DAIRY_PATTERN.sub(' ', text))
+    tags = []
+    for tag, pattern in _TAG_PATTERNS.items():
+        if not pattern.search(relaxed if tag in ('dairy-free', 'vegan', 'gluten-free') else text):
+            tags.append(tag)
+    return tags
+
+
+def required_tags(user_data):
+    """Dietary tags every recipe for a client must have"""
+    diet = str(user_data.get('dietary_type', '')).lower()
+    allergies = str(user_data.get('allergies', '')).lower()
+    tags = {tag for word, tag in DIET_TAGS.items() if word in diet}
+    tags.update(tag for word, tag in ALLERGY_TAGS.items() if re.search(rf'\b{word}', allergies))
+    return sorted(tags)
+
+
+def avoided_words(user_data):
+    """Words from a client's allergies and dislikes that no offered recipe may mention"""
+    text = f"{user_data.get('allergies', '')},{user_data.get('dislikes', '')}"
+    words = []
+    for term in re.split(r'[,;/\n]|\band\b', text.lower()):
+        term = term.strip(' .')
+        if term and term not in ('none', 'no', 'n/a', 'nothing'):
+            # "mushrooms" also rules out "mushroom"
+            words.append(term[:-1] if term.endswith('s') and len(term) > 3 else term)
+    return words
+
+
+class RecipeLibrary:
+    """
+    SQLite-backed recipe library, indexed by normalised name and dietary tag
+
+    Recipes are learnt from the cards in generated plans. A prompt offers the
+    client's suitable recipes by ID, and plans that name one by ID have the
+    card filled in from here. Safe to share between threads.
+    """
+
+    def __init__(self, path=DEFAULT_LIBRARY_PATH):
+        self.path = path
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS recipes ("
+                "id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, name TEXT NOT NULL, servings INTEGER NOT NULL, "
+                "lines TEXT NOT NULL, ingredients TEXT NOT NULL, uses INTEGER NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS recipe_tags ("
+                "tag TEXT NOT NULL, recipe_id INTEGER NOT NULL, PRIMARY KEY (tag, recipe_id))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS recipes_uses ON recipes (uses)")
+
+    def add(self, title, lines):
+        """
+        Store a recipe card, or count another use of one already stored under the same name
+
+        Cards without both ingredients and method steps aren't stored.
+
+        Returns:
+            The recipe's ID, or None if it wasn't stored
+        """
+        key = normalise_recipe_name(title)
+        ingredients, method = _split_card(lines)
+        if not key:
+            return None
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id FROM recipes WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE recipes SET uses = uses + 1 WHERE id = ?", (row[0],))
+                return row[0]
+            if not ingredients or not method:
+                return None
+
+            servings = SERVINGS_PATTERN.search(' '.join([title] + lines[:3]))
+            name = TITLE_SUFFIX_PATTERN.sub('', title.translate(MARKUP_CHARS)).strip()
+            # The title's "Serves 2" is kept in the stored lines instead
+            body = [line for line in lines if line.strip()]
+            if servings and not SERVINGS_PATTERN.search(' '.join(body[:3])):
+                body.insert(0, f"Serves: {servings.group(1)}")
+            recipe_id = self._conn.execute(
+                "INSERT INTO recipes (key, name, servings, lines, ingredients, uses, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (key, name, int(servings.group(1)) if servings else 1, json.dumps(body),
+                 '\n'.join(ingredients).lower(), time.time())
+            ).lastrowid
+            self._conn.executemany("INSERT INTO recipe_tags (tag, recipe_id) VALUES (?, ?)",
+                                   [(tag, recipe_id) for tag in recipe_tags([name] + ingredients)])
+            return recipe_id
+
+    def add_from_plan(self, plan):
+        """
+        Learn the recipe cards in a plan (text, or a structured plan dict)
+
+        Returns:
+            Number of recipes stored or counted
+        """
+        if isinstance(plan, dict):
+            cards = [(recipe['name'], _structured_lines(recipe)) for recipe in plan.get('recipes', [])]
+        else:
+            cards = [(node.title, node.lines) for node in lex_plan(plan) if isinstance(node, Recipe)]
+        return sum(1 for title, lines in cards if self.add(title, lines) is not None)
+
+    def get(self, recipe_id):
+        """Return the LibraryRecipe with an ID, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, name, servings, lines FROM recipes WHERE id = ?", (recipe_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            tags = [tag for tag, in self._conn.execute("SELECT tag FROM recipe_tags WHERE recipe_id = ?", (row[0],))]
+        lines = json.loads(row[3])
+        ingredients, method = _split_card(lines)
+        return LibraryRecipe(row[0], row[1], row[2], lines, ingredients, method, tags)
+
+    def suitable(self, user_data, limit=DEFAULT_PROMPT_RECIPES):
+        """
+        The most used recipes that suit a client's diet, allergies and dislikes
+
+        Returns:
+            List of (id, name, servings), most used first
+        """
+        tags = required_tags(user_data)
+        avoided = avoided_words(user_data)
+        query = "SELECT id, name, servings, ingredients FROM recipes"
+        if tags:
+            query += (" WHERE id IN (SELECT recipe_id FROM recipe_tags WHERE tag IN "
+                      f"({', '.join('?' * len(tags))}) GROUP BY recipe_id HAVING COUNT(*) = ?)")
+        query += " ORDER BY uses DESC, id"
+        with self._lock:
+            rows = self._conn.execute(query, tags + [len(tags)] if tags else []).fetchall()
+        suitable = []
+        for recipe_id, name, servings, ingredients in rows:
+            text = f"{name.lower()}\n{ingredients}"
+            if any(word in text for word in avoided):
+                continue
+            suitable.append((recipe_id, name, servings))
+            if len(suitable) >= limit:
+                break
+        return suitable
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM recipes").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def _structured_lines(recipe):
+    """A structured plan recipe as recipe card lines"""
+    lines = [f"Serves: {recipe['servings']}"] if recipe.get('servings') else []
+    lines.append("Ingredients:")
+    lines.extend(f"- {ingredient}" for ingredient in recipe.get('ingredients', []))
+    lines.append("Method:")
+    lines.extend(f"{number}. {step}" for number, step in enumerate(recipe.get('method', []), 1))
+    return lines
+
+
+def format_known_recipes(recipes, structured=False):
+    """The library recipes offered to the model, as a block for the client's prompt"""
+    if structured:
+        usage = ("set a recipe's library_id to the ID, e.g. \"R12\", and leave its ingredients and method empty, "
+                 "and they are filled in for you")
+    else:
+        usage = ("write only its ID and name on one line in the recipes section, e.g. "
+                 "\"[R12] Overnight Oats with Berries\", and it is filled in for you")
+    lines = [f"KNOWN RECIPES (already in our recipe library - for any of these you use, {usage}; "
+             "write out any other recipe in full):"]
+    lines.extend(f"- [R{recipe_id}] {name} (serves {servings})" for recipe_id, name, servings in recipes)
+    return '\n'.join(lines)
+
+
+def expand_recipe_lines(text, library):
+    """Replace any "[R12] Name" lines in text with the library's recipe card, leaving unknown IDs as they are"""
+    def expand(match):
+        recipe = library.get(int(match.group(1)))
+        if recipe is None:
+            return match.group(0)
+        return '\n'.join([f"**{recipe.name}**"] + recipe.lines)
+
+    return RECIPE_REFERENCE_PATTERN.sub(expand, text)
+
+
+def expand_recipe_references(plan_text, library):
+    """
+    Replace "[R12] Name" lines in a text plan with the full recipe card from the library
+
+    Only the recipes section is expanded. A reference to a recipe the
+    library doesn't have is left as it is.
+    """
+    section = RECIPES_HEADING_PATTERN.search(plan_text)
+    if section is None:
+        return plan_text
+
+    end = NEXT_SECTION_PATTERN.search(plan_text, section.end())
+    end = end.start() if end else len(plan_text)
+    return plan_text[:section.end()] + expand_recipe_lines(plan_text[section.end():end], library) + plan_text[end:]
+
+
+def expand_structured_recipes(data, library):
+    """Fill in the ingredients and method of structured plan recipes given only a library_id, in place"""
+    for recipe in data.get('recipes', []):
+        if recipe.get('ingredients') or not recipe.get('library_id'):
+            continue
+        stored = library.get(int(re.sub(r'\D', '', str(recipe['library_id'])) or 0))
+        if stored is None:
+            continue
+        recipe.update(name=recipe.get('name') or stored.name, servings=stored.servings,
+                      ingredients=stored.ingredients, method=stored.method)
+    return data
@@ -0,0 +1,144 @@
+"""
+Render Pool
+Renders plan PDFs in worker processes, so bulk jobs use every core instead of one
+"""
+
+import io
+import os
+import time
+import threading
+import instrumentation
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Each worker loads these once, in _init_worker
+_worker_theme = None
+
+
+def _init_worker(theme):
+    """Import reportlab and build the theme's shared styles before the first job arrives"""
+    global _worker_theme
+    from pdf_generator import NutritionPlanPDF, dedicate_process_to_renders, get_render_context
+    # A worker runs one job at a time, so each build's peak RSS is its own
+    dedicate_process_to_renders()
+    _worker_theme = theme or NutritionPlanPDF.default_theme()
+    get_render_context(_worker_theme)
+
+
+def _render_job(plan, user_data, output_path, theme):
+    """
+    Render one PDF in a worker
+
+    Jobs arrive as plan text (or a structured plan dict) plus the profile, and
+    never raise: failures come back in the result so one bad plan can't take
+    the pool down with it. With no output_path the PDF comes back as bytes
+    in result['pdf'] instead of being written to disk.
+    """
+    from pdf_generator import create_nutrition_plan_pdf, create_nutrition_plan_pdf_from_ir
+    from structured_plan import plan_to_ir
+
+    started = time.perf_counter()
+    result = {'output_path': output_path, 'status': 'failed', 'pid': os.getpid(), 'stats': {}}
+    try:
+        theme = theme or _worker_theme
+        output = output_path or io.BytesIO()
+        if isinstance(plan, dict):
+            create_nutrition_plan_pdf_from_ir(
+                plan_to_ir(plan, user_data), user_data, output, theme=theme, stats=result['stats']
+            )
+        else:
+            create_nutrition_plan_pdf(plan, user_data, output, theme=theme, stats=result['stats'])
+        if output_path is None:
+            result['pdf'] = output.getvalue()
+        result['status'] = 'ok'
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+class RenderPool:
+    """
+    Pool of PDF rendering processes with bounded queueing
+
+    submit blocks once max_pending jobs are queued or running, so a fast
+    producer can't pile up plans in memory faster than they are rendered.
+    Safe to share between threads.
+    """
+
+    def __init__(self, workers=None, max_pending=None, theme=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 2
+        self.theme = theme
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.theme,))
+
+    def _restart(self, broken):
+        """Replace a pool whose worker died, unless another thread already has"""
+        with self._lock:
+            if self._executor is broken:
+                print("⚠️  A PDF worker died, restarting the render pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._start()
+
+    def submit(self, plan, user_data, output_path, theme=None):
+        """
+        Queue a render, waiting for a free slot if max_pending jobs are outstanding
+
+        Returns:
+            Future resolving to the job's result dict ('status' is 'ok' or 'failed')
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(_render_job, plan, user_data, output_path, theme)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def render(self, plan, user_data, output_path=None, theme=None, stats=None):
+        """
+        Render one PDF in the pool and wait for it
+
+        A job whose worker crashed is retried once on a fresh pool. If stats
+        is given it is filled with the build's page count, time and peak RSS.
+        The worker's 'pdf_build' span is re-emitted here, where the metrics
+        hooks are.
+
+        Returns:
+            Path to the generated PDF, or its bytes if no output_path was given
+
+        Raises:
+            RuntimeError: if the job failed
+        """
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                result = self.submit(plan, user_data, output_path, theme).result()
+                break
+            except BrokenProcessPool:
+                self._restart(executor)
+                result = {'status': 'failed', 'error': "PDF worker process died"}
+
+        if result['status'] != 'ok':
+            instrumentation.emit('span', name='pdf_build', seconds=result.get('seconds'), error=result['error'])
+            raise RuntimeError(result['error'])
+        instrumentation.emit('span', name='pdf_build', worker_pid=result['pid'], **result['stats'])
+        if stats is not None:
+            stats.update(result['stats'])
+        return result['output_path'] if output_path else result['pdf']
+
+    def close(self):
+        """Wait for queued renders to finish and stop the workers"""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,266 @@
+"""
+Request Policy
+Retries with jittered backoff and hedged duplicates for Messages API calls, to cut failures and tail latency
+"""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import email.utils
+import random
+import threading
+import time
+import instrumentation
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Statuses worth another try: timeouts, conflicts, rate limits and server
+# errors (529 is the API's "overloaded")
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+def _retry_after(error):
+    """Seconds the API asked us to wait before retrying, from the error's response headers, or None"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for retryable API errors
+
+    The wait before retry n is a random time up to base_delay * 2**n (at most
+    max_delay), so clients that failed together don't retry together. A
+    retry-after header from the API is a minimum: we never retry sooner.
+    """
+
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        """Whether a failed request is worth sending again"""
+        # Only called once a request has failed, so the SDK is already loaded
+        import anthropic
+        if isinstance(error, anthropic.APIConnectionError):
+            return True
+        if isinstance(error, anthropic.APIStatusError):
+            return error.status_code in RETRYABLE_STATUSES or error.status_code >= 500
+        return False
+
+    def delay(self, retry, error=None):
+        """Seconds to wait before retry number retry (from 0)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        retry_after = _retry_after(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a slow request, within a cost cap
+
+    Once min_samples latencies of a kind of request are known, a request
+    still unanswered at their percentile gets a duplicate, and whichever
+    answers first is used. Hedges are capped at max_ratio of all requests
+    and, if max_tokens_budget is set, at that many max_tokens in total, so a
+    slow API can't double the bill. Safe to share between threads.
+    """
+
+    def __init__(self, percentile=0.95, min_samples=20, min_delay=5.0, max_ratio=0.05, max_tokens_budget=None,
+                 history=200):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.max_tokens_budget = max_tokens_budget
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_tokens = 0
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self._lock = threading.Lock()
+
+    def observe(self, kind, seconds):
+        """Record how long a successful request of a kind took"""
+        with self._lock:
+            self._latencies[kind].append(seconds)
+
+    def delay(self, kind):
+        """Seconds to wait before hedging a request of a kind, or None if too few latencies are known yet"""
+        with self._lock:
+            self.requests += 1
+            latencies = sorted(self._latencies[kind])
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, latencies[int(self.percentile * (len(latencies) - 1))])
+
+    def allow(self, request):
+        """Claim a hedge for request if the cost caps leave room for one"""
+        with self._lock:
+            if self.hedges + 1 > self.max_ratio * self.requests:
+                return False
+            if self.max_tokens_budget is not None and \
+                    self.hedge_tokens + request['max_tokens'] > self.max_tokens_budget:
+                return False
+            self.hedges += 1
+            self.hedge_tokens += request['max_tokens']
+            return True
+
+
+class RequestRunner:
+    """
+    Sends Messages API requests through a retry policy and, optionally, a hedge policy
+
+    The SDK's own retries should be turned off (max_retries=0 on the client)
+    so attempts aren't multiplied. Each retry is recorded as an 'api_retry'
+    record and each hedge as an 'api_hedge' record (see instrumentation).
+    """
+
+    def __init__(self, retry=None, hedge=None):
+        self.retry = retry or RetryPolicy()
+        self.hedge = hedge
+
+    def _give_up(self, error, retry):
+        return retry >= self.retry.max_retries or not self.retry.is_retryable(error)
+
+    def _retrying(self, error, retry, kind):
+        """Report a retry and return how long to wait before it"""
+        delay = self.retry.delay(retry, error)
+        status = getattr(error, 'status_code', None)
+        print(f"🔁 {kind.capitalize()} request failed ({status or type(error).__name__}), "
+              f"retrying in {delay:.1f}s ({retry + 1}/{self.retry.max_retries})...")
+        instrumentation.emit('api_retry', kind=kind, retry=retry + 1, status=status, error=type(error).__name__,
+                             delay=round(delay, 3), retry_after=_retry_after(error))
+        return delay
+
+    def _observe(self, kind, started):
+        if self.hedge is not None:
+            self.hedge.observe(kind, time.perf_counter() - started)
+
+    def _send(self, send, kind):
+        """Call send() until it succeeds, retrying retryable errors"""
+        for retry in range(self.retry.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                result = send()
+            except Exception as e:
+                if self._give_up(e, retry):
+                    raise
+                time.sleep(self._retrying(e, retry, kind))
+                continue
+            self._observe(kind, started)
+            return result
+
+    async def _send_async(self, send, kind):
+        """Await send() until it succeeds, retrying retryable errors"""
+        for retry in range(self.retry.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                result = await send()
+            except Exception as e:
+                if self._give_up(e, retry):
+                    raise
+                await asyncio.sleep(self._retrying(e, retry, kind))
+                continue
+            self._observe(kind, started)
+            return result
+
+    def _hedged(self, kind, delay, winner, started):
+        instrumentation.emit('api_hedge', kind=kind, delay=round(delay, 3), winner=winner,
+                             seconds=round(time.perf_counter() - started, 4))
+
+    def create(self, client, request, kind):
+        """
+        Send one request on a sync client
+
+        A hedge runs in a second thread. The losing request can't be
+        cancelled there, so it finishes in the background and is discarded.
+        """
+        def send():
+            return self._send(lambda: client.messages.create(**request), kind)
+
+        delay = self.hedge.delay(kind) if self.hedge is not None else None
+        if delay is None:
+            return send()
+
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            # Each thread runs in a copy of this context, so its records keep the trace id
+            primary = executor.submit(contextvars.copy_context().run, send)
+            if wait([primary], timeout=delay).done or not self.hedge.allow(request):
+                return primary.result()
+            backup = executor.submit(contextvars.copy_context().run, send)
+            futures = {primary: 'primary', backup: 'hedge'}
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            # Both may have finished by now: take one that succeeded, else wait for
+            # the other, and only raise if neither succeeded
+            first = next((future for future in done if future.exception() is None), None)
+            if first is None:
+                first = pending.pop() if pending else done.pop()
+            self._hedged(kind, delay, futures[first], started)
+            return first.result()
+        finally:
+            executor.shutdown(wait=False)
+
+    async def create_async(self, client, request, kind):
+        """Send one request on an async client, cancelling the losing request of a hedged pair"""
+        def send():
+            return self._send_async(lambda: client.messages.create(**request), kind)
+
+        delay = self.hedge.delay(kind) if self.hedge is not None else None
+        if delay is None:
+            return await send()
+
+        started = time.perf_counter()
+        primary = asyncio.ensure_future(send())
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self.hedge.allow(request):
+            return await primary
+        backup = asyncio.ensure_future(send())
+        tasks = {primary: 'primary', backup: 'hedge'}
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            first = next((task for task in done if task.exception() is None), None)
+            if first is None:
+                first = pending.pop() if pending else done.pop()
+                await asyncio.wait({first})
+            self._hedged(kind, delay, tasks[first], started)
+            return first.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @contextlib.contextmanager
+    def stream(self, client, request, kind):
+        """
+        Open a message stream, retrying if the request is refused
+
+        Only opening the stream is retried: once text has been yielded, a
+        failure is raised to the caller. Streams aren't hedged.
+        """
+        manager = None
+
+        def open_stream():
+            nonlocal manager
+            manager = client.messages.stream(**request)
+            return manager.__enter__()
+
+        stream = self._send(open_stream, kind)
+        with contextlib.ExitStack() as stack:
+            stack.push(manager)
+            yield stream
@@ -0,0 +1,529 @@
+"""
+Shopping List
+Builds a plan's shopping list locally, totalling recipe ingredients across every day and serving
+"""
+
+import re
+import json
+import hashlib
+import math
+from collections import namedtuple
+from plan_ir import MAJOR_SECTION_PATTERN, MARKUP_CHARS
+
+# One parsed ingredient line. unit is 'g', 'ml', a count unit ('clove', 'tin')
+# or '' for a plain count; quantity is None for "salt to taste" and the like.
+# item is the singular name ingredients are totalled under, name is as written for the list.
+Ingredient = namedtuple('Ingredient', ['item', 'name', 'quantity', 'unit', 'spoons'])
+# One line of the finished list, with its cost in £ (None if it couldn't be priced)
+ShoppingItem = namedtuple('ShoppingItem', ['item', 'name', 'quantity', 'unit', 'spoons', 'cost'])
+# A recipe as the list is built from it: servings and raw ingredient lines
+RecipeIngredients = namedtuple('RecipeIngredients', ['name', 'servings', 'ingredients'])
+
+SHOPPING_HEADING = "## 4. SHOPPING LIST"
+SHOPPING_HEADING_PATTERN = re.compile(r'^\s*#{0,3}\s*\**\s*(?:\d+\.\s*)?SHOPPING LIST', re.MULTILINE | re.IGNORECASE)
+SECTION_5_PATTERN = re.compile(r'^\s*#{0,3}\s*\**\s*(?:5\.\s*)?MEAL PREP GUIDE', re.MULTILINE | re.IGNORECASE)
+PERSONAL_NOTES_LINE_PATTERN = re.compile(r'^\s*#{0,3}\s*\**\s*(?:\d+\.\s*)?PERSONAL NOTES', re.MULTILINE)
+
+# Units converted to grams or millilitres. Spoons are kept apart so small
+# amounts of spices and oils can be shown in spoons again.
+MASS_UNITS = {'g': 1, 'gram': 1, 'grams': 1, 'gr': 1, 'kg': 1000, 'kgs': 1000, 'kilo': 1000, 'kilos': 1000,
+              'kilogram': 1000, 'kilograms': 1000, 'oz': 28.35, 'lb': 453.6, 'lbs': 453.6}
+VOLUME_UNITS = {'ml': 1, 'millilitre': 1, 'millilitres': 1, 'milliliter': 1, 'milliliters': 1, 'cl': 10,
+                'l': 1000, 'litre': 1000, 'litres': 1000, 'liter': 1000, 'liters': 1000,
+                'cup': 240, 'cups': 240, 'pint': 568, 'pints': 568}
+SPOON_UNITS = {'tsp': 5, 'teaspoon': 5, 'teaspoons': 5, 'tbsp': 15, 'tbs': 15, 'tablespoon': 15,
+               'tablespoons': 15, 'dsp': 10}
+COUNT_UNITS = ['clove', 'tin', 'can', 'slice', 'pinch', 'handful', 'bunch', 'sprig', 'pack', 'packet', 'jar',
+               'sachet', 'scoop', 'stick', 'bag', 'fillet', 'piece', 'rasher', 'head', 'knob', 'pot', 'carton',
+               'loaf', 'bottle', 'stalk', 'sheet', 'wrap', 'pouch', 'ball']
+_UNIT_WORDS = sorted(list(MASS_UNITS) + list(VOLUME_UNITS) + list(SPOON_UNITS) +
+                     [unit + suffix for unit in COUNT_UNITS for suffix in ('es', 's', '')], key=len, reverse=True)
+
+FRACTIONS = {'½': 0.5, '¼': 0.25, '¾': 0.75, '⅓': 1 / 3, '⅔': 2 / 3, '⅛': 0.125}
+_NUMBER = r'(?:\d+\s+\d+\s*/\s*\d+|\d+\s*/\s*\d+|\d+(?:\.\d+)?\s*[½¼¾⅓⅔⅛]?|[½¼¾⅓⅔⅛])'
+QUANTITY_PATTERN = re.compile(
+    rf'^(?:(?P<times>\d+)\s*[x×]\s*)?(?P<number>{_NUMBER})(?:\s*(?:-|–|to)\s*(?P<upper>{_NUMBER}))?\s*'
+    rf'(?P<unit>(?:{"|".join(re.escape(unit) for unit in _UNIT_WORDS)})\b\.?)?\s*(?:of\s+)?(?P<item>.*)$',
+    re.IGNORECASE
+)
+# "Chicken breast - 1kg", the layout of model-written shopping lists
+TRAILING_QUANTITY_PATTERN = re.compile(r'^(?P<item>.+?)\s+(?:-|–|:)\s+(?P<quantity>\S.*)$')
+SERVINGS_PATTERN = re.compile(r'\b(?:serves|servings?|portions?|makes)\W{0,3}(\d+)', re.IGNORECASE)
+INGREDIENTS_HEADING_PATTERN = re.compile(r'^ingredients\b', re.IGNORECASE)
+OTHER_HEADING_PATTERN = re.compile(r'^(?:method|instructions|directions|steps|nutrition|per serving|notes?|tips?)\b',
+                                   re.IGNORECASE)
+NUMBERED_PATTERN = re.compile(r'^\d+[.)]\s')
+
+# Preparation words dropped so "2 red onions, diced" and "1 finely chopped red onion" add up
+PREPARATION_WORDS = {'fresh', 'large', 'small', 'medium', 'ripe', 'skinless', 'boneless', 'finely', 'roughly',
+                     'thinly', 'chopped', 'diced', 'sliced', 'grated', 'minced', 'crushed', 'peeled', 'halved',
+                     'cooked', 'uncooked', 'raw', 'trimmed', 'drained', 'rinsed', 'beaten', 'shredded', 'a', 'an'}
+# Products whose names include a preparation word
+PRODUCT_PHRASES = ['chopped tomato', 'cooked ham', 'cooked rice', 'minced beef', 'minced turkey']
+CONTAINER_PATTERN = re.compile(rf'^({"|".join(COUNT_UNITS)})(?:es|s)?\b\s*(?:of\s+)?(.*)$')
+UNQUANTIFIED_PATTERN = re.compile(r'\b(?:to taste|to serve|optional|for (?:frying|greasing|garnish))\b', re.IGNORECASE)
+
+# Categories in the order they're listed, and the keywords that place an
+# item in each, checked in CATEGORY_MATCH_ORDER so "chicken stock" is a
+# cupboard item and "coconut milk" isn't dairy
+CATEGORIES = ['Fruit & Veg', 'Meat & Fish', 'Dairy & Eggs', 'Bakery & Grains', 'Tins, Jars & Cupboard',
+              'Herbs & Spices', 'Frozen', 'Other']
+CATEGORY_KEYWORDS = {
+    'Frozen': ['frozen'],
+    'Tins, Jars & Cupboard': ['stock', 'tinned', 'passata', 'chopped tomato', 'coconut milk', 'sauce', 'paste',
+                              'vinegar', 'mustard', 'honey', 'oil', 'mayonnaise', 'ketchup', 'pesto', 'peanut butter',
+                              'almond butter', 'chickpea', 'lentil', 'kidney bean', 'black bean', 'baked bean',
+                              'butter bean', 'cannellini bean', 'haricot bean', 'tuna', 'sardine', 'syrup', 'sugar',
+                              'cocoa', 'protein powder', 'nut', 'almond', 'walnut', 'cashew', 'seed', 'raisin',
+                              'stevia', 'hummus', 'houmous', 'tahini', 'jam', 'chocolate', 'stock cube'],
+    'Herbs & Spices': ['salt', 'pepper flakes', 'black pepper', 'cumin', 'paprika', 'turmeric', 'cinnamon', 'chilli powder',
+                       'chilli flakes', 'oregano', 'thyme', 'rosemary', 'basil', 'coriander', 'parsley', 'mint',
+                       'dill', 'garam masala', 'curry powder', 'nutmeg', 'ginger', 'bay leaf', 'bay leave',
+                       'mixed herbs', 'seasoning', 'spice'],
+    'Bakery & Grains': ['bread', 'rye', 'wrap', 'tortilla', 'pitta', 'bagel', 'rice', 'pasta', 'spaghetti', 'noodle',
+                        'oat', 'quinoa', 'couscous', 'bulgur', 'flour', 'granola', 'muesli', 'cereal', 'cracker',
+                        'crispbread', 'oatcake', 'barley', 'bun', 'roll'],
+    'Dairy & Eggs': ['egg', 'milk', 'yoghurt', 'yogurt', 'cheese', 'feta', 'halloumi', 'mozzarella', 'parmesan',
+                     'cheddar', 'ricotta', 'butter', 'cream', 'skyr', 'quark', 'kefir', 'paneer'],
+    'Meat & Fish': ['chicken', 'turkey', 'beef', 'pork', 'lamb', 'mince', 'steak', 'bacon', 'ham', 'sausage',
+                    'salmon', 'cod', 'haddock', 'mackerel', 'prawn', 'fish', 'trout', 'tofu', 'tempeh', 'seitan'],
+    'Fruit & Veg': ['apple', 'banana', 'berry', 'blueberry', 'strawberry', 'raspberry', 'blackberry', 'orange', 'lemon', 'lime', 'grape', 'pear', 'mango', 'pineapple',
+                    'kiwi', 'melon', 'avocado', 'tomato', 'onion', 'garlic', 'potato', 'carrot', 'pepper', 'spinach',
+                    'kale', 'lettuce', 'rocket', 'salad', 'cucumber', 'courgette', 'aubergine', 'broccoli',
+                    'cauliflower', 'mushroom', 'celery', 'leek', 'cabbage', 'pea', 'sweetcorn', 'asparagus',
+                    'squash', 'beetroot', 'radish', 'spring onion', 'shallot', 'chilli', 'green bean',
+                    'runner bean', 'fruit', 'veg', 'vegetable'],
+}
+CATEGORY_MATCH_ORDER = ['Frozen', 'Tins, Jars & Cupboard', 'Herbs & Spices', 'Bakery & Grains', 'Dairy & Eggs',
+                        'Meat & Fish', 'Fruit & Veg']
+# Keywords match whole words, so "nut" misses "nutmeg" and "oat" misses "goat"
+_CATEGORY_PATTERNS = [(category, re.compile(rf"\b(?:{'|'.join(CATEGORY_KEYWORDS[category])})\b"))
+                      for category in CATEGORY_MATCH_ORDER]
+
+# Typical UK supermarket prices in £, per kg (mass), litre (volume) or item
+# (count). Deliberately rough: enough to check a plan against a budget.
+# load_price_table merges a local JSON table of the same shape over these.
+DEFAULT_PRICES = {
+    'chicken breast': (6.50, 'kg'), 'chicken thigh': (4.50, 'kg'), 'turkey mince': (6.00, 'kg'),
+    'beef mince': (6.50, 'kg'), 'lean beef mince': (7.50, 'kg'), 'salmon': (15.00, 'kg'), 'cod': (12.00, 'kg'),
+    'prawn': (14.00, 'kg'), 'tuna': (0.80, 'tin'), 'tofu': (5.50, 'kg'), 'egg': (0.25, 'each'),
+    'milk': (1.00, 'l'), 'greek yoghurt': (3.00, 'kg'), 'yoghurt': (2.50, 'kg'), 'cheddar': (8.00, 'kg'),
+    'feta': (9.00, 'kg'), 'halloumi': (11.00, 'kg'), 'cottage cheese': (4.00, 'kg'), 'butter': (7.50, 'kg'),
+    'oat': (1.20, 'kg'), 'brown rice': (2.00, 'kg'), 'rice': (1.60, 'kg'),
+    'quinoa': (6.00, 'kg'), 'pasta': (1.20, 'kg'), 'wholemeal bread': (1.20, 'each'), 'bread': (0.10, 'slice'),
+    'wrap': (0.25, 'each'), 'sweet potato': (1.50, 'kg'), 'potato': (1.00, 'kg'), 'onion': (0.15, 'each'),
+    'red onion': (0.20, 'each'), 'garlic': (0.10, 'clove'), 'spinach': (4.00, 'kg'), 'broccoli': (1.80, 'kg'),
+    'courgette': (0.50, 'each'), 'pepper': (0.60, 'each'), 'red pepper': (0.60, 'each'), 'carrot': (0.80, 'kg'),
+    'tomato': (2.50, 'kg'), 'cherry tomato': (4.00, 'kg'), 'mushroom': (3.50, 'kg'), 'banana': (0.20, 'each'),
+    'apple': (0.30, 'each'), 'blueberry': (8.00, 'kg'), 'berry': (6.00, 'kg'), 'frozen berry': (4.00, 'kg'),
+    'lemon': (0.35, 'each'), 'lime': (0.30, 'each'), 'avocado': (0.80, 'each'), 'chopped tomato': (0.55, 'tin'),
+    'chickpea': (2.00, 'kg'), 'lentil': (3.00, 'kg'), 'olive oil': (8.00, 'l'), 'peanut butter': (5.00, 'kg'),
+    'honey': (6.00, 'kg'), 'mixed nuts': (12.00, 'kg'), 'hummus': (4.00, 'kg'), 'frozen peas': (1.50, 'kg'),
+}
+PRICE_UNITS = {'kg': ('g', 1000), 'g': ('g', 1), 'l': ('ml', 1000), 'ml': ('ml', 1), 'each': ('', 1)}
+
+
+def _number(text):
+    """Parse '1', '1.5', '½', '1½', '1/2' or '1 1/2'"""
+    text = text.strip()
+    value = 0.0
+    if text and text[-1] in FRACTIONS:
+        value, text = FRACTIONS[text[-1]], text[:-1].strip()
+    if not text:
+        return value
+    whole, _, fraction = text.rpartition(' ') if '/' in text and ' ' in text else ('', '', text)
+    if '/' in fraction:
+        numerator, denominator = fraction.split('/')
+        value += float(numerator) / float(denominator) if float(denominator) else 0.0
+    else:
+        value += float(fraction)
+    return value + (float(whole) if whole else 0.0)
+
+
+def _singular(word):
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith(('oes', 'ches', 'shes', 'xes', 'sses')):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')) and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def normalise_item(text, singular=True):
+    """Shopping name of an ingredient: lower case, singular, without preparation words, notes or container"""
+    text = re.sub(r'\([^)]*\)', '', text.translate(MARKUP_CHARS).lower())
+    text = re.split(r',|;|\bfor\b|\bto taste\b|\bor\b', text, maxsplit=1)[0]
+    words = re.findall(r"[a-z][a-z'\-&]*", text)
+    kept = [phrase for phrase in PRODUCT_PHRASES if phrase in ' '.join(_singular(word) for word in words)]
+    words = [word for word in words if word not in PREPARATION_WORDS or any(word in phrase for phrase in kept)]
+    item = ' '.join(_singular(word) if singular else word for word in words)
+    container = CONTAINER_PATTERN.match(item)
+    return container.group(2) if container and container.group(2) else item
+
+
+def _unit(unit_word):
+    """Map a unit word onto (unit, factor to that unit, spoons)"""
+    word = unit_word.lower().rstrip('.')
+    if word in MASS_UNITS:
+        return 'g', MASS_UNITS[word], False
+    if word in VOLUME_UNITS:
+        return 'ml', VOLUME_UNITS[word], False
+    if word in SPOON_UNITS:
+        return 'ml', SPOON_UNITS[word], True
+    for unit in COUNT_UNITS:
+        if word in (unit, unit + 's', unit + 'es'):
+            return unit, 1, False
+    return '', 1, False
+
+
+def parse_ingredient(line):
+    """
+    Parse one ingredient line into an Ingredient
+
+    Handles quantity-first lines ("200g chicken breast", "2 tbsp olive oil",
+    "1½ red onions, diced", "2 x 400g tins chopped tomatoes") and the
+    "Chicken breast - 200g" layout. Lines without a quantity ("salt to
+    taste") come back with quantity None.
+
+    Returns:
+        Ingredient, or None if the line names no ingredient
+    """
+    text = line.strip().lstrip('-•*☐ ').translate(MARKUP_CHARS).strip()
+    if not text:
+        return None
+
+    match = QUANTITY_PATTERN.match(text)
+    if match is None:
+        trailing = TRAILING_QUANTITY_PATTERN.match(text)
+        if trailing and QUANTITY_PATTERN.match(trailing.group('quantity')):
+            quantity = QUANTITY_PATTERN.match(trailing.group('quantity'))
+            text = f"{quantity.group('times') + ' x ' if quantity.group('times') else ''}" \
+                   f"{quantity.group('number')}{quantity.group('unit') or ''} {trailing.group('item')}"
+            match = QUANTITY_PATTERN.match(text)
+
+    if match is None or UNQUANTIFIED_PATTERN.search(text) and not match.group('unit'):
+        text = UNQUANTIFIED_PATTERN.sub('', text)
+        item = normalise_item(text)
+        return Ingredient(item, normalise_item(text, singular=False), None, '', False) if item else None
+
+    item = normalise_item(match.group('item'))
+    if not item:
+        return None
+    # Buy for the top of a range
+    quantity = _number(match.group('upper') or match.group('number'))
+    unit, factor, spoons = _unit(match.group('unit') or '')
+    if match.group('times'):
+        quantity *= int(match.group('times'))
+    # "1 tin chopped tomatoes": counted in the container the item names
+    container = CONTAINER_PATTERN.match(match.group('item').strip().lower())
+    if not unit and container and container.group(2):
+        unit = container.group(1)
+    return Ingredient(item, normalise_item(match.group('item'), singular=False), quantity * factor, unit, spoons)
+
+
+def _title_key(title):
+    """Match key of a recipe name, without servings or notes"""
+    title = re.sub(r'\([^)]*\)', ' ', title.translate(MARKUP_CHARS).lower())
+    title = re.split(r'\s[-–|:]\s|\bserves\b|\brecipe\b', title)[0]
+    return ' '.join(re.findall(r'[a-z0-9]+', title))
+
+
+def _is_heading(line):
+    """Whether a line opens a new top-level plan section"""
+    if line.startswith('#') and not line.startswith('###'):
+        return True
+    clean = line.translate(MARKUP_CHARS).strip()
+    return clean.isupper() and bool(MAJOR_SECTION_PATTERN.search(clean))
+
+
+def _is_recipe_title(line, clean, after_blank):
+    """Whether a line in the recipes section starts a new recipe"""
+    if line.startswith('###') or (line.startswith('**') and line.endswith('**') and ':' not in clean):
+        return True
+    return (after_blank and not line.startswith(('-', '•', '*')) and not NUMBERED_PATTERN.match(line)
+            and ':' not in clean and len(clean) < 80 and not SERVINGS_PATTERN.match(clean))
+
+
+def read_plan_text(plan_text):
+    """
+    Pull the recipes and the meal plan lines out of plan text
+
+    Inside a recipe, the lines after an "Ingredients" heading are its
+    ingredients; a recipe without one has its bullet lines taken instead.
+
+    Returns:
+        Tuple of (list of RecipeIngredients, list of meal plan lines, days in the meal plan)
+    """
+    recipes, meal_lines, days = [], [], 0
+    section = ''
+    recipe = None
+    in_ingredients = False
+    after_blank = True
+
+    for raw_line in plan_text.split('\n'):
+        line = raw_line.strip()
+        if not line:
+            after_blank = True
+            continue
+        clean = line.translate(MARKUP_CHARS).strip()
+
+        if _is_heading(line):
+            section = clean.upper()
+            recipe = None
+        elif 'MEAL PLAN' in section:
+            if re.match(r'DAY\s*\d+', clean, re.IGNORECASE):
+                days += 1
+            meal_lines.append(clean)
+        elif 'RECIPE' in section:
+            bullet = line.startswith(('-', '•', '*')) and not line.startswith('**')
+            if INGREDIENTS_HEADING_PATTERN.match(clean):
+                in_ingredients = recipe is not None
+                if recipe is not None:
+                    recipe['explicit'] = True
+            elif OTHER_HEADING_PATTERN.match(clean):
+                in_ingredients = False
+            elif _is_recipe_title(line, clean, after_blank):
+                recipe = {'name': clean, 'servings': None, 'ingredients': [], 'explicit': False}
+                recipes.append(recipe)
+                in_ingredients = False
+            elif recipe is not None and not NUMBERED_PATTERN.match(line) and \
+                    (in_ingredients or (bullet and not recipe['explicit'])):
+                recipe['ingredients'].append(line)
+                after_blank = False
+                continue
+
+            # Servings are given with the title or the timings, ahead of the ingredients
+            if recipe is not None and recipe['servings'] is None and not recipe['ingredients']:
+                servings = SERVINGS_PATTERN.search(clean)
+                if servings and not OTHER_HEADING_PATTERN.match(clean):
+                    recipe['servings'] = int(servings.group(1))
+        after_blank = False
+
+    return ([RecipeIngredients(r['name'], r['servings'] or 1, r['ingredients']) for r in recipes if r['ingredients']],
+            meal_lines, days)
+
+
+def count_portions(recipes, meal_lines):
+    """
+    Portions of each recipe eaten over the plan: the meal plan lines naming it
+
+    Longer names are matched first, so "Chicken Salad Wrap" isn't also
+    counted as "Chicken Salad".
+
+    Returns:
+        {recipe name: portions}
+    """
+    keys = sorted(((_title_key(recipe.name), recipe.name) for recipe in recipes), key=lambda pair: -len(pair[0]))
+    portions = dict.fromkeys((recipe.name for recipe in recipes), 0)
+    for line in meal_lines:
+        text = f" {' '.join(re.findall(r'[a-z0-9]+', line.lower()))} "
+        for key, name in keys:
+            if key and f" {key} " in text:
+                portions[name] += 1
+                text = text.replace(f" {key} ", ' | ', 1)
+    return portions
+
+
+def categorise(item):
+    """Shop category of a normalised item name"""
+    for category, pattern in _CATEGORY_PATTERNS:
+        if pattern.search(item):
+            return category
+    return 'Other'
+
+
+def load_price_table(path):
+    """
+    Read a local price table over the defaults
+
+    The file is JSON mapping item names to [price in £, unit], where unit is
+    'kg', 'g', 'l', 'ml', 'each' or a count unit such as 'tin'.
+    """
+    with open(path) as f:
+        table = json.load(f)
+    return dict(DEFAULT_PRICES, **{normalise_item(item): tuple(entry) for item, entry in table.items()})
+
+
+def prices_digest(prices):
+    """Short hash of a price table, so anything priced from it can be told apart from the same thing priced from another"""
+    payload = json.dumps(sorted((item, list(entry)) for item, entry in prices.items()))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def price_item(item, quantity, unit, prices):
+    """Cost in £ of quantity of item from the price table, or None if it has no matching price"""
+    # The most specific (longest) matching name wins: "greek yoghurt" before "yoghurt"
+    for name in sorted(prices, key=len, reverse=True):
+        if not re.search(rf'\b{re.escape(name)}\b', item):
+            continue
+        price, price_unit = prices[name]
+        base, per = PRICE_UNITS.get(price_unit, (price_unit, 1))
+        if base == unit:
+            return price * quantity / per
+    return None
+
+
+def aggregate(recipes, meal_lines, prices=None):
+    """
+    Total the ingredients of every recipe for the portions eaten
+
+    Each recipe's quantities are for its stated servings, so they are scaled
+    by portions eaten / servings. A recipe the meal plan never names is
+    bought once, for all its servings.
+
+    Returns:
+        Tuple of ({category: [ShoppingItem, ...]} in CATEGORIES order, list of
+        ingredients bought without a quantity)
+    """
+    portions = count_portions(recipes, meal_lines)
+    totals = {}
+    names = {}
+    unquantified = {}
+    for recipe in recipes:
+        scale = portions[recipe.name] / recipe.servings if portions[recipe.name] else 1.0
+        for line in recipe.ingredients:
+            ingredient = parse_ingredient(line)
+            if ingredient is None:
+                continue
+            if ingredient.quantity is None:
+                unquantified.setdefault(ingredient.item, ingredient.name)
+                continue
+            key = (ingredient.item, ingredient.unit)
+            # Listed under the name it was first written with
+            names.setdefault(key, ingredient.name)
+            quantity, spoons = totals.get(key, (0.0, True))
+            totals[key] = (quantity + ingredient.quantity * scale, spoons and ingredient.spoons)
+
+    categories = {category: [] for category in CATEGORIES}
+    for (item, unit), (quantity, spoons) in sorted(totals.items()):
+        # Round up to what can be bought: whole items, 10g and 10ml steps
+        quantity = math.ceil(quantity - 1e-9) if unit not in ('g', 'ml') else \
+            (quantity if spoons and quantity < 100 else math.ceil(quantity / 10 - 1e-9) * 10)
+        cost = price_item(item, quantity, unit, prices) if prices else None
+        categories[categorise(item)].append(ShoppingItem(item, names[item, unit], quantity, unit, spoons, cost))
+    unquantified = [name for item, name in unquantified.items() if not any(item == key[0] for key in totals)]
+    return {category: items for category, items in categories.items() if items}, unquantified
+
+
+def format_quantity(item):
+    """Quantity of a ShoppingItem as shown on the list: '450g', '1.2kg', '3 tbsp', '2 tins', '6'"""
+    quantity, unit = item.quantity, item.unit
+    if unit == 'ml' and item.spoons and quantity < 100:
+        if quantity < 15:
+            return f"{math.ceil(quantity / 5 * 2) / 2:g} tsp"
+        return f"{math.ceil(quantity / 15 * 2) / 2:g} tbsp"
+    if unit in ('g', 'ml'):
+        big = 'kg' if unit == 'g' else 'l'
+        return f"{quantity / 1000:g}{big}" if quantity >= 1000 else f"{quantity:g}{unit}"
+    if unit:
+        plural = unit + ('es' if unit.endswith(('ch', 'sh')) else 's') if quantity != 1 else unit
+        return f"{quantity:g} {plural}"
+    return f"{quantity:g}"
+
+
+def weekly_budget(budget):
+    """Weekly budget in £ from the profile's answer ('£70', '70', '£60-£80'), or None"""
+    numbers = re.findall(r'\d+(?:\.\d+)?', str(budget or '').replace(',', ''))
+    return float(numbers[-1]) if numbers else None
+
+
+def build_shopping_list(plan_text, prices=None):
+    """
+    Build the shopping list for a text plan
+
+    Returns:
+        Dict with 'categories' ({category: [ShoppingItem, ...]}), 'unquantified'
+        items and 'days' in the meal plan
+    """
+    recipes, meal_lines, days = read_plan_text(plan_text)
+    categories, unquantified = aggregate(recipes, meal_lines, prices)
+    return {'categories': categories, 'unquantified': unquantified, 'days': days}
+
+
+def structured_shopping_list(data, user_data, prices=DEFAULT_PRICES):
+    """
+    Build the shopping list for a structured plan, in the plan tool's shopping_list shape
+
+    Returns:
+        Dict with 'categories' ([{'name', 'items': [{'item', 'quantity'}]}])
+        and, if any item could be priced, 'estimated_cost'
+    """
+    recipes = [RecipeIngredients(recipe['name'], recipe.get('servings') or 1, recipe['ingredients'])
+               for recipe in data['recipes'] if recipe.get('ingredients')]
+    meal_lines = [meal.get('description', '') for day in data['days'] for meal in day.get('meals', [])]
+    categories, unquantified = aggregate(recipes, meal_lines, prices)
+    shopping = {'categories': categories, 'unquantified': unquantified, 'days': len(data['days'])}
+
+    result = {'categories': [
+        {'name': category, 'items': [{'item': item.name.capitalize(), 'quantity': format_quantity(item)}
+                                     for item in items]}
+        for category, items in categories.items()
+    ]}
+    if unquantified:
+        result['categories'].append({'name': "Also Check You Have",
+                                     'items': [{'item': name.capitalize(), 'quantity': ''} for name in unquantified]})
+    cost = _cost_text(shopping, user_data)
+    if cost:
+        result['estimated_cost'] = cost
+    return result
+
+
+def _cost_text(shopping, user_data):
+    """The estimated cost, comparing the weekly cost with the client's budget, or None if nothing is priced"""
+    items = [item for items in shopping['categories'].values() for item in items]
+    priced = [item.cost for item in items if item.cost is not None]
+    if not priced:
+        return None
+    total = sum(priced)
+    days = shopping['days'] or int(weekly_budget(user_data.get('plan_duration')) or 7)
+    weekly = total * 7 / days
+    line = f"about £{total:.2f} for the whole plan (£{weekly:.2f} a week)"
+    budget = weekly_budget(user_data.get('budget'))
+    if budget:
+        line += (f", within your £{budget:g} weekly budget" if weekly <= budget else
+                 f", over your £{budget:g} weekly budget, so choose own-brand and frozen options where you can")
+    unpriced = len(items) - len(priced)
+    if unpriced:
+        line += f". {unpriced} items aren't in our price guide, so allow a little extra"
+    return line + "."
+
+
+def render_shopping_section(shopping, user_data):
+    """Write a built shopping list as section 4 of a text plan"""
+    days = shopping['days'] or user_data.get('plan_duration')
+    lines = [SHOPPING_HEADING, "",
+             f"Quantities cover every meal in your {days}-day plan, totalled from the recipes.", ""]
+    for category, items in shopping['categories'].items():
+        lines.append(f"### {category}")
+        lines.extend(f"- {item.name.capitalize()} - {format_quantity(item)}" for item in items)
+        lines.append("")
+    if shopping['unquantified']:
+        lines.append("### Also Check You Have")
+        lines.extend(f"- {item.capitalize()}" for item in shopping['unquantified'])
+        lines.append("")
+    cost = _cost_text(shopping, user_data)
+    if cost:
+        lines.append(f"**Estimated cost:** {cost}")
+    return '\n'.join(lines).rstrip()
+
+
+def shopping_section(plan_text, user_data, prices=DEFAULT_PRICES):
+    """Section 4 for a text plan, built from its recipes and meal plan"""
+    return render_shopping_section(build_shopping_list(plan_text, prices), user_data)
+
+
+def add_shopping_list(plan_text, user_data, prices=DEFAULT_PRICES):
+    """
+    Insert the locally built shopping list into a plan as section 4
+
+    It goes in before the meal prep guide or personal notes (or at the end).
+    A plan that already has a shopping list is returned unchanged.
+    """
+    if SHOPPING_HEADING_PATTERN.search(plan_text):
+        return plan_text
+    section = shopping_section(plan_text, user_data, prices)
+    match = SECTION_5_PATTERN.search(plan_text) or PERSONAL_NOTES_LINE_PATTERN.search(plan_text)
+    if match is None:
+        return plan_text.rstrip() + "\n\n" + section + "\n"
+    return plan_text[:match.start()].rstrip() + "\n\n" + section + "\n\n" + plan_text[match.start():].lstrip()
@@ -0,0 +1,254 @@
+"""
+Structured Plans
+Tool schema for requesting a plan as JSON, and conversion of that JSON to plan IR and plain text
+"""
+
+from functools import lru_cache
+import plan_ir
+from plan_ir import lex_plan
+from aftercare_templates import render_aftercare
+from shopping_list import structured_shopping_list
+
+PLAN_TOOL_NAME = 'record_nutrition_plan'
+
+_MACROS = {
+    'calories': {'type': 'number', 'description': "Energy in kcal"},
+    'protein_g': {'type': 'number'},
+    'carbs_g': {'type': 'number'},
+    'fat_g': {'type': 'number'},
+}
+
+PLAN_TOOL = {
+    'name': PLAN_TOOL_NAME,
+    'description': "Record the client's complete nutrition plan: sections 1 to 3 and the personal notes.",
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'analysis': {
+                'type': 'object',
+                'description': "Section 1, the nutritional analysis",
+                'properties': {
+                    'daily_targets': {'type': 'object', 'properties': _MACROS, 'required': list(_MACROS)},
+                    'paragraphs': {
+                        'type': 'array', 'items': {'type': 'string'},
+                        'description': "Strategy, explanation and what to expect, one paragraph per item"
+                    },
+                },
+                'required': ['daily_targets', 'paragraphs'],
+            },
+            'days': {
+                'type': 'array',
+                'description': "Section 2, one entry per day of the plan in order",
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'day': {'type': 'integer'},
+                        'meals': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'object',
+                                'properties': dict({
+                                    'name': {'type': 'string', 'description': "e.g. Breakfast, Lunch, Snack"},
+                                    'description': {'type': 'string',
+                                                    'description': "The meal, naming its recipe, with portion sizes"},
+                                }, **_MACROS),
+                                'required': ['name', 'description'] + list(_MACROS),
+                            },
+                        },
+                    },
+                    'required': ['day', 'meals'],
+                },
+            },
+            'recipes': {
+                'type': 'array',
+                'description': "Section 3, one recipe for each unique meal in the plan",
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'name': {'type': 'string'},
+                        'library_id': {'type': 'string',
+                                       'description': "ID of a known library recipe, e.g. R12, if this is one"},
+                        'prep_minutes': {'type': 'integer'},
+                        'cook_minutes': {'type': 'integer'},
+                        'servings': {'type': 'integer'},
+                        'ingredients': {'type': 'array', 'items': {'type': 'string'},
+                                        'description': "For the whole recipe, quantity first, e.g. "
+                                                       "\"200g chicken breast\"; the shopping list is totalled "
+                                                       "from these"},
+                        'method': {'type': 'array', 'items': {'type': 'string'}},
+                        'per_serving': {'type': 'object', 'properties': _MACROS},
+                    },
+                    'required': ['name', 'servings', 'ingredients', 'method'],
+                },
+            },
+            'personal_notes': {
+                'type': 'object',
+                'properties': {
+                    'supplements': {'type': 'array', 'items': {'type': 'string'},
+                                    'description': "Paragraphs on supplements, or why none are needed"},
+                    'note': {'type': 'array', 'items': {'type': 'string'},
+                             'description': "Two or three paragraphs of personal encouragement"},
+                },
+                'required': ['supplements', 'note'],
+            },
+        },
+        'required': ['analysis', 'days', 'recipes', 'personal_notes'],
+    },
+}
+
+
+def validate_plan_data(data):
+    """Check a structured plan has the parts the renderers rely on, raising ValueError if not"""
+    if not isinstance(data, dict):
+        raise ValueError("Structured plan is not an object")
+    missing = [key for key in PLAN_TOOL['input_schema']['required'] if key not in data]
+    if missing:
+        raise ValueError(f"Structured plan is missing: {', '.join(missing)}")
+    if not data['days'] or not all(isinstance(day, dict) and day.get('meals') for day in data['days']):
+        raise ValueError("Structured plan has a day without meals")
+    if not isinstance(data['recipes'], list):
+        raise ValueError("Structured plan recipes are malformed")
+    # Plans from before shopping lists were built locally carry their own
+    if 'shopping_list' in data and not isinstance(data['shopping_list'].get('categories'), list):
+        raise ValueError("Structured plan shopping list is malformed")
+    return data
+
+
+def _number(value):
+    """Format a quantity without a trailing .0"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return f"{value:,.0f}" if value == int(value) else f"{value:,.1f}"
+
+
+def _macro_summary(macros):
+    return (f"{_number(macros.get('calories', 0))} kcal, P {_number(macros.get('protein_g', 0))}g / "
+            f"C {_number(macros.get('carbs_g', 0))}g / F {_number(macros.get('fat_g', 0))}g")
+
+
+def _day_totals(meals):
+    totals = dict.fromkeys(_MACROS, 0.0)
+    for meal in meals:
+        for key in totals:
+            try:
+                totals[key] += float(meal.get(key) or 0)
+            except (TypeError, ValueError):
+                pass
+    return totals
+
+
+def _recipe_lines(recipe):
+    """A recipe's body lines, as they would appear under its title in a text plan"""
+    timings = []
+    if recipe.get('prep_minutes'):
+        timings.append(f"Prep time: {recipe['prep_minutes']} min")
+    if recipe.get('cook_minutes'):
+        timings.append(f"Cook time: {recipe['cook_minutes']} min")
+    if recipe.get('servings'):
+        timings.append(f"Serves {recipe['servings']}")
+
+    lines = [' | '.join(timings)] if timings else []
+    lines.append("Ingredients:")
+    lines.extend(f"- {ingredient}" for ingredient in recipe['ingredients'])
+    lines.append("Method:")
+    lines.extend(f"{number}. {step}" for number, step in enumerate(recipe['method'], 1))
+    if recipe.get('per_serving'):
+        lines.append(f"Per serving: {_macro_summary(recipe['per_serving'])}")
+    return lines
+
+
+@lru_cache(maxsize=64)
+def _lex_template(text):
+    """Aftercare templates are fixed text, so each is lexed only once"""
+    return tuple(lex_plan(text))
+
+
+def _section(title, major=True):
+    return plan_ir.Section(title, major, f"## {title}")
+
+
+def _subsection(title):
+    return plan_ir.Subsection(title, None, f"### {title}")
+
+
+def _paragraph(text, meal=None):
+    return plan_ir.Paragraph(text, meal, text)
+
+
+def _bullet(text, meal=None):
+    return plan_ir.Bullet(text, meal, f"- {text}")
+
+
+def plan_to_ir(data, user_data):
+    """
+    Convert a structured plan into plan IR nodes, with the templated aftercare sections
+
+    Returns:
+        List of plan_ir nodes in document order, ready for NutritionPlanPDF.add_nodes
+    """
+    nodes = [_section("1. NUTRITIONAL ANALYSIS")]
+    targets = data['analysis'].get('daily_targets', {})
+    nodes.append(_bullet(f"**Daily calories:** {_number(targets.get('calories', 0))} kcal"))
+    for label, key in [('Protein', 'protein_g'), ('Carbohydrates', 'carbs_g'), ('Fats', 'fat_g')]:
+        nodes.append(_bullet(f"**{label}:** {_number(targets.get(key, 0))}g"))
+    nodes.extend(_paragraph(text) for text in data['analysis'].get('paragraphs', []))
+
+    nodes.append(_section(f"2. {len(data['days'])}-DAY MEAL PLAN"))
+    for day in data['days']:
+        title = f"DAY {day['day']}"
+        nodes.append(plan_ir.DayHeader(title, f"**{title}:**"))
+        for meal in day['meals']:
+            nodes.append(_bullet(
+                f"**{meal['name']}:** {meal['description']} ({_macro_summary(meal)})", meal['name'].lower()
+            ))
+        nodes.append(_paragraph(f"_Day total: {_macro_summary(_day_totals(day['meals']))}_"))
+
+    nodes.append(_section("3. RECIPES"))
+    nodes.extend(plan_ir.Recipe(recipe['name'], _recipe_lines(recipe)) for recipe in data['recipes'])
+
+    shopping = data.get('shopping_list') or structured_shopping_list(data, user_data)
+    nodes.append(_section("4. SHOPPING LIST"))
+    for category in shopping['categories']:
+        nodes.append(_subsection(category['name']))
+        items = [f"- {entry['item']} - {entry['quantity']}" if entry['quantity'] else f"- {entry['item']}"
+                 for entry in category['items']]
+        nodes.append(plan_ir.ShoppingList(items, True))
+    if shopping.get('estimated_cost'):
+        nodes.append(_paragraph(f"**Estimated cost:** {shopping['estimated_cost']}"))
+    nodes.extend(_bullet(tip) for tip in shopping.get('money_saving_tips', []))
+
+    nodes.extend(_lex_template(render_aftercare(user_data)))
+
+    notes = data['personal_notes']
+    nodes.append(_subsection("Supplements"))
+    nodes.extend(_paragraph(text) for text in notes.get('supplements', []))
+    nodes.append(_subsection("A Note for You"))
+    nodes.extend(_paragraph(text) for text in notes.get('note', []))
+    return nodes
+
+
+def plan_to_text(data, user_data):
+    """
+    Write a structured plan out as a text plan in the usual six-section layout
+
+    Used for the saved .txt file; the PDF is rendered from plan_to_ir instead.
+    """
+    lines = []
+    for node in plan_to_ir(data, user_data):
+        if isinstance(node, plan_ir.Recipe):
+            lines.extend(['', f"**{node.title}**"] + node.lines + [''])
+        elif isinstance(node, plan_ir.ShoppingList):
+            lines.extend(node.items + [''])
+        elif isinstance(node, (plan_ir.Section, plan_ir.Subsection, plan_ir.DayHeader)):
+            lines.extend(['', node.line, ''])
+        elif isinstance(node, plan_ir.Paragraph):
+            lines.extend(['', node.line, ''])
+        else:
+            lines.append(node.line)
+
+    text = '\n'.join(lines).strip()
+    while '\n\n\n' in text:
+        text = text.replace('\n\n\n', '\n\n')
+    return text + '\n'
@@ -0,0 +1,9 @@
+"""
+Test Configuration
+Puts the repository root on sys.path, since the modules live there rather than in a package
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,114 @@
+"""
+Job Queue Tests
+Lanes, leases, attempts and claim tokens of the SQLite job queue
+"""
+
+import time
+import pytest
+from job_queue import JobQueue
+
+PROFILE = {'name': 'Jane Doe', 'plan_duration': '7'}
+
+
+@pytest.fixture
+def queue():
+    queue = JobQueue(':memory:', lease_seconds=60, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+def expire_leases(queue):
+    with queue._lock, queue._conn:
+        queue._conn.execute("UPDATE jobs SET lease_until = ? WHERE status = 'running'", (time.time() - 1,))
+
+
+def test_claims_paid_lane_first_then_oldest(queue):
+    bulk = queue.enqueue(PROFILE, lane='bulk')
+    standard = queue.enqueue(PROFILE)
+    paid = queue.enqueue(PROFILE, lane='paid')
+    later_standard = queue.enqueue(PROFILE)
+
+    claimed = [queue.claim('w')['job_id'] for _ in range(4)]
+
+    assert claimed == [paid, standard, later_standard, bulk]
+    assert queue.claim('w') is None
+
+
+def test_unknown_lane_is_rejected(queue):
+    with pytest.raises(ValueError):
+        queue.enqueue(PROFILE, lane='urgent')
+
+
+def test_expired_lease_is_claimed_again_with_a_new_token(queue):
+    job_id = queue.enqueue(PROFILE)
+    first = queue.claim('a')
+    assert queue.claim('b') is None
+
+    expire_leases(queue)
+    second = queue.claim('b')
+
+    assert second['job_id'] == job_id
+    assert second['attempts'] == 2
+    assert second['claim'] != first['claim']
+
+
+def test_renewed_lease_is_not_claimed_again(queue):
+    queue.enqueue(PROFILE)
+    job = queue.claim('a')
+    expire_leases(queue)
+
+    queue.renew([job['claim']])
+
+    assert queue.claim('b') is None
+
+
+def test_job_fails_after_max_attempts(queue):
+    job_id = queue.enqueue(PROFILE)
+
+    job = queue.claim('w')
+    assert queue.retry(job_id, job['claim'], "boom")
+    assert queue.get(job_id)['status'] == 'queued'
+    job = queue.claim('w')
+    assert queue.retry(job_id, job['claim'], "boom again")
+
+    failed = queue.get(job_id)
+    assert failed['status'] == 'failed'
+    assert failed['error'] == "boom again"
+    assert queue.claim('w') is None
+
+
+def test_job_whose_worker_vanished_fails_after_max_attempts(queue):
+    job_id = queue.enqueue(PROFILE)
+    for _ in range(2):
+        queue.claim('w')
+        expire_leases(queue)
+
+    assert queue.claim('w') is None
+    assert queue.get(job_id)['status'] == 'failed'
+
+
+def test_stale_claim_cannot_touch_the_new_one(queue):
+    # Both claims come from the same worker name, as two slots of one process would
+    job_id = queue.enqueue(PROFILE)
+    stale = queue.claim('host:1')
+    expire_leases(queue)
+    current = queue.claim('host:1')
+
+    assert not queue.finish(job_id, stale['claim'], 'ok', text_path='stale.txt')
+    assert not queue.retry(job_id, stale['claim'], "stale")
+    queue.release(job_id, stale['claim'])
+    assert queue.get(job_id)['status'] == 'running'
+
+    assert queue.finish(job_id, current['claim'], 'ok', text_path='plan.txt', result={'cached': False})
+    done = queue.get(job_id)
+    assert (done['status'], done['text_path'], done['result']) == ('ok', 'plan.txt', {'cached': False})
+
+
+def test_release_does_not_count_as_an_attempt(queue):
+    job_id = queue.enqueue(PROFILE)
+    job = queue.claim('w')
+
+    queue.release(job_id, job['claim'])
+
+    released = queue.get(job_id)
+    assert (released['status'], released['attempts']) == ('queued', 0)
@@ -0,0 +1,40 @@
+"""
+Message Batches Tests
+Submitting and collecting batches offline through the local transport
+"""
+
+import os
+import pytest
+from message_batches import BatchStore, LocalBatchTransport, collect_batch, submit_batch
+from nutrition_plan_generator import NutritionPlanGenerator
+
+PROFILE = {'name': 'Jane Doe', 'age': '34', 'gender': 'F', 'height': "5'6\"", 'weight': '70kg',
+           'ideal_weight': '64kg', 'budget': '£60', 'goal': 'Fat loss'}
+
+
+@pytest.fixture
+def store():
+    store = BatchStore(':memory:')
+    yield store
+    store.close()
+
+
+def test_rerun_after_a_crash_rewrites_the_same_plan_file(store, tmp_path):
+    generator = NutritionPlanGenerator()
+    transport = LocalBatchTransport(str(tmp_path / 'batches'))
+    output_dir = str(tmp_path / 'plans')
+    batch_id = submit_batch(generator, [PROFILE], transport, store, output_dir, make_pdf=False)
+
+    custom_id = next(iter(store.pending(batch_id)))
+
+    # The process dies after saving the plan but before marking it collected
+    def killed(*args, **kwargs):
+        raise RuntimeError("killed")
+    finish, store.finish = store.finish, killed
+    assert collect_batch(generator, transport, store, batch_id) == {'pending': 1}
+    store.finish = finish
+
+    assert collect_batch(generator, transport, store, batch_id) == {'ok': 1}
+    saved = os.listdir(output_dir)
+    assert len(saved) == 1
+    assert store.output_paths(batch_id, custom_id)[0] == os.path.join(output_dir, saved[0])
@@ -0,0 +1,25 @@
+"""
+Plan Cache Tests
+Which profile differences share a cached plan
+"""
+
+from plan_cache import make_cache_key
+
+FIELDS = {'name': 'Jo Smith', 'goal': 'Fat loss', 'allergies': 'Peanuts'}
+
+
+def key(**fields):
+    return make_cache_key(dict(FIELDS, **fields), 'model', '1')
+
+
+def test_case_and_spacing_of_answers_share_a_key():
+    assert key(goal='  fat   LOSS ', allergies='peanuts') == key()
+
+
+def test_names_differing_only_in_case_do_not_share_a_key():
+    assert key(name='JO SMITH') != key()
+    assert key(name=' Jo  Smith ') == key()
+
+
+def test_context_is_part_of_the_key():
+    assert make_cache_key(FIELDS, 'model', '1', {'prices': 'a'}) != make_cache_key(FIELDS, 'model', '1', {'prices': 'b'})
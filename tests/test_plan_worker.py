@@ -0,0 +1,115 @@
+"""
+Plan Worker Tests
+The resident worker run offline on stub API clients against an in-memory queue
+"""
+
+import os
+import re
+import signal
+import asyncio
+import pytest
+from job_queue import JobQueue
+from plan_worker import PlanWorker, use_stub_api
+from nutrition_plan_generator import NutritionPlanGenerator, normalise_profile
+
+PROFILE = {'name': 'Jane Doe', 'age': '34', 'gender': 'F', 'height': "5'6\"", 'weight': '70kg',
+           'ideal_weight': '64kg', 'budget': '£60', 'goal': 'Fat loss'}
+
+
+def profile(**fields):
+    return normalise_profile(dict(PROFILE, **fields))
+
+
+@pytest.fixture
+def queue():
+    queue = JobQueue(':memory:', lease_seconds=60, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def generator():
+    generator = NutritionPlanGenerator()
+    use_stub_api(generator)
+    return generator
+
+
+def run(worker):
+    return asyncio.run(worker.serve(exit_when_idle=True))
+
+
+def test_long_plan_is_stitched_with_each_section_once(queue, generator, tmp_path):
+    job_id = queue.enqueue(profile(plan_duration='14'), output_dir=str(tmp_path), make_pdf=False)
+
+    stats = run(PlanWorker(generator, queue, concurrency=1))
+
+    assert stats['ok'] == 1
+    job = queue.get(job_id)
+    with open(job['text_path']) as f:
+        plan = f.read()
+    for heading in ('1. NUTRITIONAL ANALYSIS', '2. 14-DAY MEAL PLAN', '3. RECIPES', '4. SHOPPING LIST',
+                    '5. MEAL PREP GUIDE', '6. ADDITIONAL TIPS & ADVICE'):
+        assert len(re.findall(rf'^## {re.escape(heading)}$', plan, re.MULTILINE)) == 1, heading
+    assert [int(day) for day in re.findall(r'^\*\*DAY (\d+):\*\*$', plan, re.MULTILINE)] == list(range(1, 15))
+    # Three requests for the analysis and notes, plus one per week
+    assert generator.async_client.messages.requests == 4
+
+
+def test_jobs_run_in_lane_order(queue, generator, tmp_path):
+    bulk = queue.enqueue(profile(name='Bulk'), lane='bulk', output_dir=str(tmp_path), make_pdf=False)
+    paid = queue.enqueue(profile(name='Paid'), lane='paid', output_dir=str(tmp_path), make_pdf=False)
+
+    run(PlanWorker(generator, queue, concurrency=1))
+
+    assert queue.get(paid)['finished_at'] < queue.get(bulk)['finished_at']
+
+
+def test_failing_job_is_retried_then_failed(queue, generator, tmp_path):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("API down")
+    generator.request_plan_async = fail
+    job_id = queue.enqueue(profile(), output_dir=str(tmp_path), make_pdf=False)
+
+    stats = run(PlanWorker(generator, queue, concurrency=1))
+
+    assert (stats['retried'], stats['failed']) == (1, 1)
+    assert queue.get(job_id)['status'] == 'failed'
+
+
+def test_result_is_discarded_when_lease_is_lost(queue, generator, tmp_path):
+    job_id = queue.enqueue(profile(), output_dir=str(tmp_path), make_pdf=False)
+    request_plan = generator.request_plan_async
+    claims = []
+
+    async def stall(*args, **kwargs):
+        # The lease runs out mid-job and another slot of the same worker claims the job again
+        with queue._lock, queue._conn:
+            queue._conn.execute("UPDATE jobs SET lease_until = 0")
+        claims.append(queue.claim('host:1'))
+        return await request_plan(*args, **kwargs)
+    generator.request_plan_async = stall
+
+    stats = run(PlanWorker(generator, queue, concurrency=1, name='host:1'))
+
+    assert stats['lost'] == 1 and stats['ok'] == 0
+    job = queue.get(job_id)
+    assert (job['status'], job['claim'], job['text_path']) == ('running', claims[0]['claim'], None)
+
+
+def test_signal_drains_running_jobs_and_leaves_the_rest_queued(queue, tmp_path):
+    generator = NutritionPlanGenerator()
+    use_stub_api(generator, latency=0.3)
+    job_ids = [queue.enqueue(profile(), output_dir=str(tmp_path), make_pdf=False) for _ in range(3)]
+    request_plan = generator.request_plan_async
+
+    async def signal_once_started(*args, **kwargs):
+        if not worker.draining:
+            os.kill(os.getpid(), signal.SIGTERM)
+        return await request_plan(*args, **kwargs)
+    generator.request_plan_async = signal_once_started
+    worker = PlanWorker(generator, queue, concurrency=1, poll_seconds=0.05)
+
+    stats = asyncio.run(worker.serve())
+
+    assert worker.draining and stats['ok'] == 1
+    assert [queue.get(job_id)['status'] for job_id in job_ids] == ['ok', 'queued', 'queued']
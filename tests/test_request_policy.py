@@ -0,0 +1,86 @@
+"""
+Request Policy Tests
+Hedged requests where both copies have finished by the time the first is looked at
+"""
+
+import asyncio
+import threading
+import concurrent.futures
+import pytest
+import request_policy
+from types import SimpleNamespace
+from request_policy import HedgePolicy, RequestRunner, RetryPolicy
+
+REQUEST = {'model': 'test', 'max_tokens': 100, 'messages': []}
+
+
+def hedging_runner():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.05, max_ratio=1.0)
+    hedge.observe('plan', 0.05)
+    return RequestRunner(RetryPolicy(max_retries=0), hedge)
+
+
+class FailFirstThenAnswer:
+    """messages stand-in: the first request fails (once the second has been sent), the second answers"""
+
+    def __init__(self):
+        self.calls = 0
+        self.hedged = threading.Event()
+
+    def create(self, **request):
+        self.calls += 1
+        if self.calls == 1:
+            self.hedged.wait(5)
+            raise RuntimeError("primary failed")
+        self.hedged.set()
+        return 'hedge reply'
+
+
+def test_sync_hedge_prefers_the_request_that_succeeded(monkeypatch):
+    def wait_for_both(futures, timeout=None, return_when=concurrent.futures.ALL_COMPLETED):
+        if return_when == concurrent.futures.FIRST_COMPLETED:
+            return_when = concurrent.futures.ALL_COMPLETED
+        return concurrent.futures.wait(futures, timeout, return_when)
+    monkeypatch.setattr(request_policy, 'wait', wait_for_both)
+    client = SimpleNamespace(messages=FailFirstThenAnswer())
+
+    assert hedging_runner().create(client, REQUEST, 'plan') == 'hedge reply'
+
+
+def test_async_hedge_prefers_the_request_that_succeeded(monkeypatch):
+    wait = asyncio.wait
+
+    async def wait_for_both(tasks, timeout=None, return_when=asyncio.ALL_COMPLETED):
+        if return_when == asyncio.FIRST_COMPLETED:
+            return_when = asyncio.ALL_COMPLETED
+        return await wait(tasks, timeout=timeout, return_when=return_when)
+    monkeypatch.setattr(request_policy.asyncio, 'wait', wait_for_both)
+
+    class Messages:
+        calls = 0
+
+        async def create(self, **request):
+            Messages.calls += 1
+            if Messages.calls == 1:
+                await asyncio.sleep(0.1)
+                raise RuntimeError("primary failed")
+            return 'hedge reply'
+
+    client = SimpleNamespace(messages=Messages())
+    assert asyncio.run(hedging_runner().create_async(client, REQUEST, 'plan')) == 'hedge reply'
+
+
+def test_hedge_raises_when_both_requests_fail():
+    class Messages:
+        def create(self, **request):
+            raise RuntimeError("down")
+
+    with pytest.raises(RuntimeError):
+        hedging_runner().create(SimpleNamespace(messages=Messages()), REQUEST, 'plan')
+
+
+def test_hedges_stop_at_the_token_budget():
+    hedge = HedgePolicy(max_ratio=1.0, max_tokens_budget=250)
+    hedge.requests = 10
+
+    assert [hedge.allow(REQUEST) for _ in range(3)] == [True, True, False]